@@ -1,13 +1,35 @@
 from .base import (
+    NullMetricsSink,
+    HistogramMetricsSink,
     DummyPayloadSerializer,
     MsgPackPayloadSerializer,
     ZlibPayloadSerializer,
+    Lz4PayloadSerializer,
+    ZstdPayloadSerializer,
+    ParallelZlibPayloadSerializer,
+    train_zstd_dictionary,
     MsgPackZlibPayloadSerializer,
+    MsgPackZlibStreamPayloadSerializer,
+    FramedPayloadSerializer,
+    IndexedPayloadSerializer,
     Snapshot,
     SnapshotPatch,
+    squash_patches,
+    CompactSnapshot,
+    LazySnapshot,
     BaseCoreDataSnapshotStorageException,
+    SnapshotsLockedException,
+    ConditionalSnapshotResult,
+    KeepLastRetentionPolicy,
+    KeepNewerThanRetentionPolicy,
+    KeepEveryNthRetentionPolicy,
     DummyCoreDataSnapshotStorage,
     CompatCoreDataSnapshotStorage,
     CoreDataSnapshotStorage,
+    SegmentedCoreDataSnapshotStorage,
     S3CoreDataSnapshotStorage,
+    CachedCoreDataSnapshotStorage,
+    TieredCoreDataSnapshotStorage,
+    FileCoreDataSnapshotStorage,
+    SnapshotRefresher,
 )
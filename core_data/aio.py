@@ -0,0 +1,323 @@
+import asyncio
+import hashlib
+
+import redis
+
+from .base import (
+    Snapshot,
+    SnapshotPatch,
+    BaseCoreDataSnapshotStorageException,
+    SnapshotsLockedException,
+    BasePayloadSerializerException,
+    MsgPackZlibStreamPayloadSerializer,
+    ZlibPayloadSerializer,
+)
+
+try:
+    import botocore.exceptions
+    S3_ERRORS = (
+        botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError)
+except ImportError:  # pragma: no cover
+    S3_ERRORS = ()
+
+
+def _get_s3_error_status(error):
+    response = getattr(error, 'response', None) or {}
+    return response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+
+
+class _AsyncPayloadMixin(object):
+    def _init_payload(
+            self, snapshot_factory, snapshot_patch_factory,
+            payload_serializer, executor):
+        self._snapshot_factory = snapshot_factory
+        self._snapshot_patch_factory = snapshot_patch_factory
+        self._payload_serializer = payload_serializer
+        self._executor = executor
+        self._pending_fetches = {}
+
+    async def _run_in_executor(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    def _pack_payload_sync(self, payload):
+        try:
+            return self._payload_serializer.pack(payload)
+        except BasePayloadSerializerException as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+    def _unpack_payload_sync(self, packed_payload):
+        try:
+            return self._payload_serializer.unpack(packed_payload)
+        except BasePayloadSerializerException as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+    async def _pack_payload(self, payload):
+        return await self._run_in_executor(self._pack_payload_sync, payload)
+
+    async def _unpack_payload(self, packed_payload):
+        return await self._run_in_executor(
+            self._unpack_payload_sync, packed_payload)
+
+    async def _coalesce(self, key, coroutine_function, *args):
+        # concurrent requests for the same key share a single fetch
+        future = self._pending_fetches.get(key)
+        if future is None:
+            future = asyncio.ensure_future(coroutine_function(*args))
+            self._pending_fetches[key] = future
+            future.add_done_callback(
+                lambda _: self._pending_fetches.pop(key, None))
+        return await asyncio.shield(future)
+
+    def _clean_version(self, version):
+        try:
+            return int(version)
+        except (TypeError, ValueError):
+            raise BaseCoreDataSnapshotStorageException('Invalid version')
+
+
+class AsyncCoreDataSnapshotStorage(_AsyncPayloadMixin):
+    def __init__(
+            self, redis_conn, snapshots_lock_ttl=5,
+            ignore_snapshots_lock_once=True,
+            ignore_snapshots_lock_always=False,
+            snapshot_factory=Snapshot, snapshot_patch_factory=SnapshotPatch,
+            payload_serializer=None, executor=None):
+        if payload_serializer is None:
+            payload_serializer = MsgPackZlibStreamPayloadSerializer()
+        self._init_payload(
+            snapshot_factory, snapshot_patch_factory, payload_serializer,
+            executor)
+
+        self._redis_conn = redis_conn
+        self._redis_lock_get_script = None
+
+        self._snapshots_lock_ttl = snapshots_lock_ttl
+        self._ignore_snapshots_lock_once = ignore_snapshots_lock_once
+        self._ignore_snapshots_lock_always = ignore_snapshots_lock_always
+
+        self._latest_version_key = 'snapshot:latest_version'
+        self._versions_key = 'snapshot:versions'
+        self._chunks_manifest_prefix = b'chunks:'
+
+    @property
+    def redis_conn(self):
+        return self._redis_conn
+
+    def _get_snapshot_key_by_version(self, version):
+        return 'snapshot:%s' % version
+
+    def _get_snapshot_digest_key_by_version(self, version):
+        return 'snapshot:%s:digest' % version
+
+    def _get_patch_key_by_snapshot_version(self, version):
+        return 'snapshot:%s:patch' % version
+
+    def _get_chunks_key(self, key):
+        return '%s:chunks' % key
+
+    def _ignore_snapshots_lock(self):
+        if self._ignore_snapshots_lock_always:
+            return True
+
+        if self._ignore_snapshots_lock_once:
+            self._ignore_snapshots_lock_once = False
+            return True
+
+        return False
+
+    def _get_redis_lock_get_script(self):
+        if self._redis_lock_get_script is None:
+            self._redis_lock_get_script = self._redis_conn.register_script(
+                """
+                --lockgetscript, parameters: lock_key, key, lock_timeout
+                local ttl = redis.call('ttl', KEYS[1])
+                if ttl > 0 then
+                    return {0}
+                end
+                redis.call('setex', KEYS[1], ARGV[1], 'locked')
+                return {1, redis.call('get', KEYS[2])}""")
+        return self._redis_lock_get_script
+
+    async def set_latest_version(self, version):
+        version = self._clean_version(version)
+        try:
+            await self._redis_conn.set(self._latest_version_key, version)
+            await self._redis_conn.publish(
+                '%s:updates' % self._latest_version_key, version)
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+    async def get_latest_version(self):
+        try:
+            version = await self._redis_conn.get(self._latest_version_key)
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        return self._clean_version(version)
+
+    async def _get_packed_payload_by_key(self, key):
+        try:
+            if self._ignore_snapshots_lock():
+                return await self._redis_conn.get(key)
+
+            result = await self._get_redis_lock_get_script()(
+                keys=('snapshots_lock', key),
+                args=(self._snapshots_lock_ttl,),
+                client=self._redis_conn)
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        if not result or not result[0]:
+            raise SnapshotsLockedException('locked')
+        return result[1] if len(result) > 1 else None
+
+    async def _get_chunks_by_manifest(self, key, manifest):
+        try:
+            chunks_count, size = [
+                int(value) for value in manifest[
+                    len(self._chunks_manifest_prefix):].split(b':')]
+        except ValueError:
+            raise BaseCoreDataSnapshotStorageException('Invalid manifest')
+
+        try:
+            pipeline = self._redis_conn.pipeline(transaction=False)
+            for index in range(chunks_count):
+                pipeline.hget(self._get_chunks_key(key), index)
+            chunks = await pipeline.execute()
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        if None in chunks or sum(len(chunk) for chunk in chunks) != size:
+            raise BaseCoreDataSnapshotStorageException('Broken chunks')
+        return b''.join(chunks)
+
+    async def _get_payload_by_key(self, key):
+        packed_payload = await self._get_packed_payload_by_key(key)
+        if (isinstance(packed_payload, bytes) and
+                packed_payload.startswith(self._chunks_manifest_prefix)):
+            packed_payload = await self._get_chunks_by_manifest(
+                key, packed_payload)
+        return await self._unpack_payload(packed_payload)
+
+    async def _set_payload_by_key(self, key, payload, version=None):
+        packed_payload = await self._pack_payload(payload)
+        try:
+            pipeline = self._redis_conn.pipeline()
+            pipeline.set(key, packed_payload)
+            if version is not None:
+                # get_snapshot_if_changed compares against this digest, it
+                # must change along with the snapshot
+                pipeline.set(
+                    self._get_snapshot_digest_key_by_version(version),
+                    hashlib.sha1(packed_payload).hexdigest())
+                pipeline.zadd(self._versions_key, {version: version})
+            await pipeline.execute()
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+    async def set_snapshot_by_version(self, version, snapshot):
+        version = self._clean_version(version)
+        await self._set_payload_by_key(
+            self._get_snapshot_key_by_version(version), snapshot.payload,
+            version=version)
+
+    async def _fetch_snapshot_by_version(self, version):
+        snapshot_payload = await self._get_payload_by_key(
+            self._get_snapshot_key_by_version(version))
+        return self._snapshot_factory(version, snapshot_payload)
+
+    async def get_snapshot_by_version(self, version):
+        return await self._coalesce(
+            ('snapshot', version), self._fetch_snapshot_by_version, version)
+
+    async def set_patch_by_version(self, version, patch):
+        await self._set_payload_by_key(
+            self._get_patch_key_by_snapshot_version(version), patch.payload)
+
+    async def _fetch_patch_by_version(self, version):
+        patch_payload = await self._get_payload_by_key(
+            self._get_patch_key_by_snapshot_version(version))
+        return self._snapshot_patch_factory(version, patch_payload)
+
+    async def get_patch_by_version(self, version):
+        return await self._coalesce(
+            ('patch', version), self._fetch_patch_by_version, version)
+
+
+class AsyncS3CoreDataSnapshotStorage(_AsyncPayloadMixin):
+    def __init__(
+            self, s3_client, bucket_name='unitcore',
+            snapshot_factory=Snapshot, snapshot_patch_factory=SnapshotPatch,
+            payload_serializer=None, executor=None):
+        if payload_serializer is None:
+            payload_serializer = ZlibPayloadSerializer()
+        self._init_payload(
+            snapshot_factory, snapshot_patch_factory, payload_serializer,
+            executor)
+
+        self._s3_client = s3_client
+        self._bucket_name = bucket_name
+
+        self._latest_version_key = 'snapshots/latest_version'
+        self._latest_version = None
+        self._latest_version_etag = None
+
+    async def set_latest_version(self, version):
+        version = self._clean_version(version)
+        try:
+            await self._s3_client.put_object(
+                Bucket=self._bucket_name, Key=self._latest_version_key,
+                Body=str(version).encode())
+        except S3_ERRORS as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+    async def get_latest_version(self):
+        kwargs = {}
+        if self._latest_version_etag is not None:
+            kwargs['IfNoneMatch'] = self._latest_version_etag
+
+        try:
+            response = await self._s3_client.get_object(
+                Bucket=self._bucket_name, Key=self._latest_version_key,
+                **kwargs)
+            version = await response['Body'].read()
+        except S3_ERRORS as error:
+            if (_get_s3_error_status(error) == 304 and
+                    self._latest_version is not None):
+                return self._latest_version
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        version = self._clean_version(version)
+        self._latest_version = version
+        self._latest_version_etag = response.get('ETag')
+        return version
+
+    def _get_snapshot_key_by_version(self, version):
+        return 'snapshots/snapshot_%s' % version
+
+    async def set_snapshot_by_version(self, version, snapshot):
+        packed_payload = await self._pack_payload(snapshot.payload)
+        try:
+            await self._s3_client.put_object(
+                Bucket=self._bucket_name,
+                Key=self._get_snapshot_key_by_version(version),
+                Body=packed_payload)
+        except S3_ERRORS as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+    async def _fetch_snapshot_by_version(self, version):
+        try:
+            response = await self._s3_client.get_object(
+                Bucket=self._bucket_name,
+                Key=self._get_snapshot_key_by_version(version))
+            packed_payload = await response['Body'].read()
+        except S3_ERRORS as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        payload = await self._unpack_payload(packed_payload)
+        return self._snapshot_factory(version, payload)
+
+    async def get_snapshot_by_version(self, version):
+        return await self._coalesce(
+            ('snapshot', version), self._fetch_snapshot_by_version, version)
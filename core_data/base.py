@@ -1,14 +1,67 @@
 import abc
+import bisect
+import collections
+import copy
+import errno
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import random
+import tempfile
+import multiprocessing.pool
+import io
+import itertools
+import struct
+import sys
+import threading
+import time
 
 import zlib
 import json
 
+try:
+    import Queue
+except ImportError:  # pragma: no cover
+    import queue as Queue
+
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:  # pragma: no cover
+    from collections import Mapping, MutableMapping
+
 import msgpack
 import redis
 import boto
 import boto.s3.key
 import boto.exception
 
+BOTO_ERRORS = (boto.exception.BotoClientError, boto.exception.BotoServerError)
+
+# packed payloads may also be read-only views, e.g. of a downloaded
+# bytearray or of a mapped file
+try:
+    BUFFER_TYPES = (str, buffer, bytearray, mmap.mmap)
+except NameError:  # pragma: no cover
+    BUFFER_TYPES = (bytes, memoryview, bytearray, mmap.mmap)
+
+# msgpack 0.5.2 replaced the encoding argument by raw, 1.0 dropped encoding
+if msgpack.version >= (0, 5, 2):
+    MSGPACK_UNPACK_KWARGS = {'raw': False}
+else:  # pragma: no cover
+    MSGPACK_UNPACK_KWARGS = {'encoding': 'utf-8'}
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
 
 # TODO: refactor SnapshotPatch
 # TODO: create a version factory (think of comparison)
@@ -31,6 +84,10 @@ class BaseSnapshot(object):
     def make_patch(self, new_snapshot):  # pragma: no cover
         pass
 
+    @abc.abstractmethod
+    def apply_patch(self, patch):  # pragma: no cover
+        pass
+
     # TODO: meta (size, time etc)
 
 
@@ -90,7 +147,169 @@ class BaseCoreDataSnapshotStorageException(Exception):
     pass
 
 
+class SnapshotsLockedException(BaseCoreDataSnapshotStorageException):
+    pass
+
+
+class BaseMetricsSink(object):
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def observe(self, name, value):  # pragma: no cover
+        pass
+
+    @abc.abstractmethod
+    def increment(self, name, count=1):  # pragma: no cover
+        pass
+
+    def timer(self, name):
+        return _MetricsTimer(self, name)
+
+
+class _MetricsTimer(object):
+    __slots__ = ('_sink', '_name', '_start_time')
+
+    def __init__(self, sink, name):
+        self._sink = sink
+        self._name = name
+        self._start_time = None
+
+    def __enter__(self):
+        self._start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._sink.observe(self._name, time.time() - self._start_time)
+
+
+class _NullMetricsTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class NullMetricsSink(BaseMetricsSink):
+    # the default sink, timers are a shared no-op object so that an
+    # uninstrumented call only costs an attribute lookup and a with block
+    _timer = _NullMetricsTimer()
+
+    def observe(self, name, value):
+        pass
+
+    def increment(self, name, count=1):
+        pass
+
+    def timer(self, name):
+        return self._timer
+
+
+NULL_METRICS_SINK = NullMetricsSink()
+
+
+class _Histogram(object):
+    # values are counted in power of two buckets, so percentiles are
+    # reported as the upper bound of the bucket they fall into; zero and
+    # negative values share a bucket below every exponent
+    ZERO_BUCKET = float('-inf')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = collections.Counter()
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value > 0:
+            self.buckets[math.frexp(value)[1]] += 1
+        else:
+            self.buckets[self.ZERO_BUCKET] += 1
+
+    def get_percentile(self, percentile):
+        rank = self.count * percentile / 100.0
+        seen = 0
+        for exponent in sorted(self.buckets):
+            seen += self.buckets[exponent]
+            if seen >= rank:
+                if exponent == self.ZERO_BUCKET:
+                    return 0.0
+                return min(math.ldexp(1.0, exponent), self.max)
+        return self.max
+
+    def summarize(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.get_percentile(50),
+            'p90': self.get_percentile(90),
+            'p99': self.get_percentile(99),
+        }
+
+
+class HistogramMetricsSink(BaseMetricsSink):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = collections.defaultdict(_Histogram)
+        self._counters = collections.Counter()
+
+    def observe(self, name, value):
+        with self._lock:
+            self._histograms[name].add(value)
+
+    def increment(self, name, count=1):
+        with self._lock:
+            self._counters[name] += count
+
+    def get_counter(self, name):
+        with self._lock:
+            return self._counters[name]
+
+    def get_histogram(self, name):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            return None if histogram is None else histogram.summarize()
+
+    def summarize(self):
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'histograms': dict(
+                    (name, histogram.summarize())
+                    for name, histogram in self._histograms.items()),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
 class BasePayloadSerializer(object):
+    codec_id = None
+    metrics_sink = NULL_METRICS_SINK
+
+    def set_metrics_sink(self, metrics_sink):
+        self.metrics_sink = metrics_sink
+
+    def _observe_compression_ratio(self, name, payload, packed_payload):
+        if payload:
+            self.metrics_sink.observe(
+                '%s.compression_ratio' % name,
+                float(len(packed_payload)) / len(payload))
+
     @abc.abstractmethod
     def pack(self, payload):  # pragma: no cover
         pass
@@ -104,7 +323,18 @@ class BasePayloadSerializerException(Exception):
     pass
 
 
+class BaseStreamPayloadSerializer(BasePayloadSerializer):
+    @abc.abstractmethod
+    def unpack_stream(self, packed_chunks):  # pragma: no cover
+        pass
+
+    def unpack(self, packed_payload):
+        return self.unpack_stream((packed_payload,))
+
+
 class DummyPayloadSerializer(BasePayloadSerializer):
+    codec_id = 0
+
     def pack(self, payload):
         return payload
 
@@ -113,62 +343,256 @@ class DummyPayloadSerializer(BasePayloadSerializer):
 
 
 class JsonPayloadSerializer(BasePayloadSerializer):
+    codec_id = 1
+
     def pack(self, payload):
-        try:
-            packed_payload = json.dumps(payload)
-        except:
-            raise BasePayloadSerializerException()
+        with self.metrics_sink.timer('json.encode'):
+            try:
+                packed_payload = json.dumps(payload)
+            except:
+                raise BasePayloadSerializerException()
         return packed_payload
 
     def unpack(self, packed_payload):
-        try:
-            payload = json.loads(packed_payload)
-        except:
-            raise BasePayloadSerializerException()
+        with self.metrics_sink.timer('json.decode'):
+            try:
+                payload = json.loads(packed_payload)
+            except:
+                raise BasePayloadSerializerException()
         return payload
 
 
 class MsgPackPayloadSerializer(BasePayloadSerializer):
-    def __init__(self, unpack_use_list=False):
+    codec_id = 2
+
+    def __init__(self, unpack_use_list=False, compact=False):
         self._unpack_use_list = unpack_use_list
+        self._compact = compact
 
     def pack(self, payload):
-        try:
-            packed_payload = msgpack.packb(payload)
-        except (TypeError, msgpack.PackException) as error:
-            raise BasePayloadSerializerException(error)
+        with self.metrics_sink.timer('msgpack.encode'):
+            try:
+                packed_payload = msgpack.packb(payload)
+            except (TypeError, msgpack.PackException) as error:
+                raise BasePayloadSerializerException(error)
         return packed_payload
 
     def unpack(self, packed_payload):
-        try:
-            payload = msgpack.unpackb(
-                packed_payload, encoding='utf-8',
-                use_list=self._unpack_use_list)
-        except (TypeError, ValueError, msgpack.UnpackException) as error:
-            raise BasePayloadSerializerException(error)
+        with self.metrics_sink.timer('msgpack.decode'):
+            try:
+                payload = msgpack.unpackb(
+                    packed_payload, use_list=self._unpack_use_list,
+                    **_get_unpack_kwargs(self._compact))
+            except (TypeError, ValueError, msgpack.UnpackException) as error:
+                raise BasePayloadSerializerException(error)
         return payload
 
 
 class ZlibPayloadSerializer(BasePayloadSerializer):
+    codec_id = 3
+
+    def __init__(self, level=1):
+        self._level = level
+
     def pack(self, payload):
-        try:
-            packed_payload = zlib.compress(payload, 1)
-        except (TypeError, zlib.error) as error:
-            raise BasePayloadSerializerException(error)
+        with self.metrics_sink.timer('zlib.compress'):
+            try:
+                packed_payload = zlib.compress(payload, self._level)
+            except (TypeError, zlib.error) as error:
+                raise BasePayloadSerializerException(error)
+        self._observe_compression_ratio('zlib', payload, packed_payload)
+        return packed_payload
+
+    def unpack(self, packed_payload):
+        with self.metrics_sink.timer('zlib.decompress'):
+            try:
+                payload = zlib.decompress(packed_payload)
+            except (TypeError, zlib.error) as error:
+                raise BasePayloadSerializerException(error)
+        return payload
+
+
+class Lz4PayloadSerializer(BasePayloadSerializer):
+    codec_id = 4
+
+    def __init__(self, level=0):
+        if lz4 is None:
+            raise BasePayloadSerializerException('lz4 is not installed')
+        self._level = level
+
+    def pack(self, payload):
+        with self.metrics_sink.timer('lz4.compress'):
+            try:
+                packed_payload = lz4.frame.compress(
+                    payload, compression_level=self._level)
+            except (TypeError, RuntimeError) as error:
+                raise BasePayloadSerializerException(error)
+        self._observe_compression_ratio('lz4', payload, packed_payload)
+        return packed_payload
+
+    def unpack(self, packed_payload):
+        with self.metrics_sink.timer('lz4.decompress'):
+            try:
+                payload = lz4.frame.decompress(packed_payload)
+            except (TypeError, RuntimeError) as error:
+                raise BasePayloadSerializerException(error)
+        return payload
+
+
+class ZstdPayloadSerializer(BasePayloadSerializer):
+    codec_id = 5
+
+    def __init__(self, level=3, dictionary=None, dictionaries=None):
+        if zstandard is None:
+            raise BasePayloadSerializerException('zstandard is not installed')
+        compressor_kwargs = {'level': level}
+        dictionaries = list(dictionaries or ())
+        if dictionary is not None:
+            compressor_kwargs['dict_data'] = dictionary
+            dictionaries.append(dictionary)
+        self._compressor = zstandard.ZstdCompressor(**compressor_kwargs)
+        self._dictionaries = dict(
+            (dictionary.dict_id(), dictionary) for dictionary in dictionaries)
+        self._decompressors = {}
+
+    def _get_decompressor(self, packed_payload):
+        dictionary_id = zstandard.get_frame_parameters(packed_payload).dict_id
+        decompressor = self._decompressors.get(dictionary_id)
+        if decompressor is None:
+            decompressor_kwargs = {}
+            if dictionary_id:
+                if dictionary_id not in self._dictionaries:
+                    raise BasePayloadSerializerException('Unknown dictionary')
+                decompressor_kwargs['dict_data'] = (
+                    self._dictionaries[dictionary_id])
+            decompressor = zstandard.ZstdDecompressor(**decompressor_kwargs)
+            self._decompressors[dictionary_id] = decompressor
+        return decompressor
+
+    def pack(self, payload):
+        with self.metrics_sink.timer('zstd.compress'):
+            try:
+                packed_payload = self._compressor.compress(payload)
+            except (TypeError, zstandard.ZstdError) as error:
+                raise BasePayloadSerializerException(error)
+        self._observe_compression_ratio('zstd', payload, packed_payload)
         return packed_payload
 
     def unpack(self, packed_payload):
+        with self.metrics_sink.timer('zstd.decompress'):
+            try:
+                payload = self._get_decompressor(packed_payload).decompress(
+                    packed_payload)
+            except (TypeError, zstandard.ZstdError) as error:
+                raise BasePayloadSerializerException(error)
+        return payload
+
+
+class ParallelZlibPayloadSerializer(BasePayloadSerializer):
+    # the payload is split into blocks which are compressed as separate
+    # zlib streams on a thread pool (zlib releases the GIL); the layout is
+    # MAGIC, the blocks count, the packed size of every block and the
+    # blocks. Plain zlib payloads are still unpacked
+    codec_id = 6
+    MAGIC = '\x00cdz'
+
+    def __init__(self, level=1, block_size=1024 * 1024, concurrency=None):
+        self._level = level
+        self._block_size = block_size
+        if concurrency is None:
+            concurrency = multiprocessing.cpu_count()
+        self._concurrency = concurrency
+        self._thread_pool = None
+        self._thread_pool_lock = threading.Lock()
+
+    def _map_blocks(self, function, blocks):
+        if self._concurrency <= 1 or len(blocks) <= 1:
+            return map(function, blocks)
+        with self._thread_pool_lock:
+            if self._thread_pool is None:
+                self._thread_pool = multiprocessing.pool.ThreadPool(
+                    self._concurrency)
+        return self._thread_pool.map(function, blocks)
+
+    def _compress_block(self, block):
+        return zlib.compress(block, self._level)
+
+    def pack(self, payload):
+        with self.metrics_sink.timer('zlib.compress'):
+            try:
+                blocks = [
+                    buffer(payload, offset, self._block_size)
+                    for offset in xrange(0, len(payload), self._block_size)]
+                packed_blocks = self._map_blocks(self._compress_block, blocks)
+            except (TypeError, zlib.error) as error:
+                raise BasePayloadSerializerException(error)
+            packed_payload = ''.join([
+                self.MAGIC,
+                struct.pack(
+                    '>I%dI' % len(packed_blocks), len(packed_blocks),
+                    *[len(packed_block) for packed_block in packed_blocks]),
+            ] + packed_blocks)
+        self._observe_compression_ratio('zlib', payload, packed_payload)
+        return packed_payload
+
+    def _get_packed_blocks(self, packed_payload):
+        offset = len(self.MAGIC)
         try:
-            payload = zlib.decompress(packed_payload)
-        except (TypeError, zlib.error) as error:
+            blocks_count, = struct.unpack_from('>I', packed_payload, offset)
+            offset += 4
+            block_sizes = struct.unpack_from(
+                '>%dI' % blocks_count, packed_payload, offset)
+        except struct.error as error:
             raise BasePayloadSerializerException(error)
-        return payload
+        offset += 4 * blocks_count
+
+        if offset + sum(block_sizes) != len(packed_payload):
+            raise BasePayloadSerializerException('Invalid block sizes')
+        packed_blocks = []
+        for block_size in block_sizes:
+            packed_blocks.append(buffer(packed_payload, offset, block_size))
+            offset += block_size
+        return packed_blocks
+
+    def unpack(self, packed_payload):
+        with self.metrics_sink.timer('zlib.decompress'):
+            try:
+                if packed_payload[:len(self.MAGIC)] != self.MAGIC:
+                    return zlib.decompress(packed_payload)
+                return ''.join(self._map_blocks(
+                    zlib.decompress, self._get_packed_blocks(packed_payload)))
+            except (TypeError, zlib.error) as error:
+                raise BasePayloadSerializerException(error)
+
+
+def train_zstd_dictionary(payloads, dictionary_size=112 * 1024):
+    if zstandard is None:
+        raise BasePayloadSerializerException('zstandard is not installed')
+
+    # every top level entry of a snapshot payload is a separate sample
+    serializer = MsgPackPayloadSerializer()
+    samples = []
+    for payload in payloads:
+        items = payload.iteritems() if isinstance(payload, dict) else (
+            (None, payload),)
+        for key, value in items:
+            samples.append(serializer.pack((key, value)))
+
+    try:
+        return zstandard.train_dictionary(dictionary_size, samples)
+    except zstandard.ZstdError as error:
+        raise BasePayloadSerializerException(error)
 
 
 class ChainPayloadSerializer(BasePayloadSerializer):
     def __init__(self, serializers=None):
         self._serializers = list(serializers) if serializers else []
 
+    def set_metrics_sink(self, metrics_sink):
+        super(ChainPayloadSerializer, self).set_metrics_sink(metrics_sink)
+        for serializer in self._serializers:
+            serializer.set_metrics_sink(metrics_sink)
+
     def pack(self, payload):
         packed_payload = payload
         for serializer in self._serializers:
@@ -191,6 +615,410 @@ class MsgPackZlibPayloadSerializer(ChainPayloadSerializer):
             serializers)
 
 
+def _diff_payloads(old_payload, new_payload, path, added, removed):
+    # nested dicts are diffed key by key, anything else is replaced as a
+    # whole; every key of both payloads is visited once
+    if old_payload is new_payload:
+        return
+
+    if not (isinstance(old_payload, dict) and isinstance(new_payload, dict)):
+        if old_payload != new_payload:
+            added.append((path, new_payload))
+        return
+
+    for key in old_payload:
+        if key not in new_payload:
+            removed.append(path + (key,))
+
+    for key, new_value in new_payload.iteritems():
+        if key not in old_payload:
+            added.append((path + (key,), new_value))
+            continue
+        _diff_payloads(
+            old_payload[key], new_value, path + (key,), added, removed)
+
+
+def _get_payload_by_path(payload, path):
+    for key in path:
+        payload = payload[key]
+    return payload
+
+
+def _iter_payload_objects(payload):
+    # shared objects (e.g. interned strings) are only yielded once
+    seen = set()
+    stack = [payload]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        yield item
+        if isinstance(item, dict):
+            stack.extend(item.iterkeys())
+            stack.extend(item.itervalues())
+        elif isinstance(item, LazyPayload):
+            stack.extend(item._entries.itervalues())
+        elif isinstance(item, CompactMapping):
+            stack.append(item._keys)
+            stack.append(item._values)
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+
+
+def _get_object_size(item):
+    if isinstance(item, LazyPayload):
+        return sys.getsizeof(item) + len(item._packed_payload)
+    return sys.getsizeof(item)
+
+
+def _get_payload_size(payload):
+    return sum(
+        _get_object_size(item) for item in _iter_payload_objects(payload))
+
+
+def _estimate_payload_size(payload, sample_count=256):
+    # large mappings and sequences are extrapolated from evenly spread
+    # entries instead of being measured object by object
+    if isinstance(payload, (dict, CompactMapping)):
+        items = payload.iteritems()
+    elif isinstance(payload, (list, tuple)):
+        items = ((item,) for item in payload)
+    else:
+        return _get_payload_size(payload)
+    items_count = len(payload)
+    if items_count <= sample_count:
+        return _get_payload_size(payload)
+
+    sample = list(itertools.islice(
+        items, 0, None, items_count // sample_count))
+    # objects found under several sampled entries are shared by the
+    # entries (e.g. interned keys), they are counted once and are not
+    # extrapolated
+    counts = collections.Counter()
+    sizes = {}
+    for item in sample:
+        for part in item:
+            for obj in _iter_payload_objects(part):
+                counts[id(obj)] += 1
+                sizes[id(obj)] = _get_object_size(obj)
+    entries_size = shared_size = 0
+    for obj_id, obj_size in sizes.iteritems():
+        if counts[obj_id] > 1:
+            shared_size += obj_size
+        else:
+            entries_size += obj_size
+
+    size = sys.getsizeof(payload) + shared_size
+    if isinstance(payload, CompactMapping):
+        size += sys.getsizeof(payload._keys) + sys.getsizeof(
+            payload._values)
+    return size + entries_size * items_count // len(sample)
+
+
+class FramedPayloadSerializer(BasePayloadSerializer):
+    # frame: magic, codecs count, codec ids in the packing order, payload
+    MAGIC = '\x00cdf'
+
+    def __init__(
+            self, serializers=None, decoders=None, legacy_serializer=None):
+        if serializers is None:
+            serializers = (MsgPackPayloadSerializer(), ZlibPayloadSerializer())
+        self._serializers = list(serializers)
+        for serializer in self._serializers:
+            if serializer.codec_id is None:
+                raise BasePayloadSerializerException(
+                    'Serializer has no codec id')
+        self._header = self.MAGIC + struct.pack(
+            '%dB' % (len(self._serializers) + 1), len(self._serializers),
+            *[serializer.codec_id for serializer in self._serializers])
+
+        self._decoders = {
+            DummyPayloadSerializer.codec_id: DummyPayloadSerializer(),
+            JsonPayloadSerializer.codec_id: JsonPayloadSerializer(),
+            MsgPackPayloadSerializer.codec_id: MsgPackPayloadSerializer(),
+            ZlibPayloadSerializer.codec_id: ZlibPayloadSerializer(),
+            ParallelZlibPayloadSerializer.codec_id: (
+                ParallelZlibPayloadSerializer()),
+        }
+        if lz4 is not None:
+            self._decoders[Lz4PayloadSerializer.codec_id] = (
+                Lz4PayloadSerializer())
+        if zstandard is not None:
+            self._decoders[ZstdPayloadSerializer.codec_id] = (
+                ZstdPayloadSerializer())
+        for decoder in self._serializers + list(decoders or ()):
+            self._decoders[decoder.codec_id] = decoder
+
+        self._legacy_serializer = legacy_serializer
+
+    def set_metrics_sink(self, metrics_sink):
+        super(FramedPayloadSerializer, self).set_metrics_sink(metrics_sink)
+        decoders = self._serializers + self._decoders.values()
+        if self._legacy_serializer is not None:
+            decoders.append(self._legacy_serializer)
+        for decoder in decoders:
+            decoder.set_metrics_sink(metrics_sink)
+
+    def pack(self, payload):
+        packed_payload = payload
+        for serializer in self._serializers:
+            packed_payload = serializer.pack(packed_payload)
+        return self._header + packed_payload
+
+    def _parse_header(self, packed_payload):
+        offset = len(self.MAGIC)
+        try:
+            codecs_count, = struct.unpack_from('B', packed_payload, offset)
+            offset += 1
+            codec_ids = struct.unpack_from(
+                '%dB' % codecs_count, packed_payload, offset)
+        except struct.error as error:
+            raise BasePayloadSerializerException(error)
+        return codec_ids, offset + codecs_count
+
+    def unpack(self, packed_payload):
+        if not (isinstance(packed_payload, BUFFER_TYPES) and
+                packed_payload[:len(self.MAGIC)] == self.MAGIC):
+            if self._legacy_serializer is None:
+                raise BasePayloadSerializerException('Unknown format')
+            return self._legacy_serializer.unpack(packed_payload)
+
+        codec_ids, offset = self._parse_header(packed_payload)
+        payload = packed_payload[offset:]
+        for codec_id in reversed(codec_ids):
+            decoder = self._decoders.get(codec_id)
+            if decoder is None:
+                raise BasePayloadSerializerException(
+                    'Unknown codec %d' % codec_id)
+            payload = decoder.unpack(payload)
+        return payload
+
+
+class MsgPackZlibStreamPayloadSerializer(BaseStreamPayloadSerializer):
+    # max_buffer_size=0 is unlimited, msgpack>=1.0 caps the buffer at
+    # 100MiB by default which unpackb does not
+    def __init__(
+            self, unpack_use_list=False, read_size=1024 * 1024,
+            compact=False, max_buffer_size=0):
+        self._unpack_use_list = unpack_use_list
+        self._read_size = read_size
+        self._compact = compact
+        self._max_buffer_size = max_buffer_size
+        self._serializer = MsgPackZlibPayloadSerializer()
+
+    def set_metrics_sink(self, metrics_sink):
+        super(MsgPackZlibStreamPayloadSerializer, self).set_metrics_sink(
+            metrics_sink)
+        self._serializer.set_metrics_sink(metrics_sink)
+
+    def pack(self, payload):
+        return self._serializer.pack(payload)
+
+    def unpack_stream(self, packed_chunks):
+        # only the decompression itself is timed since reading the chunks
+        # may wait for the network
+        decompressor = zlib.decompressobj()
+        unpacker = msgpack.Unpacker(
+            use_list=self._unpack_use_list,
+            max_buffer_size=self._max_buffer_size,
+            **_get_unpack_kwargs(self._compact))
+        decompress_seconds = 0.0
+        try:
+            for packed_chunk in packed_chunks:
+                while packed_chunk:
+                    start_time = time.time()
+                    chunk = decompressor.decompress(
+                        packed_chunk, self._read_size)
+                    decompress_seconds += time.time() - start_time
+                    unpacker.feed(chunk)
+                    packed_chunk = decompressor.unconsumed_tail
+            unpacker.feed(decompressor.flush())
+            self.metrics_sink.observe('zlib.decompress', decompress_seconds)
+            with self.metrics_sink.timer('msgpack.decode'):
+                payload = unpacker.unpack()
+        except (TypeError, ValueError, zlib.error,
+                msgpack.UnpackException) as error:
+            raise BasePayloadSerializerException(error)
+
+        try:
+            unpacker.skip()
+        except msgpack.OutOfData:
+            return payload
+        raise BasePayloadSerializerException('Extra data')
+
+
+class LazyPayload(MutableMapping):
+    # keys are looked up by a binary search over the packed index and
+    # entries are decoded on first access and memoized, so nothing is
+    # decoded up front; an entry that was accessed or assigned is no
+    # longer backed by its packed bytes since it may have been changed
+    def __init__(self, packed_payload, count, offset, entry_serializer):
+        self._packed_payload = packed_payload
+        self._count = count
+        self._key_offsets_offset = offset
+        self._entry_offsets_offset = offset + (count + 1) * 4
+        self._keys_offset = self._entry_offsets_offset + (count + 1) * 4
+        self._entries_offset = self._keys_offset + self._get_offset(
+            self._key_offsets_offset, count)
+        self._entry_serializer = entry_serializer
+        self._entries = {}
+        self._removed = set()
+
+    def _get_offset(self, table_offset, position):
+        return struct.unpack_from(
+            '>I', self._packed_payload, table_offset + position * 4)[0]
+
+    def _get_slice(self, table_offset, data_offset, position):
+        start = self._get_offset(table_offset, position)
+        end = self._get_offset(table_offset, position + 1)
+        return self._packed_payload[data_offset + start:data_offset + end]
+
+    def _get_packed_key(self, position):
+        return self._get_slice(
+            self._key_offsets_offset, self._keys_offset, position)
+
+    def _find(self, key):
+        try:
+            packed_key = msgpack.packb(key)
+        except (TypeError, msgpack.PackException):
+            return -1
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_packed_key(middle) < packed_key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._get_packed_key(low) == packed_key:
+            return low
+        return -1
+
+    def get_packed_entry(self, key):
+        if key in self._entries or key in self._removed:
+            return None
+        position = self._find(key)
+        if position < 0:
+            return None
+        return self._get_slice(
+            self._entry_offsets_offset, self._entries_offset, position)
+
+    def __getitem__(self, key):
+        try:
+            return self._entries[key]
+        except KeyError:
+            pass
+        packed_entry = self.get_packed_entry(key)
+        if packed_entry is None:
+            raise KeyError(key)
+        try:
+            value = self._entry_serializer.unpack(packed_entry)
+        except BasePayloadSerializerException as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+        self._entries[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._entries[key] = value
+        self._removed.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._entries.pop(key, None)
+        if self._find(key) >= 0:
+            self._removed.add(key)
+
+    def __contains__(self, key):
+        if key in self._entries:
+            return True
+        return key not in self._removed and self._find(key) >= 0
+
+    def _iter_packed_keys(self):
+        for position in xrange(self._count):
+            yield msgpack.unpackb(
+                self._get_packed_key(position), **MSGPACK_UNPACK_KWARGS)
+
+    def __iter__(self):
+        for key in self._iter_packed_keys():
+            if key not in self._removed:
+                yield key
+        for key in self._entries.keys():
+            if self._find(key) < 0:
+                yield key
+
+    def __len__(self):
+        added_count = sum(
+            1 for key in self._entries if self._find(key) < 0)
+        return self._count - len(self._removed) + added_count
+
+
+class IndexedPayloadSerializer(BasePayloadSerializer):
+    # the layout is MAGIC, the entries count, the key offsets, the entry
+    # offsets, the msgpack packed keys in sorted order and then the
+    # separately packed entries; unpack does not read past the header
+    MAGIC = '\x00cdi'
+
+    def __init__(self, entry_serializer=None):
+        if entry_serializer is None:
+            entry_serializer = MsgPackZlibPayloadSerializer()
+        self._entry_serializer = entry_serializer
+
+    def set_metrics_sink(self, metrics_sink):
+        super(IndexedPayloadSerializer, self).set_metrics_sink(metrics_sink)
+        self._entry_serializer.set_metrics_sink(metrics_sink)
+
+    def _pack_offsets(self, items):
+        offsets = [0]
+        for item in items:
+            offsets.append(offsets[-1] + len(item))
+        return struct.pack('>%dI' % len(offsets), *offsets)
+
+    def pack(self, payload):
+        if not isinstance(payload, Mapping):
+            raise BasePayloadSerializerException('Payload is not a mapping')
+
+        try:
+            packed_keys = sorted(
+                (msgpack.packb(key), key) for key in payload)
+        except (TypeError, msgpack.PackException) as error:
+            raise BasePayloadSerializerException(error)
+        packed_entries = [
+            self._entry_serializer.pack(payload[key])
+            for _, key in packed_keys]
+        packed_keys = [packed_key for packed_key, _ in packed_keys]
+
+        return ''.join([
+            self.MAGIC, struct.pack('>I', len(packed_keys)),
+            self._pack_offsets(packed_keys),
+            self._pack_offsets(packed_entries),
+        ] + packed_keys + packed_entries)
+
+    def unpack(self, packed_payload):
+        offset = len(self.MAGIC)
+        if packed_payload[:offset] != self.MAGIC:
+            raise BasePayloadSerializerException('Unknown format')
+
+        try:
+            count, = struct.unpack_from('>I', packed_payload, offset)
+            payload = LazyPayload(
+                packed_payload, count, offset + 4, self._entry_serializer)
+        except struct.error as error:
+            raise BasePayloadSerializerException(error)
+        return payload
+
+
+_MISSING = object()
+
+
+def _iter_popped(items):
+    # yields items while dropping the references to them, so that
+    # consumed chunks can be freed before the whole stream is processed
+    items.reverse()
+    while items:
+        yield items.pop()
+
+
 class Snapshot(BaseSnapshot):
     def __init__(self, version, payload):
         self._version = version
@@ -209,7 +1037,50 @@ class Snapshot(BaseSnapshot):
         return self._payload
 
     def make_patch(self, new_snapshot):
-        pass
+        added = []
+        removed = []
+        _diff_payloads(self.payload, new_snapshot.payload, (), added, removed)
+        payload = {
+            'new_snapshot_version': new_snapshot.version,
+            'added': added,
+            'removed': removed,
+        }
+        return SnapshotPatch(self.version, payload)
+
+    def apply_patch(self, patch):
+        # every change is recorded and undone if the patch does not apply,
+        # so that the snapshot is never left half patched; added values
+        # are copied so that the patch is not changed by later patches
+        payload = self._payload
+        undo = []
+        try:
+            for path in patch.removed:
+                parent = _get_payload_by_path(payload, path[:-1])
+                value = parent.pop(path[-1], _MISSING)
+                if value is not _MISSING:
+                    undo.append((parent, path[-1], value))
+            for path, value in patch.added:
+                if isinstance(value, (dict, list)):
+                    value = copy.deepcopy(value)
+                if not path:
+                    payload = value
+                    continue
+                parent = _get_payload_by_path(payload, path[:-1])
+                try:
+                    previous_value = parent[path[-1]]
+                except (KeyError, IndexError):
+                    previous_value = _MISSING
+                undo.append((parent, path[-1], previous_value))
+                parent[path[-1]] = value
+        except Exception:
+            for parent, key, value in reversed(undo):
+                if value is _MISSING:
+                    parent.pop(key, None)
+                else:
+                    parent[key] = value
+            raise
+        self._payload = payload
+        self._version = patch.new_snapshot_version
 
 
 class SnapshotPatch(BaseSnapshotPatch):
@@ -231,13 +1102,320 @@ class SnapshotPatch(BaseSnapshotPatch):
 
     @property
     def added(self):
-        return self._payload['added'].iteritems()
+        return iter(self._payload['added'])
 
     @property
     def removed(self):
         return self._payload['removed']
 
 
+class CompactMapping(object):
+    # a frozen mapping backed by a sorted tuple of keys and a parallel
+    # tuple of values; it is not derived from Mapping because
+    # the ABC brings a per-instance __dict__ back in python 2
+    __slots__ = ('_keys', '_values')
+
+    def __init__(self, keys, values):
+        self._keys = keys
+        self._values = values
+
+    def _find(self, key):
+        keys = self._keys
+        index = bisect.bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            return index
+        return -1
+
+    def __getitem__(self, key):
+        index = self._find(key)
+        if index < 0:
+            raise KeyError(key)
+        return self._values[index]
+
+    def get(self, key, default=None):
+        index = self._find(key)
+        if index < 0:
+            return default
+        return self._values[index]
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        return iter(self._values)
+
+    def iteritems(self):
+        return iter(zip(self._keys, self._values))
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._keys, self._values)
+
+    def __eq__(self, other):
+        if not isinstance(other, (dict, CompactMapping)):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        for key, value in self.iteritems():
+            if key not in other or other[key] != value:
+                return False
+        return True
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'CompactMapping(%r)' % dict(self.iteritems())
+
+
+Mapping.register(CompactMapping)
+
+
+def _compact_payload(payload, strings):
+    if isinstance(payload, dict):
+        keys = sorted(payload)
+        return CompactMapping(
+            tuple(_compact_payload(key, strings) for key in keys),
+            tuple(_compact_payload(payload[key], strings) for key in keys))
+    if isinstance(payload, (list, tuple)):
+        # sequences stay tuples, so that they compare equal to and can be
+        # serialized like the tuples which the serializers unpack
+        return tuple(_compact_payload(item, strings) for item in payload)
+    if isinstance(payload, basestring):
+        return strings.setdefault(payload, payload)
+    return payload
+
+
+def compact_payload(payload):
+    return _compact_payload(payload, {})
+
+
+def _get_compact_unpack_hooks():
+    # msgpack calls the hooks bottom up, so maps and arrays are built in
+    # their compact form right away and the dict tree never exists
+    strings = {}
+
+    def intern(item):
+        if isinstance(item, basestring):
+            return strings.setdefault(item, item)
+        return item
+
+    def object_pairs_hook(pairs):
+        pairs.sort(key=lambda pair: pair[0])
+        keys = tuple(intern(key) for key, _ in pairs)
+        values = tuple(intern(value) for _, value in pairs)
+        del pairs[:]
+        return CompactMapping(keys, values)
+
+    def list_hook(items):
+        return tuple(intern(item) for item in items)
+
+    return {'object_pairs_hook': object_pairs_hook, 'list_hook': list_hook}
+
+
+def _get_unpack_kwargs(compact):
+    if not compact:
+        return MSGPACK_UNPACK_KWARGS
+    kwargs = dict(MSGPACK_UNPACK_KWARGS)
+    kwargs.update(_get_compact_unpack_hooks())
+    return kwargs
+
+
+class CompactSnapshot(Snapshot):
+    # a read-only snapshot; apply_patch raises TypeError, which makes
+    # sync_snapshot fall back to fetching the full snapshot. Payloads are
+    # best unpacked by a msgpack serializer with compact=True, otherwise
+    # the whole dict tree is decoded first and then copied
+    def __init__(self, version, payload):
+        super(CompactSnapshot, self).__init__(
+            version, compact_payload(payload))
+
+    def apply_patch(self, patch):
+        raise TypeError('CompactSnapshot is read-only')
+
+
+class LazySnapshot(Snapshot):
+    # meant for payloads unpacked by IndexedPayloadSerializer; entries
+    # whose packed bytes are the same in both snapshots are not decoded
+    # when a patch is made
+    def make_patch(self, new_snapshot):
+        old_payload = self.payload
+        new_payload = new_snapshot.payload
+        if not (isinstance(old_payload, Mapping) and
+                isinstance(new_payload, Mapping)):
+            return super(LazySnapshot, self).make_patch(new_snapshot)
+
+        added = []
+        removed = []
+        for key in old_payload:
+            if key not in new_payload:
+                removed.append((key,))
+
+        for key in new_payload:
+            if key not in old_payload:
+                added.append(((key,), new_payload[key]))
+                continue
+            if isinstance(old_payload, LazyPayload) and isinstance(
+                    new_payload, LazyPayload):
+                old_packed_entry = old_payload.get_packed_entry(key)
+                if (old_packed_entry is not None and
+                        old_packed_entry == new_payload.get_packed_entry(
+                            key)):
+                    continue
+            _diff_payloads(
+                old_payload[key], new_payload[key], (key,), added, removed)
+
+        payload = {
+            'new_snapshot_version': new_snapshot.version,
+            'added': added,
+            'removed': removed,
+        }
+        return SnapshotPatch(self.version, payload)
+
+
+def _replace_by_path(payload, path, value=None, remove=False):
+    # returns a copy of the nested dicts along the path, the payload
+    # itself is left intact
+    if not isinstance(payload, dict):
+        raise TypeError('Not a dict at %r' % (path,))
+    payload = dict(payload)
+    key = path[0]
+    if len(path) > 1:
+        payload[key] = _replace_by_path(payload[key], path[1:], value, remove)
+    elif remove:
+        payload.pop(key, None)
+    else:
+        payload[key] = value
+    return payload
+
+
+def squash_patches(patches):
+    # merges consecutive patches into a single one which gives the same
+    # result when applied to the base snapshot of the first patch
+    patches = list(patches)
+    if not patches:
+        raise ValueError('No patches to squash')
+
+    added = collections.OrderedDict()
+    added_prefixes = collections.Counter()
+    removed = collections.OrderedDict()
+
+    def find_added_ancestor(path):
+        for length in xrange(len(path)):
+            if path[:length] in added:
+                return path[:length]
+        return None
+
+    def drop_added(path):
+        # drops the path itself along with everything added under it
+        if path in added_prefixes:
+            dropped_paths = [
+                added_path for added_path in added
+                if added_path[:len(path)] == path]
+        else:
+            dropped_paths = [path] if path in added else []
+        for dropped_path in dropped_paths:
+            del added[dropped_path]
+            for length in xrange(len(dropped_path)):
+                added_prefixes[dropped_path[:length]] -= 1
+                if not added_prefixes[dropped_path[:length]]:
+                    del added_prefixes[dropped_path[:length]]
+
+    for patch in patches:
+        for path in patch.removed:
+            path = tuple(path)
+            ancestor = find_added_ancestor(path)
+            if ancestor is not None:
+                added[ancestor] = _replace_by_path(
+                    added[ancestor], path[len(ancestor):], remove=True)
+                continue
+            drop_added(path)
+            removed[path] = None
+
+        for path, value in patch.added:
+            path = tuple(path)
+            ancestor = find_added_ancestor(path)
+            if ancestor is not None:
+                added[ancestor] = _replace_by_path(
+                    added[ancestor], path[len(ancestor):], value)
+                continue
+            drop_added(path)
+            if not path:
+                removed.clear()
+            added[path] = value
+            for length in xrange(len(path)):
+                added_prefixes[path[:length]] += 1
+
+    payload = {
+        'new_snapshot_version': patches[-1].new_snapshot_version,
+        'added': added.items(),
+        'removed': removed.keys(),
+    }
+    return SnapshotPatch(patches[0].base_snapshot_version, payload)
+
+
+class BaseRetentionPolicy(object):
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def get_kept_versions(self, versions):  # pragma: no cover
+        pass
+
+
+class KeepLastRetentionPolicy(BaseRetentionPolicy):
+    def __init__(self, count):
+        self._count = count
+
+    def get_kept_versions(self, versions):
+        if self._count <= 0:
+            return set()
+        return set(versions[-self._count:])
+
+
+class KeepNewerThanRetentionPolicy(BaseRetentionPolicy):
+    def __init__(self, min_version):
+        self._min_version = min_version
+
+    def get_kept_versions(self, versions):
+        return set(
+            version for version in versions if version >= self._min_version)
+
+
+class KeepEveryNthRetentionPolicy(BaseRetentionPolicy):
+    def __init__(self, step):
+        self._step = step
+
+    def get_kept_versions(self, versions):
+        return set(versions[::-self._step])
+
+
+GarbageCollectionResult = collections.namedtuple(
+    'GarbageCollectionResult', ('removed_versions', 'reclaimed_bytes'))
+
+ConditionalSnapshotResult = collections.namedtuple(
+    'ConditionalSnapshotResult', ('modified', 'snapshot', 'digest'))
+
+
 class DummyCoreDataSnapshotStorage(BaseCoreDataSnapshotStorage):
     def __init__(self):
         self._latest_version = None
@@ -269,15 +1447,39 @@ class DummyCoreDataSnapshotStorage(BaseCoreDataSnapshotStorage):
         raise BaseCoreDataSnapshotStorageException()
 
 
+class _RedisCommandQueue(object):
+    # records pipeline-like calls so that they can be replayed by a script
+    def __init__(self):
+        self.commands = []
+
+    def set(self, key, value):
+        self.commands.append(('set', key, (value,)))
+
+    def delete(self, key):
+        self.commands.append(('del', key, ()))
+
+    def hset(self, key, field, value):
+        self.commands.append(('hset', key, (field, value)))
+
+    def sadd(self, key, *values):
+        self.commands.append(('sadd', key, values))
+
+    def zadd(self, key, mapping):
+        self.commands.append(('zadd', key, tuple(
+            arg for member, score in sorted(mapping.iteritems())
+            for arg in (score, member))))
+
+
 class RedisCoreDataSnapshotStorage(BaseCoreDataSnapshotStorage):
     def __init__(
             self, redis_conn, snapshots_lock_ttl=5,
             ignore_snapshots_lock_once=True,
             ignore_snapshots_lock_always=False,
             snapshot_factory=Snapshot, snapshot_patch_factory=SnapshotPatch,
-            payload_serializer=None):
+            payload_serializer=None, chunk_size=None, metrics_sink=None):
         self._redis_conn = redis_conn
         self.__redis_lock_script = None
+        self.__redis_lock_get_script = None
 
         self._snapshot_factory = snapshot_factory
         self._snapshot_patch_factory = snapshot_patch_factory
@@ -287,10 +1489,18 @@ class RedisCoreDataSnapshotStorage(BaseCoreDataSnapshotStorage):
         if self._payload_serializer is None:
             self._payload_serializer = ZlibPayloadSerializer()
 
+        self._metrics_sink = NULL_METRICS_SINK
+        if metrics_sink is not None:
+            self._metrics_sink = metrics_sink
+            self._payload_serializer.set_metrics_sink(metrics_sink)
+
         self._snapshots_lock_ttl = snapshots_lock_ttl
         self._ignore_snapshots_lock_once = ignore_snapshots_lock_once
         self._ignore_snapshots_lock_always = ignore_snapshots_lock_always
 
+        self._chunk_size = chunk_size
+        self._chunks_manifest_prefix = 'chunks:'
+
         self._latest_version_key = 'last_export_date'
         self._snapshot_key = 'core_data'
 
@@ -302,6 +1512,14 @@ class RedisCoreDataSnapshotStorage(BaseCoreDataSnapshotStorage):
     def redis_conn(self, redis_conn):
         self._redis_conn = redis_conn
 
+    @property
+    def payload_serializer(self):
+        return self._payload_serializer
+
+    @property
+    def metrics_sink(self):
+        return self._metrics_sink
+
     @property
     def _redis_lock_script(self):
         if self.__redis_lock_script is not None:
@@ -321,7 +1539,27 @@ class RedisCoreDataSnapshotStorage(BaseCoreDataSnapshotStorage):
 
         return self.__redis_lock_script
 
-    def _lock_snapshots(self):
+    @property
+    def _redis_lock_get_script(self):
+        if self.__redis_lock_get_script is not None:
+            return self.__redis_lock_get_script
+
+        try:
+            self.__redis_lock_get_script = self._redis_conn.register_script(
+                """
+                --lockgetscript, parameters: lock_key, key, lock_timeout
+                local ttl = redis.call('ttl', KEYS[1])
+                if ttl > 0 then
+                    return {0}
+                end
+                redis.call('setex', KEYS[1], ARGV[1], 'locked')
+                return {1, redis.call('get', KEYS[2])}""")
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        return self.__redis_lock_get_script
+
+    def _ignore_snapshots_lock(self):
         if self._ignore_snapshots_lock_always:
             return True
 
@@ -329,13 +1567,24 @@ class RedisCoreDataSnapshotStorage(BaseCoreDataSnapshotStorage):
             self._ignore_snapshots_lock_once = False
             return True
 
-        try:
-            return self._redis_lock_script(
-                keys=('snapshots_lock',),
-                args=(self._snapshots_lock_ttl,),
-                client=self._redis_conn)
-        except redis.RedisError as error:
-            raise BaseCoreDataSnapshotStorageException(error)
+        return False
+
+    def _lock_snapshots(self):
+        if self._ignore_snapshots_lock():
+            return True
+
+        try:
+            with self._metrics_sink.timer('redis.lock'):
+                locked = self._redis_lock_script(
+                    keys=('snapshots_lock',),
+                    args=(self._snapshots_lock_ttl,),
+                    client=self._redis_conn)
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        if not locked:
+            self._metrics_sink.increment('redis.lock_rejections')
+        return locked
 
     def _clean_version(self, version):
         try:
@@ -343,10 +1592,15 @@ class RedisCoreDataSnapshotStorage(BaseCoreDataSnapshotStorage):
         except:
             raise BaseCoreDataSnapshotStorageException('Invalid version')
 
+    def _get_latest_version_channel(self):
+        return '%s:updates' % self._latest_version_key
+
     def set_latest_version(self, version):
         try:
             version = self._clean_version(version)
             self._redis_conn.set(self._latest_version_key, version)
+            self._redis_conn.publish(
+                self._get_latest_version_channel(), version)
         except redis.RedisError as error:
             raise BaseCoreDataSnapshotStorageException(error)
 
@@ -358,47 +1612,174 @@ class RedisCoreDataSnapshotStorage(BaseCoreDataSnapshotStorage):
 
         return self._clean_version(version)
 
+    def subscribe_latest_version(self):
+        try:
+            pubsub = self._redis_conn.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(self._get_latest_version_channel())
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+        return pubsub
+
     def _get_snapshot_key_by_version(self, version):
         return self._snapshot_key
 
     def _get_patch_key_by_snapshot_version(self, version):
         raise BaseCoreDataSnapshotStorageException()
 
-    def _set_payload_by_key(self, key, payload):
+    def _pack_payload(self, payload):
+        try:
+            with self._metrics_sink.timer('redis.pack'):
+                return self._payload_serializer.pack(payload)
+        except BasePayloadSerializerException as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+    def _unpack_payload(self, packed_payload):
+        try:
+            return self._payload_serializer.unpack(packed_payload)
+        except BasePayloadSerializerException as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+    def _unpack_payload_chunks(self, packed_chunks):
+        if not isinstance(
+                self._payload_serializer, BaseStreamPayloadSerializer):
+            return self._unpack_payload(''.join(packed_chunks))
+
         try:
-            packed_payload = self._payload_serializer.pack(payload)
+            return self._payload_serializer.unpack_stream(
+                _iter_popped(packed_chunks))
         except BasePayloadSerializerException as error:
             raise BaseCoreDataSnapshotStorageException(error)
 
+    def _get_chunks_key(self, key):
+        return '%s:chunks' % key
+
+    def _queue_set_packed_payload(
+            self, pipeline, key, packed_payload, ttl=None):
+        set_kwargs = {} if ttl is None else {'ex': ttl}
+        if self._chunk_size is None:
+            pipeline.set(key, packed_payload, **set_kwargs)
+            return
+
+        chunks_key = self._get_chunks_key(key)
+        pipeline.delete(chunks_key)
+        chunks_count = 0
+        for offset in xrange(0, len(packed_payload), self._chunk_size):
+            pipeline.hset(
+                chunks_key, chunks_count,
+                packed_payload[offset:offset + self._chunk_size])
+            chunks_count += 1
+        if ttl is not None:
+            pipeline.expire(chunks_key, ttl)
+        pipeline.set(key, '%s%d:%d' % (
+            self._chunks_manifest_prefix, chunks_count, len(packed_payload)),
+            **set_kwargs)
+
+    def _set_payload_by_key(self, key, payload, ttl=None):
+        packed_payload = self._pack_payload(payload)
+
         try:
-            self._redis_conn.set(key, packed_payload)
+            with self._metrics_sink.timer('redis.write'):
+                if self._chunk_size is None:
+                    set_kwargs = {} if ttl is None else {'ex': ttl}
+                    self._redis_conn.set(key, packed_payload, **set_kwargs)
+                else:
+                    pipeline = self._redis_conn.pipeline()
+                    self._queue_set_packed_payload(
+                        pipeline, key, packed_payload, ttl=ttl)
+                    pipeline.execute()
         except redis.RedisError as error:
             raise BaseCoreDataSnapshotStorageException(error)
+        self._metrics_sink.observe('redis.bytes_out', len(packed_payload))
 
-    def _get_payload_by_key(self, key):
-        if not self._lock_snapshots():
-            raise BaseCoreDataSnapshotStorageException('locked')
+    def _is_chunks_manifest(self, packed_payload):
+        return (
+            isinstance(packed_payload, str) and
+            packed_payload.startswith(self._chunks_manifest_prefix))
 
+    def _parse_chunks_manifest(self, manifest):
+        try:
+            chunks_count, size = [
+                int(value) for value in manifest[
+                    len(self._chunks_manifest_prefix):].split(':')]
+        except ValueError:
+            raise BaseCoreDataSnapshotStorageException('Invalid manifest')
+        return chunks_count, size
+
+    def _get_chunks_by_manifest(self, key, manifest):
+        chunks_count, size = self._parse_chunks_manifest(manifest)
+        chunks_key = self._get_chunks_key(key)
         try:
-            packed_payload = self._redis_conn.get(key)
+            with self._metrics_sink.timer('redis.read'):
+                pipeline = self._redis_conn.pipeline(transaction=False)
+                for index in xrange(chunks_count):
+                    pipeline.hget(chunks_key, index)
+                chunks = pipeline.execute()
         except redis.RedisError as error:
             raise BaseCoreDataSnapshotStorageException(error)
 
+        if None in chunks or sum(len(chunk) for chunk in chunks) != size:
+            raise BaseCoreDataSnapshotStorageException('Broken chunks')
+        return chunks
+
+    def _get_packed_payload_by_key_locked(self, key):
         try:
-            payload = self._payload_serializer.unpack(packed_payload)
-        except BasePayloadSerializerException as error:
+            with self._metrics_sink.timer('redis.read'):
+                result = self._redis_lock_get_script(
+                    keys=('snapshots_lock', key),
+                    args=(self._snapshots_lock_ttl,),
+                    client=self._redis_conn)
+        except redis.RedisError as error:
             raise BaseCoreDataSnapshotStorageException(error)
-        return payload
 
-    def set_snapshot_by_version(self, version, snapshot):
+        if not result or not result[0]:
+            self._metrics_sink.increment('redis.lock_rejections')
+            raise SnapshotsLockedException('locked')
+        # a missing key truncates the reply to the status only
+        return result[1] if len(result) > 1 else None
+
+    def _get_packed_chunks_by_key(self, key, lock=True):
+        if lock and not self._ignore_snapshots_lock():
+            packed_payload = self._get_packed_payload_by_key_locked(key)
+        else:
+            try:
+                with self._metrics_sink.timer('redis.read'):
+                    packed_payload = self._redis_conn.get(key)
+            except redis.RedisError as error:
+                raise BaseCoreDataSnapshotStorageException(error)
+
+        if self._is_chunks_manifest(packed_payload):
+            packed_chunks = self._get_chunks_by_manifest(key, packed_payload)
+        else:
+            packed_chunks = [packed_payload]
+        self._metrics_sink.observe('redis.bytes_in', sum(
+            len(packed_chunk) for packed_chunk in packed_chunks
+            if packed_chunk is not None))
+        return packed_chunks
+
+    def _get_payload_by_key(self, key, lock=True):
+        packed_chunks = self._get_packed_chunks_by_key(key, lock=lock)
+        with self._metrics_sink.timer('redis.unpack'):
+            if len(packed_chunks) == 1:
+                return self._unpack_payload(packed_chunks[0])
+            return self._unpack_payload_chunks(packed_chunks)
+
+    def set_snapshot_by_version(self, version, snapshot, ttl=None):
         snapshot_key = self._get_snapshot_key_by_version(version)
-        self._set_payload_by_key(snapshot_key, snapshot.payload)
+        self._set_payload_by_key(snapshot_key, snapshot.payload, ttl=ttl)
 
     def get_snapshot_by_version(self, version):
         snapshot_key = self._get_snapshot_key_by_version(version)
         snapshot_payload = self._get_payload_by_key(snapshot_key)
         return self._snapshot_factory(version, snapshot_payload)
 
+    def get_packed_snapshot_by_version(self, version):
+        snapshot_key = self._get_snapshot_key_by_version(version)
+        packed_chunks = self._get_packed_chunks_by_key(snapshot_key)
+        if None in packed_chunks:
+            raise BaseCoreDataSnapshotStorageException(
+                'Snapshot is not found')
+        return ''.join(packed_chunks)
+
     def set_patch_by_version(self, version, patch):
         patch_key = self._get_patch_key_by_snapshot_version(version)
         self._set_payload_by_key(patch_key, patch.payload)
@@ -413,7 +1794,8 @@ class S3CoreDataSnapshotStorage(BaseCoreDataSnapshotStorage):
     def __init__(
             self, aws_access_key_id=None, aws_secret_access_key=None,
             snapshot_factory=Snapshot, snapshot_patch_factory=SnapshotPatch,
-            payload_serializer=None):
+            payload_serializer=None, part_size=8 * 1024 * 1024,
+            concurrency=4, metrics_sink=None):
         aws_access_key_id = aws_access_key_id
         aws_secret_access_key = aws_secret_access_key
         bucket_name = 'unitcore'
@@ -426,53 +1808,284 @@ class S3CoreDataSnapshotStorage(BaseCoreDataSnapshotStorage):
         if self._payload_serializer is None:
             self._payload_serializer = ZlibPayloadSerializer()
 
+        self._metrics_sink = NULL_METRICS_SINK
+        if metrics_sink is not None:
+            self._metrics_sink = metrics_sink
+            self._payload_serializer.set_metrics_sink(metrics_sink)
+
+        # S3 rejects multipart upload parts (except the last one) smaller
+        # than 5 MB
+        self._part_size = part_size
+        self._concurrency = concurrency
+        self._thread_pool = None
+
+        self._latest_version_key = 'snapshots/latest_version'
+        self._latest_version = None
+        self._latest_version_etag = None
+        # the last fetched snapshot is shared with the callers and is
+        # returned again while its etag stays the same
+        self._last_snapshot = None
+        self._last_snapshot_etag = None
+
         try:
             self._s3_conn = boto.connect_s3(
                 aws_access_key_id, aws_secret_access_key)
             self._s3_bucket = self._s3_conn.get_bucket(bucket_name)
-        except boto.exception.BotoClientError as error:
+        except BOTO_ERRORS as error:
             raise BaseCoreDataSnapshotStorageException(error)
 
-    def set_latest_version(self):  # pragma: no cover
-        pass
+    @property
+    def payload_serializer(self):
+        return self._payload_serializer
 
-    def get_latest_version(self):  # pragma: no cover
-        pass
+    @property
+    def metrics_sink(self):
+        return self._metrics_sink
+
+    def _get_thread_pool(self):
+        if self._thread_pool is None:
+            self._thread_pool = multiprocessing.pool.ThreadPool(
+                self._concurrency)
+        return self._thread_pool
+
+    def _map_parts(self, function, part_offsets):
+        if self._concurrency <= 1 or len(part_offsets) <= 1:
+            return map(function, part_offsets)
+        return self._get_thread_pool().map(function, part_offsets)
+
+    def _clean_version(self, version):
+        try:
+            return int(version)
+        except:
+            raise BaseCoreDataSnapshotStorageException('Invalid version')
+
+    def set_latest_version(self, version):
+        version = self._clean_version(version)
+        try:
+            s3_key = boto.s3.key.Key(self._s3_bucket, self._latest_version_key)
+            s3_key.set_contents_from_string(str(version))
+        except BOTO_ERRORS as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+    def get_latest_version(self):
+        headers = {}
+        if self._latest_version_etag is not None:
+            headers['If-None-Match'] = self._latest_version_etag
+
+        try:
+            s3_key = boto.s3.key.Key(self._s3_bucket, self._latest_version_key)
+            version = s3_key.get_contents_as_string(headers=headers)
+        except boto.exception.S3ResponseError as error:
+            if error.status == 304 and self._latest_version is not None:
+                return self._latest_version
+            raise BaseCoreDataSnapshotStorageException(error)
+        except BOTO_ERRORS as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        version = self._clean_version(version)
+        self._latest_version = version
+        self._latest_version_etag = s3_key.etag
+        return version
 
     def _get_snapshot_key_by_version(self, version):
         return 'snapshots/snapshot_%s' % version
 
+    def _upload_parts(self, key_name, packed_payload):
+        try:
+            multipart_upload = self._s3_bucket.initiate_multipart_upload(
+                key_name)
+        except BOTO_ERRORS as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        def upload_part(offset):
+            part_file = io.BytesIO(
+                packed_payload[offset:offset + self._part_size])
+            multipart_upload.upload_part_from_file(
+                part_file, part_num=offset // self._part_size + 1)
+
+        try:
+            self._map_parts(
+                upload_part, xrange(0, len(packed_payload), self._part_size))
+            multipart_upload.complete_upload()
+        except BOTO_ERRORS as error:
+            try:
+                multipart_upload.cancel_upload()
+            except BOTO_ERRORS:
+                pass
+            raise BaseCoreDataSnapshotStorageException(error)
+
     def set_snapshot_by_version(self, version, snapshot):
         payload = snapshot.payload
 
         try:
-            packed_payload = self._payload_serializer.pack(payload)
+            with self._metrics_sink.timer('s3.pack'):
+                packed_payload = self._payload_serializer.pack(payload)
         except BasePayloadSerializerException as error:
             raise BaseCoreDataSnapshotStorageException(error)
 
+        key_name = self._get_snapshot_key_by_version(version)
+        with self._metrics_sink.timer('s3.write'):
+            if len(packed_payload) > self._part_size:
+                self._upload_parts(key_name, packed_payload)
+            else:
+                try:
+                    s3_key = boto.s3.key.Key(self._s3_bucket, key_name)
+                    s3_key.set_contents_from_string(packed_payload)
+                except BOTO_ERRORS as error:
+                    raise BaseCoreDataSnapshotStorageException(error)
+        self._metrics_sink.observe('s3.bytes_out', len(packed_payload))
+
+    def _open_s3_key_by_version(self, version, etag=None):
+        # a single GET of the first part brings the size and the etag of
+        # the snapshot along; with an etag it is conditional and None is
+        # returned while the snapshot has not changed
+        s3_key = boto.s3.key.Key(
+            self._s3_bucket, self._get_snapshot_key_by_version(version))
+        headers = {'Range': 'bytes=0-%d' % (self._part_size - 1)}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        try:
+            with self._metrics_sink.timer('s3.open'):
+                s3_key.open_read(headers=headers)
+        except boto.exception.S3ResponseError as error:
+            if error.status == 304 and etag is not None:
+                return None
+            if error.status == 404:
+                raise BaseCoreDataSnapshotStorageException(
+                    'Snapshot is not found')
+            raise BaseCoreDataSnapshotStorageException(error)
+        except BOTO_ERRORS as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+        return s3_key
+
+    def _download_part(self, s3_key, offset):
+        # boto keys are not thread safe, every part gets its own one; the
+        # etag fails the part if the snapshot was overwritten meanwhile
+        end = min(offset + self._part_size, s3_key.size)
+        part_key = boto.s3.key.Key(self._s3_bucket, s3_key.name)
+        part = part_key.get_contents_as_string(headers={
+            'Range': 'bytes=%d-%d' % (offset, end - 1),
+            'If-Match': s3_key.etag})
+        if len(part) != end - offset:
+            raise BaseCoreDataSnapshotStorageException('Invalid part size')
+        return part
+
+    def _download_parts(self, s3_key):
+        size = s3_key.size
+        packed_payload = bytearray(size)
+
+        def download_part(offset):
+            packed_payload[offset:offset + self._part_size] = (
+                self._download_part(s3_key, offset))
+
         try:
-            s3_key = boto.s3.key.Key(
-                self._s3_bucket, self._get_snapshot_key_by_version(version))
-            s3_key.set_contents_from_string(packed_payload)
-        except boto.exception.BotoClientError as error:
+            first_part = s3_key.read()
+            if len(first_part) != min(self._part_size, size):
+                raise BaseCoreDataSnapshotStorageException(
+                    'Invalid part size')
+            packed_payload[:len(first_part)] = first_part
+            self._map_parts(
+                download_part, xrange(self._part_size, size, self._part_size))
+        except BOTO_ERRORS as error:
             raise BaseCoreDataSnapshotStorageException(error)
+        # a read-only view, serializers do not accept a bytearray
+        return buffer(packed_payload)
+
+    def _iter_parts(self, s3_key):
+        # the first part is read from the response which opened the key,
+        # the others are downloaded ahead by up to concurrency requests but
+        # are yielded in order, so only that window is held in memory
+        part_offsets = iter(
+            xrange(self._part_size, s3_key.size, self._part_size))
+        if self._concurrency <= 1:
+            for chunk in s3_key:
+                yield chunk
+            for offset in part_offsets:
+                yield self._download_part(s3_key, offset)
+            return
+
+        thread_pool = self._get_thread_pool()
+        pending_parts = collections.deque(
+            thread_pool.apply_async(self._download_part, (s3_key, offset))
+            for offset in itertools.islice(part_offsets, self._concurrency))
+        for chunk in s3_key:
+            yield chunk
+        for offset in part_offsets:
+            yield pending_parts.popleft().get()
+            pending_parts.append(thread_pool.apply_async(
+                self._download_part, (s3_key, offset)))
+        while pending_parts:
+            yield pending_parts.popleft().get()
 
     def get_snapshot_by_version(self, version):
-        packed_payload = self._get_packed_payload_by_version(version)
+        # the last snapshot is returned again when S3 answers the GET made
+        # conditional on its etag by 304
+        etag = None
+        if (self._last_snapshot is not None and
+                self._last_snapshot.version == version):
+            etag = self._last_snapshot_etag
+        s3_key = self._open_s3_key_by_version(version, etag=etag)
+        if s3_key is None:
+            return self._last_snapshot
 
         try:
-            payload = self._payload_serializer.unpack(packed_payload)
+            if isinstance(
+                    self._payload_serializer, BaseStreamPayloadSerializer):
+                snapshot = self._get_snapshot_by_version_stream(
+                    version, s3_key)
+            else:
+                packed_payload = self._read_packed_payload(s3_key)
+                try:
+                    with self._metrics_sink.timer('s3.unpack'):
+                        payload = self._payload_serializer.unpack(
+                            packed_payload)
+                except BasePayloadSerializerException as error:
+                    raise BaseCoreDataSnapshotStorageException(error)
+                snapshot = self._snapshot_factory(version, payload)
+        finally:
+            s3_key.close()
+
+        self._last_snapshot = snapshot
+        self._last_snapshot_etag = s3_key.etag
+        return snapshot
+
+    def _get_snapshot_by_version_stream(self, version, s3_key):
+        # the read and the unpack overlap, the serializer reports the
+        # decompression and decoding time on its own; large snapshots are
+        # streamed by ranged parts
+        try:
+            if s3_key.size > self._part_size:
+                packed_chunks = self._iter_parts(s3_key)
+            else:
+                packed_chunks = s3_key
+            with self._metrics_sink.timer('s3.read_unpack'):
+                payload = self._payload_serializer.unpack_stream(
+                    packed_chunks)
+            self._metrics_sink.observe('s3.bytes_in', s3_key.size)
+        except BOTO_ERRORS as error:
+            raise BaseCoreDataSnapshotStorageException(error)
         except BasePayloadSerializerException as error:
             raise BaseCoreDataSnapshotStorageException(error)
         return self._snapshot_factory(version, payload)
 
-    def _get_packed_payload_by_version(self, version):
+    def _read_packed_payload(self, s3_key):
+        with self._metrics_sink.timer('s3.read'):
+            if s3_key.size > self._part_size:
+                packed_payload = self._download_parts(s3_key)
+            else:
+                try:
+                    packed_payload = s3_key.read()
+                except BOTO_ERRORS as error:
+                    raise BaseCoreDataSnapshotStorageException(error)
+        self._metrics_sink.observe('s3.bytes_in', len(packed_payload))
+        return packed_payload
+
+    def get_packed_snapshot_by_version(self, version):
+        s3_key = self._open_s3_key_by_version(version)
         try:
-            s3_key = boto.s3.key.Key(
-                self._s3_bucket, self._get_snapshot_key_by_version(version))
-            return s3_key.get_contents_as_string()
-        except boto.exception.BotoClientError as error:
-            raise BaseCoreDataSnapshotStorageException(error)
+            return self._read_packed_payload(s3_key)
+        finally:
+            s3_key.close()
 
     def set_patch_by_version(self, version, patch):  # pragma: no cover
         pass
@@ -485,15 +2098,194 @@ class CompatCoreDataSnapshotStorage(RedisCoreDataSnapshotStorage):
     def __init__(self, *args, **kwargs):
         payload_serializer = kwargs.pop('payload_serializer', None)
         if payload_serializer is None:
-            payload_serializer = MsgPackZlibPayloadSerializer()
+            payload_serializer = MsgPackZlibStreamPayloadSerializer()
         kwargs['payload_serializer'] = payload_serializer
         super(CompatCoreDataSnapshotStorage, self).__init__(*args, **kwargs)
 
 
 class CoreDataSnapshotStorage(CompatCoreDataSnapshotStorage):
     def __init__(self, *args, **kwargs):
+        # squashed_patches_count is the number of the latest versions
+        # which get a patch straight to the newly published version
+        self._squashed_patches_count = kwargs.pop(
+            'squashed_patches_count', 0)
         super(CoreDataSnapshotStorage, self).__init__(*args, **kwargs)
         self._latest_version_key = 'snapshot:latest_version'
+        self._versions_key = 'snapshot:versions'
+        self.__redis_publish_script = None
+        self.__redis_lock_mget_script = None
+        self.__redis_get_if_changed_script = None
+
+        self._unpack_thread_pool = None
+        self._unpack_thread_pool_lock = threading.Lock()
+
+    @property
+    def _redis_lock_mget_script(self):
+        if self.__redis_lock_mget_script is not None:
+            return self.__redis_lock_mget_script
+
+        try:
+            self.__redis_lock_mget_script = self._redis_conn.register_script(
+                """
+                --lockmgetscript, parameters: lock_key, keys..., lock_timeout
+                local ttl = redis.call('ttl', KEYS[1])
+                if ttl > 0 then
+                    return {0}
+                end
+                redis.call('setex', KEYS[1], ARGV[1], 'locked')
+                -- unpack() is bounded by the Lua C stack (about 8000
+                -- values), so the keys are read by slices
+                local values = {}
+                for first = 2, #KEYS, 1000 do
+                    local last = math.min(first + 999, #KEYS)
+                    local batch = redis.call(
+                        'mget', unpack(KEYS, first, last))
+                    for index = 1, #batch do
+                        values[#values + 1] = batch[index]
+                    end
+                end
+                return {1, values}""")
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        return self.__redis_lock_mget_script
+
+    @property
+    def _redis_get_if_changed_script(self):
+        if self.__redis_get_if_changed_script is not None:
+            return self.__redis_get_if_changed_script
+
+        try:
+            self.__redis_get_if_changed_script = (
+                self._redis_conn.register_script(
+                    """
+                    --getifchangedscript, parameters:
+                    --  digest_key, key, lock_key, known_digest, lock_timeout
+                    local digest = redis.call('get', KEYS[1])
+                    if digest and digest == ARGV[1] then
+                        return {0}
+                    end
+                    if ARGV[2] ~= '' then
+                        if redis.call('ttl', KEYS[3]) > 0 then
+                            return {2}
+                        end
+                        redis.call('setex', KEYS[3], ARGV[2], 'locked')
+                    end
+                    return {1, digest or '', redis.call('get', KEYS[2])}"""))
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        return self.__redis_get_if_changed_script
+
+    @property
+    def _redis_publish_script(self):
+        if self.__redis_publish_script is not None:
+            return self.__redis_publish_script
+
+        try:
+            self.__redis_publish_script = self._redis_conn.register_script(
+                """
+                --publishscript, parameters:
+                --  latest_version_key, versions_key, command keys...
+                --  expected_version, version, latest_version_channel,
+                --  (command, arguments count, arguments...) per command key
+                if ARGV[1] ~= '' and redis.call('get', KEYS[1]) ~= ARGV[1] then
+                    return 0
+                end
+                local argv_index = 4
+                for key_index = 3, #KEYS do
+                    local arguments_count = tonumber(ARGV[argv_index + 1])
+                    redis.call(
+                        ARGV[argv_index], KEYS[key_index],
+                        unpack(ARGV, argv_index + 2,
+                               argv_index + 1 + arguments_count))
+                    argv_index = argv_index + 2 + arguments_count
+                end
+                redis.call('zadd', KEYS[2], ARGV[2], ARGV[2])
+                redis.call('set', KEYS[1], ARGV[2])
+                redis.call('publish', ARGV[3], ARGV[2])
+                return 1""")
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        return self.__redis_publish_script
+
+    def _publish_by_script(self, version, expected_version, commands):
+        keys = [self._latest_version_key, self._versions_key]
+        args = [
+            '' if expected_version is None else str(expected_version),
+            version, self._get_latest_version_channel()]
+        for command, key, command_args in commands:
+            keys.append(key)
+            args.append(command)
+            args.append(len(command_args))
+            args.extend(command_args)
+
+        with self._metrics_sink.timer('redis.write'):
+            return self._redis_publish_script(
+                keys=keys, args=args, client=self._redis_conn)
+
+    def _publish_by_transaction(self, version, expected_version, commands):
+        # every command is sent on its own, so that none of them carries
+        # more than a chunk; the expected version is checked by WATCH
+        with self._metrics_sink.timer('redis.write'):
+            pipeline = self._redis_conn.pipeline()
+            try:
+                if expected_version is not None:
+                    pipeline.watch(self._latest_version_key)
+                    latest_version = pipeline.get(self._latest_version_key)
+                    if latest_version != str(expected_version):
+                        return False
+                pipeline.multi()
+                for command, key, command_args in commands:
+                    pipeline.execute_command(command, key, *command_args)
+                pipeline.zadd(self._versions_key, {version: version})
+                pipeline.set(self._latest_version_key, version)
+                pipeline.publish(self._get_latest_version_channel(), version)
+                pipeline.execute()
+            except redis.WatchError:
+                return False
+            finally:
+                pipeline.reset()
+        return True
+
+    def publish(self, version, snapshot, patch=None, expected_version=None):
+        # a single script call is atomic but carries the whole snapshot, so
+        # chunked storages publish by a WATCH/MULTI transaction instead
+        version = self._clean_version(version)
+        if expected_version is not None:
+            expected_version = self._clean_version(expected_version)
+
+        command_queue = _RedisCommandQueue()
+        self._queue_set_snapshot(command_queue, version, snapshot.payload)
+        if patch is not None:
+            self._queue_set_packed_payload(
+                command_queue,
+                self._get_patch_key_by_snapshot_version(
+                    patch.base_snapshot_version),
+                self._pack_payload(patch.payload))
+            for squashed_patch in self._get_squashed_patches(patch):
+                self._queue_set_packed_payload(
+                    command_queue,
+                    self._get_squashed_patch_key_by_snapshot_version(
+                        squashed_patch.base_snapshot_version),
+                    self._pack_payload(squashed_patch.payload))
+
+        try:
+            if self._chunk_size is None:
+                published = self._publish_by_script(
+                    version, expected_version, command_queue.commands)
+            else:
+                published = self._publish_by_transaction(
+                    version, expected_version, command_queue.commands)
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+        self._metrics_sink.observe('redis.bytes_out', sum(
+            len(arg) for _, _, command_args in command_queue.commands
+            for arg in command_args if isinstance(arg, str)))
+
+        if not published:
+            raise BaseCoreDataSnapshotStorageException('Version conflict')
 
     def _get_snapshot_key_by_version(self, version):
         return 'snapshot:%s' % version
@@ -501,34 +2293,1186 @@ class CoreDataSnapshotStorage(CompatCoreDataSnapshotStorage):
     def _get_patch_key_by_snapshot_version(self, version):
         return 'snapshot:%s:patch' % version
 
+    def _get_squashed_patch_key_by_snapshot_version(self, version):
+        return 'snapshot:%s:squashed_patch' % version
+
+    def _get_snapshot_digest_key_by_version(self, version):
+        return 'snapshot:%s:digest' % version
+
+    def _get_squashed_patch_by_version(self, version):
+        squashed_patch_key = self._get_squashed_patch_key_by_snapshot_version(
+            version)
+        try:
+            patch_payload = self._get_payload_by_key(
+                squashed_patch_key, lock=False)
+            patch = self._snapshot_patch_factory(version, patch_payload)
+            self._clean_version(patch.new_snapshot_version)
+        except (BaseCoreDataSnapshotStorageException, TypeError, KeyError):
+            return None
+        return patch
+
+    def _get_squashed_patches(self, patch):
+        # the squashed patches of the previous versions lead to the base
+        # version of the new patch, which is squashed onto each of them
+        if self._squashed_patches_count <= 0:
+            return []
+
+        base_version = self._clean_version(patch.base_snapshot_version)
+        squashed_patches = [patch]
+        for version in self.get_latest_versions(self._squashed_patches_count):
+            if version >= base_version:
+                continue
+            squashed_patch = self._get_squashed_patch_by_version(version)
+            if squashed_patch is None or self._clean_version(
+                    squashed_patch.new_snapshot_version) != base_version:
+                continue
+            squashed_patches.append(squash_patches((squashed_patch, patch)))
+        return squashed_patches
+
+    def sync_snapshot(self, snapshot, max_patches_count=10):
+        latest_version = self.get_latest_version()
+        if snapshot is None:
+            return self.get_snapshot_by_version(latest_version)
+        if snapshot.version == latest_version:
+            return snapshot
+
+        if not self._lock_snapshots():
+            raise SnapshotsLockedException('locked')
+
+        if self._squashed_patches_count > 0:
+            patch = self._get_squashed_patch_by_version(snapshot.version)
+            if patch is not None and self._clean_version(
+                    patch.new_snapshot_version) == latest_version:
+                try:
+                    snapshot.apply_patch(patch)
+                    return snapshot
+                except (TypeError, KeyError, IndexError):
+                    pass
+
+        patches = []
+        version = snapshot.version
+        while version != latest_version and len(patches) < max_patches_count:
+            patch_key = self._get_patch_key_by_snapshot_version(version)
+            try:
+                patch_payload = self._get_payload_by_key(patch_key, lock=False)
+                patch = self._snapshot_patch_factory(version, patch_payload)
+                new_version = self._clean_version(patch.new_snapshot_version)
+            except (BaseCoreDataSnapshotStorageException, TypeError, KeyError):
+                break
+            if new_version <= version or new_version > latest_version:
+                break
+            patches.append(patch)
+            version = new_version
+
+        if version == latest_version:
+            try:
+                for patch in patches:
+                    snapshot.apply_patch(patch)
+                return snapshot
+            except (TypeError, KeyError, IndexError):
+                pass
+
+        snapshot_key = self._get_snapshot_key_by_version(latest_version)
+        snapshot_payload = self._get_payload_by_key(snapshot_key, lock=False)
+        return self._snapshot_factory(latest_version, snapshot_payload)
+
+    def _get_packed_payloads_by_keys(self, keys):
+        # the snapshots lock is taken once for the whole batch
+        try:
+            with self._metrics_sink.timer('redis.read'):
+                if self._ignore_snapshots_lock():
+                    packed_payloads = self._redis_conn.mget(keys)
+                else:
+                    result = self._redis_lock_mget_script(
+                        keys=['snapshots_lock'] + keys,
+                        args=(self._snapshots_lock_ttl,),
+                        client=self._redis_conn)
+                    if not result or not result[0]:
+                        self._metrics_sink.increment('redis.lock_rejections')
+                        raise SnapshotsLockedException('locked')
+                    packed_payloads = result[1]
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+        packed_payloads = list(packed_payloads)
+
+        manifests = []
+        for index, packed_payload in enumerate(packed_payloads):
+            if self._is_chunks_manifest(packed_payload):
+                manifests.append((index, self._parse_chunks_manifest(
+                    packed_payload)))
+        if manifests:
+            try:
+                with self._metrics_sink.timer('redis.read'):
+                    pipeline = self._redis_conn.pipeline(transaction=False)
+                    for index, (chunks_count, _) in manifests:
+                        chunks_key = self._get_chunks_key(keys[index])
+                        for chunk_index in xrange(chunks_count):
+                            pipeline.hget(chunks_key, chunk_index)
+                    chunks = pipeline.execute()
+            except redis.RedisError as error:
+                raise BaseCoreDataSnapshotStorageException(error)
+
+            offset = 0
+            for index, (chunks_count, size) in manifests:
+                payload_chunks = chunks[offset:offset + chunks_count]
+                offset += chunks_count
+                if None in payload_chunks or sum(
+                        len(chunk) for chunk in payload_chunks) != size:
+                    raise BaseCoreDataSnapshotStorageException(
+                        'Broken chunks')
+                packed_payloads[index] = ''.join(payload_chunks)
+
+        self._metrics_sink.observe('redis.bytes_in', sum(
+            len(packed_payload) for packed_payload in packed_payloads
+            if packed_payload is not None))
+        return packed_payloads
+
+    def _unpack_payloads(self, packed_payloads, concurrency):
+        with self._metrics_sink.timer('redis.unpack'):
+            if concurrency <= 1 or len(packed_payloads) <= 1:
+                return map(self._unpack_payload, packed_payloads)
+            with self._unpack_thread_pool_lock:
+                if self._unpack_thread_pool is None:
+                    self._unpack_thread_pool = multiprocessing.pool.ThreadPool(
+                        concurrency)
+            return self._unpack_thread_pool.map(
+                self._unpack_payload, packed_payloads)
+
+    def _get_payloads_by_keys(self, keys, concurrency, missing_message):
+        if not keys:
+            return []
+        packed_payloads = self._get_packed_payloads_by_keys(keys)
+        if None in packed_payloads:
+            raise BaseCoreDataSnapshotStorageException(missing_message)
+        return self._unpack_payloads(packed_payloads, concurrency)
+
+    def get_snapshots_by_versions(self, versions, concurrency=4):
+        versions = self._clean_versions(versions)
+        payloads = self._get_payloads_by_keys(
+            [self._get_snapshot_key_by_version(version)
+             for version in versions],
+            concurrency, 'Snapshot is not found')
+        return [
+            self._snapshot_factory(version, payload)
+            for version, payload in zip(versions, payloads)]
+
+    def get_patches_by_versions(self, versions, concurrency=4):
+        versions = self._clean_versions(versions)
+        payloads = self._get_payloads_by_keys(
+            [self._get_patch_key_by_snapshot_version(version)
+             for version in versions],
+            concurrency, 'Patch is not found')
+        return [
+            self._snapshot_patch_factory(version, payload)
+            for version, payload in zip(versions, payloads)]
+
+    def _queue_set_snapshot_digest(
+            self, pipeline, version, packed_payload, ttl=None):
+        digest_key = self._get_snapshot_digest_key_by_version(version)
+        digest = hashlib.sha1(packed_payload).hexdigest()
+        if ttl is None:
+            pipeline.set(digest_key, digest)
+        else:
+            pipeline.set(digest_key, digest, ex=ttl)
+
+    def _queue_set_snapshot(self, pipeline, version, payload, ttl=None):
+        packed_payload = self._pack_payload(payload)
+        self._queue_set_packed_payload(
+            pipeline, self._get_snapshot_key_by_version(version),
+            packed_payload, ttl=ttl)
+        self._queue_set_snapshot_digest(
+            pipeline, version, packed_payload, ttl=ttl)
+
+    def set_snapshot_by_version(self, version, snapshot, ttl=None):
+        version = self._clean_version(version)
+        try:
+            pipeline = self._redis_conn.pipeline()
+            self._queue_set_snapshot(
+                pipeline, version, snapshot.payload, ttl=ttl)
+            # expiring snapshots (e.g. read-through fills) are not indexed,
+            # the index would keep listing them once their keys are gone
+            if ttl is None:
+                pipeline.zadd(self._versions_key, {version: version})
+            pipeline.execute()
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+    def get_snapshot_if_changed(self, version, known_digest=None):
+        # the digest is compared server side, an unchanged snapshot costs a
+        # single round trip and neither takes the snapshots lock nor
+        # transfers the payload
+        version = self._clean_version(version)
+        snapshot_key = self._get_snapshot_key_by_version(version)
+        lock_ttl = (
+            '' if self._ignore_snapshots_lock() else self._snapshots_lock_ttl)
+        try:
+            with self._metrics_sink.timer('redis.read'):
+                result = self._redis_get_if_changed_script(
+                    keys=(
+                        self._get_snapshot_digest_key_by_version(version),
+                        snapshot_key, 'snapshots_lock'),
+                    args=(known_digest or '', lock_ttl),
+                    client=self._redis_conn)
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        if not result or result[0] == 2:
+            self._metrics_sink.increment('redis.lock_rejections')
+            raise SnapshotsLockedException('locked')
+        if result[0] == 0:
+            self._metrics_sink.increment('redis.not_modified')
+            return ConditionalSnapshotResult(False, None, known_digest)
+
+        # a missing key truncates the reply to the status and the digest
+        packed_payload = result[2] if len(result) > 2 else None
+        if packed_payload is None:
+            raise BaseCoreDataSnapshotStorageException(
+                'Snapshot is not found')
+        if self._is_chunks_manifest(packed_payload):
+            packed_chunks = self._get_chunks_by_manifest(
+                snapshot_key, packed_payload)
+        else:
+            packed_chunks = [packed_payload]
+        self._metrics_sink.observe('redis.bytes_in', sum(
+            len(packed_chunk) for packed_chunk in packed_chunks))
+
+        with self._metrics_sink.timer('redis.unpack'):
+            if len(packed_chunks) == 1:
+                payload = self._unpack_payload(packed_chunks[0])
+            else:
+                payload = self._unpack_payload_chunks(packed_chunks)
+        return ConditionalSnapshotResult(
+            True, self._snapshot_factory(version, payload), result[1] or None)
+
+    def _clean_versions(self, versions):
+        return [self._clean_version(version) for version in versions]
+
     def get_all_versions(self):
         try:
-            keys_template = self._get_snapshot_key_by_version('*')
-            keys = self._redis_conn.keys(keys_template)
+            versions = self._redis_conn.zrange(self._versions_key, 0, -1)
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+        return self._clean_versions(versions)
+
+    def get_latest_versions(self, count):
+        if count <= 0:
+            return []
+
+        try:
+            versions = self._redis_conn.zrevrange(
+                self._versions_key, 0, count - 1)
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+        return self._clean_versions(reversed(versions))
+
+    def get_versions_in_range(self, min_version='-inf', max_version='+inf'):
+        try:
+            versions = self._redis_conn.zrangebyscore(
+                self._versions_key, min_version, max_version)
         except redis.RedisError as error:
             raise BaseCoreDataSnapshotStorageException(error)
+        return self._clean_versions(versions)
 
+    def migrate_versions_index(self, batch_size=1000):
+        snapshot_key_prefix = self._get_snapshot_key_by_version('')
         versions = set()
-        for key in keys:
+        try:
+            keys = self._redis_conn.scan_iter(
+                match=self._get_snapshot_key_by_version('*'),
+                count=batch_size)
+            for key in keys:
+                try:
+                    version = self._clean_version(
+                        key.replace(snapshot_key_prefix, ''))
+                    versions.add(version)
+                except BaseCoreDataSnapshotStorageException:
+                    pass
+
+            versions = sorted(versions)
+            for index in xrange(0, len(versions), batch_size):
+                self._redis_conn.zadd(self._versions_key, dict(
+                    (version, version)
+                    for version in versions[index:index + batch_size]))
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+        return versions
+
+    def _get_keys_by_version(self, version):
+        snapshot_key = self._get_snapshot_key_by_version(version)
+        patch_key = self._get_patch_key_by_snapshot_version(version)
+        squashed_patch_key = self._get_squashed_patch_key_by_snapshot_version(
+            version)
+        return (
+            snapshot_key, self._get_chunks_key(snapshot_key),
+            self._get_snapshot_digest_key_by_version(version),
+            patch_key, self._get_chunks_key(patch_key),
+            squashed_patch_key, self._get_chunks_key(squashed_patch_key))
+
+    def _unlink_versions(self, versions, batch_size, measure=False):
+        reclaimed_bytes = 0
+        for index in xrange(0, len(versions), batch_size):
+            batch_versions = versions[index:index + batch_size]
+            keys = []
+            for version in batch_versions:
+                keys.extend(self._get_keys_by_version(version))
             try:
-                version = key.replace(
-                    self._get_snapshot_key_by_version(''), '')
-                version = self._clean_version(version)
-                versions.add(version)
-            except BaseCoreDataSnapshotStorageException:
-                pass
+                pipeline = self._redis_conn.pipeline(transaction=False)
+                if measure:
+                    for key in keys:
+                        pipeline.memory_usage(key)
+                pipeline.unlink(*keys)
+                pipeline.zrem(self._versions_key, *batch_versions)
+                results = pipeline.execute()
+            except redis.RedisError as error:
+                raise BaseCoreDataSnapshotStorageException(error)
+            if measure:
+                reclaimed_bytes += sum(
+                    size for size in results[:len(keys)] if size)
+        return reclaimed_bytes
+
+    def remove_snapshots_and_patches_by_versions(
+            self, versions, batch_size=100):
+        if not versions:
+            return
 
-        return sorted(versions)
+        self._unlink_versions(list(versions), batch_size)
+
+    def _get_patch_chain_versions(self, versions, max_patch_chain_length):
+        # versions which clients can still catch up from by patches, that
+        # is the unbroken run of patches right before the latest version
+        candidate_versions = versions[-max_patch_chain_length - 1:-1]
+        if not candidate_versions:
+            return set()
+
+        try:
+            pipeline = self._redis_conn.pipeline(transaction=False)
+            for version in candidate_versions:
+                pipeline.exists(
+                    self._get_patch_key_by_snapshot_version(version))
+            patches_exist = pipeline.execute()
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
 
-    def remove_snapshots_and_patches_by_versions(self, versions):
+        chain_versions = set()
+        for version, patch_exists in reversed(
+                zip(candidate_versions, patches_exist)):
+            if not patch_exists:
+                break
+            chain_versions.add(version)
+        return chain_versions
+
+    def collect_garbage(
+            self, policies, batch_size=100, max_patch_chain_length=10,
+            dry_run=False):
+        versions = self.get_all_versions()
         if not versions:
+            return GarbageCollectionResult([], 0)
+
+        kept_versions = set(versions[-1:])
+        for policy in policies:
+            kept_versions.update(policy.get_kept_versions(versions))
+        kept_versions.update(self._get_patch_chain_versions(
+            versions, max_patch_chain_length))
+
+        removed_versions = [
+            version for version in versions if version not in kept_versions]
+        if dry_run or not removed_versions:
+            return GarbageCollectionResult(removed_versions, 0)
+
+        reclaimed_bytes = self._unlink_versions(
+            removed_versions, batch_size, measure=True)
+        return GarbageCollectionResult(removed_versions, reclaimed_bytes)
+
+
+class SegmentedCoreDataSnapshotStorage(CoreDataSnapshotStorage):
+    # snapshots are split into content-defined segments of top-level keys,
+    # each segment is stored once under its digest and a version only
+    # keeps the manifest of its segment digests
+    #
+    # the segments index is a sorted set scored by the time until which a
+    # segment must be kept: a writer which skips an existing segment pushes
+    # that time forward in the same script that finds it, and garbage
+    # collection only removes segments past it, so a manifest written
+    # within segments_grace_period never loses its segments
+    def __init__(self, *args, **kwargs):
+        self._segment_keys_count = kwargs.pop('segment_keys_count', 1024)
+        self._segment_cache_size = kwargs.pop(
+            'segment_cache_size', 256 * 1024 * 1024)
+        self._segments_grace_period = kwargs.pop(
+            'segments_grace_period', 60 * 60)
+        super(SegmentedCoreDataSnapshotStorage, self).__init__(
+            *args, **kwargs)
+        self._segments_manifest_prefix = 'segments:'
+        self._segments_key = 'snapshot:segments'
+        self.__redis_touch_segments_script = None
+        self.__redis_remove_segments_script = None
+
+        self._segments = collections.OrderedDict()
+        self._segments_size = 0
+        self._segments_lock = threading.Lock()
+
+    def _get_segment_key(self, digest):
+        return 'snapshot:segment:%s' % digest
+
+    def _split_segments(self, payload):
+        # a segment ends on a key whose hash hits the boundary, so that an
+        # added or removed key only changes the segment it falls into
+        items = sorted(
+            (msgpack.packb(key), key, value)
+            for key, value in payload.iteritems())
+        segments = []
+        segment = []
+        for packed_key, key, value in items:
+            segment.append((key, value))
+            if zlib.crc32(packed_key) % self._segment_keys_count == 0:
+                segments.append(segment)
+                segment = []
+        if segment:
+            segments.append(segment)
+        return segments
+
+    def _pack_segments(self, payload):
+        packed_segments = []
+        for segment in self._split_segments(payload):
+            packed_segment = self._pack_payload(dict(segment))
+            packed_segments.append(
+                (hashlib.sha1(packed_segment).hexdigest(), packed_segment))
+        return packed_segments
+
+    @property
+    def _redis_touch_segments_script(self):
+        if self.__redis_touch_segments_script is not None:
+            return self.__redis_touch_segments_script
+
+        try:
+            self.__redis_touch_segments_script = (
+                self._redis_conn.register_script(
+                    """
+                    --touchsegmentsscript, parameters:
+                    --  segments_key, segment keys..., keep_until, digests...
+                    local keep_until = tonumber(ARGV[1])
+                    local missing_digests = {}
+                    for index = 2, #KEYS do
+                        local digest = ARGV[index]
+                        if redis.call('exists', KEYS[index]) == 1 then
+                            local score = redis.call(
+                                'zscore', KEYS[1], digest)
+                            if not score or tonumber(score) < keep_until then
+                                redis.call('zadd', KEYS[1], ARGV[1], digest)
+                            end
+                        else
+                            table.insert(missing_digests, digest)
+                        end
+                    end
+                    return missing_digests"""))
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        return self.__redis_touch_segments_script
+
+    @property
+    def _redis_remove_segments_script(self):
+        if self.__redis_remove_segments_script is not None:
+            return self.__redis_remove_segments_script
+
+        try:
+            self.__redis_remove_segments_script = (
+                self._redis_conn.register_script(
+                    """
+                    --removesegmentsscript, parameters:
+                    --  segments_key, segment keys..., now, digests...
+                    local now = tonumber(ARGV[1])
+                    local removed_digests = {}
+                    for index = 2, #KEYS do
+                        local digest = ARGV[index]
+                        local score = redis.call('zscore', KEYS[1], digest)
+                        if score and tonumber(score) < now then
+                            redis.call('unlink', KEYS[index])
+                            redis.call('zrem', KEYS[1], digest)
+                            table.insert(removed_digests, digest)
+                        end
+                    end
+                    return removed_digests"""))
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        return self.__redis_remove_segments_script
+
+    def _get_missing_digests(self, digests, keep_until):
+        # existing segments are kept until keep_until in the same script,
+        # so that garbage collection cannot remove them once skipped
+        digests = sorted(set(digests))
+        try:
+            missing_digests = self._redis_touch_segments_script(
+                keys=[self._segments_key] + [
+                    self._get_segment_key(digest) for digest in digests],
+                args=[keep_until] + digests, client=self._redis_conn)
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+        return set(missing_digests)
+
+    def _queue_set_snapshot(self, pipeline, version, payload, ttl=None):
+        packed_segments = self._pack_segments(payload)
+        digests = [digest for digest, _ in packed_segments]
+        # segments of an expiring manifest are not referenced by any
+        # indexed version, they are kept for as long as the manifest lives
+        keep_until = int(time.time()) + max(
+            self._segments_grace_period, ttl or 0)
+        missing_digests = self._get_missing_digests(digests, keep_until)
+
+        written_digests = set()
+        for digest, packed_segment in packed_segments:
+            if digest not in missing_digests or digest in written_digests:
+                continue
+            pipeline.set(self._get_segment_key(digest), packed_segment)
+            written_digests.add(digest)
+            self._metrics_sink.observe(
+                'redis.bytes_out', len(packed_segment))
+        if written_digests:
+            pipeline.zadd(self._segments_key, dict(
+                (digest, keep_until) for digest in written_digests))
+        self._metrics_sink.increment(
+            'redis.segments_written', len(written_digests))
+        self._metrics_sink.increment(
+            'redis.segments_skipped', len(digests) - len(written_digests))
+
+        manifest = self._segments_manifest_prefix + ','.join(digests)
+        if ttl is None:
+            pipeline.set(self._get_snapshot_key_by_version(version), manifest)
+        else:
+            pipeline.set(
+                self._get_snapshot_key_by_version(version), manifest, ex=ttl)
+        # the manifest is content-addressed already
+        self._queue_set_snapshot_digest(pipeline, version, manifest, ttl=ttl)
+
+    def _is_segments_manifest(self, packed_payload):
+        return (
+            isinstance(packed_payload, str) and
+            packed_payload.startswith(self._segments_manifest_prefix))
+
+    def _parse_segments_manifest(self, manifest):
+        manifest = manifest[len(self._segments_manifest_prefix):]
+        return manifest.split(',') if manifest else []
+
+    def _get_cached_segment(self, digest):
+        with self._segments_lock:
+            packed_segment = self._segments.pop(digest, None)
+            if packed_segment is not None:
+                self._segments[digest] = packed_segment
+            return packed_segment
+
+    def _cache_segment(self, digest, packed_segment):
+        if len(packed_segment) > self._segment_cache_size:
             return
 
-        keys = []
-        for version in versions:
-            keys.append(self._get_snapshot_key_by_version(version))
-            keys.append(self._get_patch_key_by_snapshot_version(version))
+        with self._segments_lock:
+            if digest in self._segments:
+                return
+            self._segments[digest] = packed_segment
+            self._segments_size += len(packed_segment)
+            while self._segments_size > self._segment_cache_size:
+                _, evicted_segment = self._segments.popitem(last=False)
+                self._segments_size -= len(evicted_segment)
+
+    def _get_packed_segments(self, digests):
+        packed_segments = dict(
+            (digest, self._get_cached_segment(digest)) for digest in digests)
+        missing_digests = sorted(
+            digest for digest, packed_segment in packed_segments.iteritems()
+            if packed_segment is None)
+        self._metrics_sink.increment(
+            'redis.segment_cache_hits',
+            len(packed_segments) - len(missing_digests))
+        self._metrics_sink.increment(
+            'redis.segment_cache_misses', len(missing_digests))
+        if not missing_digests:
+            return packed_segments
+
+        try:
+            with self._metrics_sink.timer('redis.read'):
+                fetched_segments = self._redis_conn.mget([
+                    self._get_segment_key(digest)
+                    for digest in missing_digests])
+        except redis.RedisError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        for digest, packed_segment in zip(missing_digests, fetched_segments):
+            if packed_segment is None:
+                raise BaseCoreDataSnapshotStorageException('Broken segments')
+            self._metrics_sink.observe('redis.bytes_in', len(packed_segment))
+            self._cache_segment(digest, packed_segment)
+            packed_segments[digest] = packed_segment
+        return packed_segments
+
+    def _unpack_payload(self, packed_payload):
+        # every read path ends up here, a manifest is resolved into its
+        # segments which are unpacked anew so that callers can patch them
+        if not self._is_segments_manifest(packed_payload):
+            return super(SegmentedCoreDataSnapshotStorage,
+                         self)._unpack_payload(packed_payload)
+
+        digests = self._parse_segments_manifest(packed_payload)
+        packed_segments = self._get_packed_segments(digests)
+        payload = {}
+        for digest in digests:
+            payload.update(super(
+                SegmentedCoreDataSnapshotStorage, self)._unpack_payload(
+                    packed_segments[digest]))
+        return payload
+
+    def get_packed_snapshot_by_version(self, version):
+        packed_payload = super(
+            SegmentedCoreDataSnapshotStorage,
+            self).get_packed_snapshot_by_version(version)
+        if not self._is_segments_manifest(packed_payload):
+            return packed_payload
+        return self._pack_payload(self._unpack_payload(packed_payload))
+
+    def collect_segments(self, batch_size=100):
+        # segments which none of the stored versions refers to any more
+        # and which are past their keep-until time; the time is checked
+        # again by the removing script, a writer may have just skipped one
+        now = int(time.time())
+        versions = self.get_all_versions()
+        referenced_digests = set()
         try:
-            self._redis_conn.delete(*keys)
+            for index in xrange(0, len(versions), batch_size):
+                manifests = self._redis_conn.mget([
+                    self._get_snapshot_key_by_version(version)
+                    for version in versions[index:index + batch_size]])
+                for manifest in manifests:
+                    if self._is_segments_manifest(manifest):
+                        referenced_digests.update(
+                            self._parse_segments_manifest(manifest))
+            digests = self._redis_conn.zrangebyscore(
+                self._segments_key, '-inf', '(%d' % now)
         except redis.RedisError as error:
             raise BaseCoreDataSnapshotStorageException(error)
+
+        unreferenced_digests = sorted(set(digests) - referenced_digests)
+        removed_digests = []
+        for index in xrange(0, len(unreferenced_digests), batch_size):
+            batch_digests = unreferenced_digests[index:index + batch_size]
+            try:
+                removed_digests.extend(self._redis_remove_segments_script(
+                    keys=[self._segments_key] + [
+                        self._get_segment_key(digest)
+                        for digest in batch_digests],
+                    args=[now] + batch_digests, client=self._redis_conn))
+            except redis.RedisError as error:
+                raise BaseCoreDataSnapshotStorageException(error)
+        return removed_digests
+
+    def collect_garbage(
+            self, policies, batch_size=100, max_patch_chain_length=10,
+            dry_run=False):
+        result = super(SegmentedCoreDataSnapshotStorage, self).collect_garbage(
+            policies, batch_size=batch_size,
+            max_patch_chain_length=max_patch_chain_length, dry_run=dry_run)
+        if result.removed_versions and not dry_run:
+            self.collect_segments(batch_size=batch_size)
+        return result
+
+
+class CachedCoreDataSnapshotStorage(BaseCoreDataSnapshotStorage):
+    # cached snapshots are shared between callers and must not be patched
+    # in place
+    def __init__(self, storage, max_size=512 * 1024 * 1024):
+        self._storage = storage
+        self._max_size = max_size
+
+        self._snapshots = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def storage(self):
+        return self._storage
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    @property
+    def size(self):
+        return self._size
+
+    def set_latest_version(self, version):
+        self._storage.set_latest_version(version)
+
+    def get_latest_version(self):
+        return self._storage.get_latest_version()
+
+    def set_snapshot_by_version(self, version, snapshot):
+        self._storage.set_snapshot_by_version(version, snapshot)
+        self.invalidate(version)
+
+    def get_snapshot_by_version(self, version):
+        with self._lock:
+            entry = self._snapshots.pop(version, None)
+            if entry is not None:
+                self._snapshots[version] = entry
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+
+        snapshot = self._storage.get_snapshot_by_version(version)
+        size = _estimate_payload_size(snapshot.payload)
+        if size > self._max_size:
+            return snapshot
+
+        with self._lock:
+            entry = self._snapshots.pop(version, None)
+            if entry is not None:
+                self._size -= entry[1]
+            self._snapshots[version] = (snapshot, size)
+            self._size += size
+            while self._size > self._max_size:
+                _, (_, evicted_size) = self._snapshots.popitem(last=False)
+                self._size -= evicted_size
+        return snapshot
+
+    def set_patch_by_version(self, version, patch):
+        self._storage.set_patch_by_version(version, patch)
+
+    def get_patch_by_version(self, version):
+        return self._storage.get_patch_by_version(version)
+
+    def invalidate(self, version=None):
+        with self._lock:
+            if version is None:
+                self._snapshots.clear()
+                self._size = 0
+                return
+            entry = self._snapshots.pop(version, None)
+            if entry is not None:
+                self._size -= entry[1]
+
+
+class TieredCoreDataSnapshotStorage(BaseCoreDataSnapshotStorage):
+    # reads are served by the primary storage (Redis) and filled from the
+    # secondary one (S3); snapshots and latest versions are written to the
+    # secondary storage in the background in the order they were set
+    #
+    # a full queue blocks the caller for up to enqueue_timeout and then
+    # raises, and the secondary latest version is never moved to a version
+    # whose snapshot was dropped or failed to upload
+    def __init__(
+            self, primary_storage, secondary_storage, fill_ttl=24 * 60 * 60,
+            queue_size=16, enqueue_timeout=30.0, max_retries=3,
+            retry_delay=1.0):
+        self._primary_storage = primary_storage
+        self._secondary_storage = secondary_storage
+        self._fill_ttl = fill_ttl
+
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._enqueue_timeout = enqueue_timeout
+        self._max_retries = max_retries
+        self._retry_delay = retry_delay
+        self._writer_thread = None
+        self._writer_thread_lock = threading.Lock()
+
+        self._failed_versions = set()
+        self._failed_versions_lock = threading.Lock()
+
+        self._metrics = collections.Counter()
+
+    @property
+    def primary_storage(self):
+        return self._primary_storage
+
+    @property
+    def secondary_storage(self):
+        return self._secondary_storage
+
+    @property
+    def metrics(self):
+        metrics = dict(self._metrics)
+        metrics['queue_size'] = self._queue.qsize()
+        return metrics
+
+    def _start_writer_thread(self):
+        with self._writer_thread_lock:
+            if self._writer_thread is not None:
+                return
+            self._writer_thread = threading.Thread(target=self._run_writer)
+            self._writer_thread.daemon = True
+            self._writer_thread.start()
+
+    def _run_writer(self):
+        while True:
+            write = self._queue.get()
+            try:
+                self._write(*write)
+            finally:
+                self._queue.task_done()
+
+    def _set_version_failed(self, version, failed):
+        with self._failed_versions_lock:
+            if failed:
+                self._failed_versions.add(version)
+            else:
+                self._failed_versions.discard(version)
+
+    def _is_version_failed(self, version):
+        with self._failed_versions_lock:
+            return version in self._failed_versions
+
+    def _write(self, method_name, args):
+        version = args[0]
+        if (method_name == 'set_latest_version' and
+                self._is_version_failed(version)):
+            self._metrics['latest_version_skips'] += 1
+            return
+
+        for attempt in xrange(self._max_retries + 1):
+            if attempt:
+                self._metrics['write_retries'] += 1
+                time.sleep(self._retry_delay * 2 ** (attempt - 1))
+            try:
+                getattr(self._secondary_storage, method_name)(*args)
+            except Exception:
+                # anything escaping here would kill the writer thread and
+                # leave the queue unconsumed
+                continue
+            if method_name == 'set_snapshot_by_version':
+                self._set_version_failed(version, False)
+            self._metrics['writes'] += 1
+            return
+        if method_name == 'set_snapshot_by_version':
+            self._set_version_failed(version, True)
+        self._metrics['write_failures'] += 1
+
+    def _enqueue_write(self, method_name, *args):
+        self._start_writer_thread()
+        try:
+            self._queue.put(
+                (method_name, args), timeout=self._enqueue_timeout)
+        except Queue.Full:
+            self._metrics['write_drops'] += 1
+            if method_name == 'set_snapshot_by_version':
+                self._set_version_failed(args[0], True)
+            raise BaseCoreDataSnapshotStorageException(
+                'Write-behind queue is full')
+        self._metrics['write_enqueues'] += 1
+
+    def flush(self):
+        self._queue.join()
+
+    def set_latest_version(self, version):
+        self._primary_storage.set_latest_version(version)
+        self._enqueue_write('set_latest_version', version)
+
+    def get_latest_version(self):
+        try:
+            return self._primary_storage.get_latest_version()
+        except BaseCoreDataSnapshotStorageException:
+            self._metrics['latest_version_misses'] += 1
+        return self._secondary_storage.get_latest_version()
+
+    def set_snapshot_by_version(self, version, snapshot):
+        self._primary_storage.set_snapshot_by_version(version, snapshot)
+        # the caller may patch the snapshot in place before it is uploaded
+        self._enqueue_write(
+            'set_snapshot_by_version', version, copy.deepcopy(snapshot))
+
+    def get_snapshot_by_version(self, version):
+        try:
+            snapshot = self._primary_storage.get_snapshot_by_version(version)
+        except SnapshotsLockedException:
+            raise
+        except BaseCoreDataSnapshotStorageException:
+            self._metrics['misses'] += 1
+        else:
+            self._metrics['hits'] += 1
+            return snapshot
+
+        snapshot = self._secondary_storage.get_snapshot_by_version(version)
+        try:
+            self._primary_storage.set_snapshot_by_version(
+                version, snapshot, ttl=self._fill_ttl)
+        except BaseCoreDataSnapshotStorageException:
+            self._metrics['fill_failures'] += 1
+        return snapshot
+
+    def set_patch_by_version(self, version, patch):
+        self._primary_storage.set_patch_by_version(version, patch)
+
+    def get_patch_by_version(self, version):
+        return self._primary_storage.get_patch_by_version(version)
+
+
+class FileCoreDataSnapshotStorage(BaseCoreDataSnapshotStorage):
+    # packed snapshots are written once per host and read through mmap, so
+    # that processes share them via the page cache; only the files of the
+    # keep_count latest versions are kept
+    def __init__(
+            self, storage, directory, snapshot_factory=Snapshot,
+            payload_serializer=None, keep_count=2):
+        self._storage = storage
+        self._directory = directory
+        self._snapshot_factory = snapshot_factory
+        self._keep_count = keep_count
+        self._snapshot_file_prefix = 'snapshot_'
+
+        self._payload_serializer = payload_serializer
+        if self._payload_serializer is None:
+            self._payload_serializer = storage.payload_serializer
+
+    @property
+    def storage(self):
+        return self._storage
+
+    def _get_snapshot_path_by_version(self, version):
+        return os.path.join(
+            self._directory, '%s%s' % (self._snapshot_file_prefix, version))
+
+    def _get_file_versions(self):
+        versions = set()
+        for name in os.listdir(self._directory):
+            if not name.startswith(self._snapshot_file_prefix):
+                continue
+            version = name[len(self._snapshot_file_prefix):]
+            if version.endswith('.lock'):
+                version = version[:-len('.lock')]
+            try:
+                versions.add(int(version))
+            except ValueError:
+                pass
+        return sorted(versions)
+
+    def _unlink_file(self, path):
+        try:
+            os.unlink(path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+    def _prune_snapshot_files(self, version):
+        # processes still mapping a removed file keep reading it until they
+        # unmap it
+        versions = [
+            file_version for file_version in self._get_file_versions()
+            if str(file_version) != str(version)]
+        removed_count = len(versions) - max(self._keep_count - 1, 0)
+        for file_version in versions[:max(removed_count, 0)]:
+            path = self._get_snapshot_path_by_version(file_version)
+            self._unlink_file(path)
+            self._unlink_file(path + '.lock')
+
+    def set_latest_version(self, version):
+        self._storage.set_latest_version(version)
+
+    def get_latest_version(self):
+        return self._storage.get_latest_version()
+
+    def set_snapshot_by_version(self, version, snapshot):
+        self._storage.set_snapshot_by_version(version, snapshot)
+        try:
+            self._unlink_file(self._get_snapshot_path_by_version(version))
+        except OSError as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+    def _write_snapshot_file(self, version, path):
+        packed_payload = self._storage.get_packed_snapshot_by_version(version)
+        fd, temp_path = tempfile.mkstemp(
+            prefix='.snapshot_', dir=self._directory)
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(packed_payload)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.rename(temp_path, path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+    def _ensure_snapshot_file(self, version):
+        path = self._get_snapshot_path_by_version(version)
+        if os.path.exists(path):
+            return path
+
+        with open(path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(path):
+                    return path
+                self._write_snapshot_file(version, path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self._prune_snapshot_files(version)
+        return path
+
+    def _read_snapshot_file(self, path):
+        with open(path, 'rb') as snapshot_file:
+            if not os.fstat(snapshot_file.fileno()).st_size:
+                return snapshot_file.read()
+            return mmap.mmap(
+                snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get_snapshot_by_version(self, version):
+        try:
+            path = self._ensure_snapshot_file(version)
+            packed_payload = self._read_snapshot_file(path)
+        except (IOError, OSError) as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+
+        # the mapping is not closed here since a lazy payload keeps reading
+        # it, it is unmapped once the last reference to it is dropped
+        try:
+            payload = self._payload_serializer.unpack(packed_payload)
+        except BasePayloadSerializerException as error:
+            raise BaseCoreDataSnapshotStorageException(error)
+        return self._snapshot_factory(version, payload)
+
+    def set_patch_by_version(self, version, patch):
+        self._storage.set_patch_by_version(version, patch)
+
+    def get_patch_by_version(self, version):
+        return self._storage.get_patch_by_version(version)
+
+
+class SnapshotRefresher(object):
+    # keeps the latest snapshot loaded in a background thread; a new
+    # version is loaded into the back snapshot, which is then swapped with
+    # the current one, so the previous snapshot gets patched in place on the
+    # next refresh and must not be held by readers for longer than that
+    #
+    # the snapshots lock lets one reader load per lock ttl, a refresh it
+    # rejects is retried after about lock_retry_interval (the storage's
+    # snapshots_lock_ttl) rather than on the next poll
+    def __init__(
+            self, storage, poll_interval=60.0, subscribe=True,
+            max_patches_count=10, wait_interval=1.0,
+            lock_retry_interval=5.0):
+        self._storage = storage
+        self._poll_interval = poll_interval
+        self._subscribe = subscribe
+        self._max_patches_count = max_patches_count
+        self._wait_interval = min(
+            wait_interval, poll_interval, lock_retry_interval)
+        self._lock_retry_interval = lock_retry_interval
+
+        self._snapshot = None
+        self._back_snapshot = None
+        self._refresh_lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self._metrics = collections.Counter()
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def metrics(self):
+        return dict(self._metrics)
+
+    def wait(self, timeout=None):
+        self._loaded.wait(timeout)
+        return self._snapshot
+
+    def _load_snapshot(self, snapshot, version):
+        if snapshot is not None and hasattr(self._storage, 'sync_snapshot'):
+            return self._storage.sync_snapshot(
+                snapshot, max_patches_count=self._max_patches_count)
+        return self._storage.get_snapshot_by_version(version)
+
+    def refresh(self):
+        with self._refresh_lock:
+            version = self._storage.get_latest_version()
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.version == version:
+                return False
+
+            new_snapshot = self._load_snapshot(self._back_snapshot, version)
+            self._back_snapshot = snapshot
+            self._snapshot = new_snapshot
+            self._loaded.set()
+            self._metrics['refreshes'] += 1
+            return True
+
+    def _try_refresh(self):
+        # returns when to try again
+        try:
+            self.refresh()
+        except SnapshotsLockedException:
+            self._metrics['refresh_lock_retries'] += 1
+            # jittered, so that the rejected readers do not all come back
+            # at once for the next lock
+            return time.time() + self._lock_retry_interval * random.uniform(
+                1.0, 1.5)
+        except BaseCoreDataSnapshotStorageException:
+            self._metrics['refresh_failures'] += 1
+        return time.time() + self._poll_interval
+
+    def _subscribe_latest_version(self):
+        if not self._subscribe or not hasattr(
+                self._storage, 'subscribe_latest_version'):
+            return None
+        try:
+            return self._storage.subscribe_latest_version()
+        except BaseCoreDataSnapshotStorageException:
+            self._metrics['subscription_failures'] += 1
+        return None
+
+    def _wait_for_notification(self, pubsub):
+        # returns whether a new version was announced, pubsub is closed and
+        # dropped on errors so that the refresher falls back to polling
+        try:
+            message = pubsub.get_message(timeout=self._wait_interval)
+        except redis.RedisError:
+            self._metrics['subscription_drops'] += 1
+            try:
+                pubsub.close()
+            except redis.RedisError:
+                pass
+            return False, None
+        return bool(message and message['type'] == 'message'), pubsub
+
+    def _run(self):
+        pubsub = None
+        next_poll_time = 0
+        while not self._stopped.is_set():
+            if pubsub is None:
+                pubsub = self._subscribe_latest_version()
+
+            notified = False
+            if pubsub is not None:
+                notified, pubsub = self._wait_for_notification(pubsub)
+            elif time.time() < next_poll_time:
+                self._stopped.wait(self._wait_interval)
+
+            if notified:
+                self._metrics['notifications'] += 1
+            if notified or time.time() >= next_poll_time:
+                next_poll_time = self._try_refresh()
+
+        if pubsub is not None:
+            try:
+                pubsub.close()
+            except redis.RedisError:
+                pass
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,310 @@
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import timeit
+
+import msgpack
+
+from .base import (
+    _get_payload_size,
+    lz4,
+    zstandard,
+    JsonPayloadSerializer,
+    MsgPackPayloadSerializer,
+    ZlibPayloadSerializer,
+    Lz4PayloadSerializer,
+    ZstdPayloadSerializer,
+    ParallelZlibPayloadSerializer,
+    ChainPayloadSerializer,
+    MsgPackZlibPayloadSerializer,
+    MsgPackZlibStreamPayloadSerializer,
+    FramedPayloadSerializer,
+    IndexedPayloadSerializer,
+    Snapshot,
+    CompactSnapshot,
+)
+
+
+def make_payload(
+        keys_count, depth=2, seed=0, nested_ratio=0.1, string_ratio=0.5):
+    rand = random.Random(seed)
+
+    def make_value(level):
+        if level < depth and rand.random() < nested_ratio:
+            return dict(
+                ('key_%d' % index, make_value(level + 1))
+                for index in xrange(10))
+        if rand.random() >= string_ratio:
+            return rand.randint(0, 1 << 30)
+        return 'value_%d' % rand.randint(0, 1 << 30)
+
+    return dict(
+        ('key_%d' % index, make_value(1)) for index in xrange(keys_count))
+
+
+def mutate_payload(payload, ratio=0.01, seed=0):
+    rand = random.Random(seed)
+    payload = dict(payload)
+    keys = sorted(payload)
+    changes_count = int(len(keys) * ratio)
+    for key in rand.sample(keys, changes_count):
+        if rand.random() < 0.2:
+            del payload[key]
+        else:
+            payload[key] = rand.randint(0, 1 << 30)
+    for index in xrange(changes_count // 5):
+        payload['new_key_%d' % index] = rand.randint(0, 1 << 30)
+    return payload
+
+
+def bench_make_patch(keys_count, ratio=0.01, repeat=3):
+    payload = make_payload(keys_count)
+    base_snapshot = Snapshot(1, payload)
+    new_snapshot = Snapshot(2, mutate_payload(payload, ratio))
+
+    timer = timeit.Timer(lambda: base_snapshot.make_patch(new_snapshot))
+    elapsed = min(timer.repeat(repeat, 1))
+
+    serializer = MsgPackZlibPayloadSerializer()
+    patch = base_snapshot.make_patch(new_snapshot)
+    patch_size = len(serializer.pack(patch.payload))
+    snapshot_size = len(serializer.pack(new_snapshot.payload))
+
+    return {
+        'keys_count': keys_count,
+        'changed_ratio': ratio,
+        'make_patch_seconds': elapsed,
+        'patch_size': patch_size,
+        'snapshot_size': snapshot_size,
+        'size_ratio': float(patch_size) / snapshot_size,
+    }
+
+
+def _get_rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def _run_in_child(function, *args):
+    # every measurement runs in a forked child so that it starts from the
+    # same heap and is not skewed by the previous one
+    results = multiprocessing.Queue()
+
+    def run():
+        results.put(function(*args))
+
+    process = multiprocessing.Process(target=run)
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def _measure_snapshot(snapshot_factory, packed_payload, lookups):
+    # compact snapshots are unpacked straight into their compact form
+    serializer = MsgPackZlibPayloadSerializer(
+        compact=issubclass(snapshot_factory, CompactSnapshot))
+    gc.collect()
+    rss_before = _get_rss()
+    snapshot = snapshot_factory(1, serializer.unpack(packed_payload))
+    gc.collect()
+    rss = _get_rss() - rss_before
+
+    payload = snapshot.payload
+    rand = random.Random(0)
+    keys = sorted(payload)
+    keys = [rand.choice(keys) for _ in xrange(lookups)]
+    timer = timeit.Timer(lambda: [payload[key] for key in keys])
+    elapsed = min(timer.repeat(3, 1))
+    return {
+        'rss_bytes': rss,
+        'payload_bytes': _get_payload_size(payload),
+        'lookup_seconds': elapsed / lookups,
+    }
+
+
+def _make_packed_payload(keys_count):
+    return MsgPackZlibPayloadSerializer().pack(make_payload(keys_count))
+
+
+def bench_snapshot_factory(snapshot_factory, keys_count, lookups=100000):
+    # the payload is built in another child, otherwise the measuring child
+    # inherits the memory freed after packing it and unpacking reuses it
+    packed_payload = _run_in_child(_make_packed_payload, keys_count)
+    result = _run_in_child(
+        _measure_snapshot, snapshot_factory, packed_payload, lookups)
+    result.update({
+        'factory': snapshot_factory.__name__,
+        'keys_count': keys_count,
+    })
+    return result
+
+
+def get_serializer_factories():
+    factories = [
+        ('json', JsonPayloadSerializer),
+        ('msgpack', MsgPackPayloadSerializer),
+        ('msgpack_zlib_stream', MsgPackZlibStreamPayloadSerializer),
+        ('framed', FramedPayloadSerializer),
+        ('indexed', IndexedPayloadSerializer),
+    ]
+    for level in (1, 6, 9):
+        factories.append(('json_zlib_%d' % level, lambda level=level: (
+            ChainPayloadSerializer((
+                JsonPayloadSerializer(), ZlibPayloadSerializer(level))))))
+        factories.append(('msgpack_zlib_%d' % level, lambda level=level: (
+            ChainPayloadSerializer((
+                MsgPackPayloadSerializer(), ZlibPayloadSerializer(level))))))
+    factories.append(('msgpack_parallel_zlib_1', lambda: (
+        ChainPayloadSerializer((
+            MsgPackPayloadSerializer(), ParallelZlibPayloadSerializer())))))
+    if lz4 is not None:
+        for level in (0, 9):
+            factories.append(('msgpack_lz4_%d' % level, lambda level=level: (
+                ChainPayloadSerializer((
+                    MsgPackPayloadSerializer(),
+                    Lz4PayloadSerializer(level))))))
+    if zstandard is not None:
+        for level in (1, 3, 9):
+            factories.append(('msgpack_zstd_%d' % level, lambda level=level: (
+                ChainPayloadSerializer((
+                    MsgPackPayloadSerializer(),
+                    ZstdPayloadSerializer(level))))))
+    return factories
+
+
+def _measure_peak_memory(function, *args):
+    gc.collect()
+    rss_before = _get_rss()
+    function(*args)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return max(peak_rss - rss_before, 0)
+
+
+def bench_serializer(name, serializer_factory, payload, repeat=3):
+    serializer = serializer_factory()
+    packed_payload = serializer.pack(payload)
+    # throughput is relative to the plain msgpack size of the payload so
+    # that it is comparable between serializers
+    payload_size = len(msgpack.packb(payload))
+
+    pack_seconds = min(timeit.Timer(
+        lambda: serializer.pack(payload)).repeat(repeat, 1))
+    unpack_seconds = min(timeit.Timer(
+        lambda: serializer.unpack(packed_payload)).repeat(repeat, 1))
+
+    return {
+        'serializer': name,
+        'payload_size': payload_size,
+        'packed_size': len(packed_payload),
+        'size_ratio': float(len(packed_payload)) / payload_size,
+        'pack_seconds': pack_seconds,
+        'unpack_seconds': unpack_seconds,
+        'pack_throughput': payload_size / pack_seconds,
+        'unpack_throughput': payload_size / unpack_seconds,
+        'pack_peak_memory': _run_in_child(
+            _measure_peak_memory, serializer.pack, payload),
+        'unpack_peak_memory': _run_in_child(
+            _measure_peak_memory, serializer.unpack, packed_payload),
+    }
+
+
+def bench_serializers(
+        keys_count, depth=2, nested_ratio=0.1, string_ratio=0.5, repeat=3,
+        names=None):
+    payload = make_payload(
+        keys_count, depth=depth, nested_ratio=nested_ratio,
+        string_ratio=string_ratio)
+    results = []
+    for name, serializer_factory in get_serializer_factories():
+        if names and name not in names:
+            continue
+        result = bench_serializer(name, serializer_factory, payload, repeat)
+        result.update({
+            'keys_count': keys_count,
+            'depth': depth,
+            'nested_ratio': nested_ratio,
+            'string_ratio': string_ratio,
+        })
+        results.append(result)
+    return results
+
+
+def _print_serializer_result(result):
+    print(
+        'serializer %(serializer)s keys=%(keys_count)d '
+        'size=%(packed_size)dB ratio=%(size_ratio).4f '
+        'pack=%(pack_throughput).0fB/s unpack=%(unpack_throughput).0fB/s '
+        'pack_peak=%(pack_peak_memory)dB '
+        'unpack_peak=%(unpack_peak_memory)dB' % result)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m core_data.benchmarks')
+    parser.add_argument(
+        '--suite', choices=('all', 'make_patch', 'snapshot', 'serializers'),
+        default='all')
+    parser.add_argument('--keys', type=int, action='append')
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--nested-ratio', type=float, default=0.1)
+    parser.add_argument('--string-ratio', type=float, default=0.5)
+    parser.add_argument('--serializer', action='append')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--json', action='store_true',
+        help='print all results as a single JSON document')
+    args = parser.parse_args(argv)
+
+    results = []
+
+    def report(suite, result, print_result):
+        result['suite'] = suite
+        results.append(result)
+        if not args.json:
+            print_result(result)
+
+    if args.suite in ('all', 'make_patch'):
+        for keys_count in args.keys or (1000, 10000, 100000, 300000):
+            report('make_patch', bench_make_patch(
+                keys_count, repeat=args.repeat), lambda result: print(
+                    'make_patch keys=%(keys_count)d '
+                    'time=%(make_patch_seconds).4fs '
+                    'patch=%(patch_size)dB snapshot=%(snapshot_size)dB '
+                    'ratio=%(size_ratio).4f' % result))
+
+    if args.suite in ('all', 'snapshot'):
+        for keys_count in args.keys or (10000, 100000, 300000):
+            for snapshot_factory in (Snapshot, CompactSnapshot):
+                report('snapshot', bench_snapshot_factory(
+                    snapshot_factory, keys_count), lambda result: print(
+                        'snapshot_factory %(factory)s keys=%(keys_count)d '
+                        'rss=%(rss_bytes)dB payload=%(payload_bytes)dB '
+                        'lookup=%(lookup_seconds).9fs' % result))
+
+    if args.suite in ('all', 'serializers'):
+        for keys_count in args.keys or (10000, 100000):
+            for result in bench_serializers(
+                    keys_count, depth=args.depth,
+                    nested_ratio=args.nested_ratio,
+                    string_ratio=args.string_ratio, repeat=args.repeat,
+                    names=args.serializer):
+                report('serializers', result, _print_serializer_result)
+
+    if args.json:
+        json.dump({
+            'python': platform.python_version(),
+            'msgpack': '.'.join(str(part) for part in msgpack.version),
+            'results': results,
+        }, sys.stdout, indent=2, sort_keys=True)
+        print('')
+
+
+if __name__ == '__main__':
+    main()
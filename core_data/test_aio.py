@@ -0,0 +1,179 @@
+import hashlib
+import sys
+import unittest
+
+if sys.version_info < (3, 8):
+    raise unittest.SkipTest('asyncio storages require Python 3.8+')
+
+import asyncio
+from unittest import mock
+
+import redis
+
+from .base import (
+    BaseCoreDataSnapshotStorageException,
+    ZlibPayloadSerializer,
+    Snapshot,
+)
+from .aio import (
+    AsyncCoreDataSnapshotStorage,
+    AsyncS3CoreDataSnapshotStorage,
+)
+
+
+class AsyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+
+class AsyncCoreDataSnapshotStorageTestCase(AsyncTestCase):
+    def _make_storage(self, **kwargs):
+        redis_conn = mock.Mock()
+        redis_conn.get = mock.AsyncMock()
+        redis_conn.set = mock.AsyncMock()
+        redis_conn.publish = mock.AsyncMock()
+        pipeline = redis_conn.pipeline.return_value
+        pipeline.execute = mock.AsyncMock()
+        kwargs.setdefault('ignore_snapshots_lock_once', False)
+        storage = AsyncCoreDataSnapshotStorage(
+            redis_conn, payload_serializer=ZlibPayloadSerializer(), **kwargs)
+        return storage, redis_conn
+
+    def test_latest_version(self):
+        storage, redis_conn = self._make_storage()
+        redis_conn.get.return_value = b'3'
+        self.assertEqual(self.run_async(storage.get_latest_version()), 3)
+
+        redis_conn.get.side_effect = redis.RedisError()
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            self.run_async, storage.get_latest_version())
+
+        self.run_async(storage.set_latest_version('4'))
+        redis_conn.set.assert_called_once_with('snapshot:latest_version', 4)
+        redis_conn.publish.assert_called_once_with(
+            'snapshot:latest_version:updates', 4)
+
+    def test_set_get_snapshot_by_version(self):
+        storage, redis_conn = self._make_storage()
+        pipeline = redis_conn.pipeline.return_value
+        self.run_async(
+            storage.set_snapshot_by_version(1, Snapshot(1, b'test')))
+        (key, packed_payload), (digest_key, digest) = [
+            call[0] for call in pipeline.set.call_args_list]
+        self.assertEqual(key, 'snapshot:1')
+        self.assertEqual(digest_key, 'snapshot:1:digest')
+        self.assertEqual(digest, hashlib.sha1(packed_payload).hexdigest())
+        pipeline.zadd.assert_called_once_with('snapshot:versions', {1: 1})
+
+        redis_lock_script = mock.AsyncMock()
+        redis_lock_script.return_value = [1, packed_payload]
+        redis_conn.register_script.return_value = redis_lock_script
+        snapshot = self.run_async(storage.get_snapshot_by_version(1))
+        self.assertEqual(snapshot.version, 1)
+        self.assertEqual(snapshot.payload, b'test')
+
+        redis_lock_script.return_value = [0]
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            self.run_async, storage.get_snapshot_by_version(1))
+
+    def test_default_payload_serializer(self):
+        redis_conn = mock.Mock()
+        redis_conn.get = mock.AsyncMock()
+        pipeline = redis_conn.pipeline.return_value
+        pipeline.execute = mock.AsyncMock()
+        storage = AsyncCoreDataSnapshotStorage(
+            redis_conn, ignore_snapshots_lock_always=True)
+        payload = {'a': 1, 'b': {'c': 'test'}, 'd': [1, 2]}
+        self.run_async(
+            storage.set_snapshot_by_version(1, Snapshot(1, payload)))
+        redis_conn.get.return_value = pipeline.set.call_args_list[0][0][1]
+
+        snapshot = self.run_async(storage.get_snapshot_by_version(1))
+        self.assertEqual(snapshot.payload, {
+            'a': 1, 'b': {'c': 'test'}, 'd': (1, 2)})
+
+    def test_get_snapshot_by_version_coalesced(self):
+        storage, redis_conn = self._make_storage(
+            ignore_snapshots_lock_always=True)
+        packed_payload = ZlibPayloadSerializer().pack(b'test')
+        future = self.loop.create_future()
+        redis_conn.get = mock.Mock(return_value=future)
+
+        tasks = [
+            self.loop.create_task(storage.get_snapshot_by_version(1))
+            for _ in range(3)]
+        self.loop.call_soon(future.set_result, packed_payload)
+        self.run_async(asyncio.wait(tasks))
+        snapshots = [task.result() for task in tasks]
+        self.assertEqual(redis_conn.get.call_count, 1)
+        self.assertIs(snapshots[0], snapshots[1])
+        self.assertEqual(snapshots[2].payload, b'test')
+
+        self.run_async(storage.get_snapshot_by_version(1))
+        self.assertEqual(redis_conn.get.call_count, 2)
+
+    def test_get_chunked_snapshot_by_version(self):
+        storage, redis_conn = self._make_storage(
+            ignore_snapshots_lock_always=True)
+        packed_payload = ZlibPayloadSerializer().pack(b'test' * 10)
+        chunks = [packed_payload[:10], packed_payload[10:]]
+        redis_conn.get.return_value = b'chunks:2:%d' % len(packed_payload)
+        redis_conn.pipeline.return_value.execute.return_value = chunks
+
+        snapshot = self.run_async(storage.get_patch_by_version(1))
+        self.assertEqual(snapshot.payload, b'test' * 10)
+        redis_conn.pipeline.return_value.hget.assert_called_with(
+            'snapshot:1:patch:chunks', 1)
+
+
+class AsyncS3CoreDataSnapshotStorageTestCase(AsyncTestCase):
+    def test_set_get_snapshot_by_version(self):
+        s3_client = mock.Mock()
+        s3_client.put_object = mock.AsyncMock()
+        s3_client.get_object = mock.AsyncMock()
+        storage = AsyncS3CoreDataSnapshotStorage(s3_client)
+
+        self.run_async(
+            storage.set_snapshot_by_version(1, Snapshot(1, b'test')))
+        put_kwargs = s3_client.put_object.call_args[1]
+        self.assertEqual(put_kwargs['Bucket'], 'unitcore')
+        self.assertEqual(put_kwargs['Key'], 'snapshots/snapshot_1')
+
+        body = mock.Mock()
+        body.read = mock.AsyncMock(return_value=put_kwargs['Body'])
+        s3_client.get_object.return_value = {'Body': body}
+        snapshot = self.run_async(storage.get_snapshot_by_version(1))
+        self.assertEqual(snapshot.payload, b'test')
+
+    def test_latest_version(self):
+        s3_client = mock.Mock()
+        s3_client.put_object = mock.AsyncMock()
+        s3_client.get_object = mock.AsyncMock()
+        storage = AsyncS3CoreDataSnapshotStorage(s3_client)
+
+        self.run_async(storage.set_latest_version('2'))
+        put_kwargs = s3_client.put_object.call_args[1]
+        self.assertEqual(put_kwargs['Key'], 'snapshots/latest_version')
+        self.assertEqual(put_kwargs['Body'], b'2')
+
+        body = mock.Mock()
+        body.read = mock.AsyncMock(return_value=b'2')
+        s3_client.get_object.return_value = {'Body': body, 'ETag': '"x"'}
+        self.assertEqual(self.run_async(storage.get_latest_version()), 2)
+        self.assertNotIn('IfNoneMatch', s3_client.get_object.call_args[1])
+
+        class NotModifiedError(Exception):
+            response = {'ResponseMetadata': {'HTTPStatusCode': 304}}
+
+        s3_client.get_object.side_effect = NotModifiedError()
+        with mock.patch('core_data.aio.S3_ERRORS', (NotModifiedError,)):
+            self.assertEqual(
+                self.run_async(storage.get_latest_version()), 2)
+        self.assertEqual(
+            s3_client.get_object.call_args[1]['IfNoneMatch'], '"x"')
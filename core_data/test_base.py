@@ -1,17 +1,461 @@
+import copy
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
 import unittest
 import mock
 
 import redis
+import boto.exception
 
 from .base import (
+    NULL_METRICS_SINK,
+    HistogramMetricsSink,
+    lz4,
+    zstandard,
+    BasePayloadSerializerException,
+    JsonPayloadSerializer,
+    MsgPackPayloadSerializer,
+    ZlibPayloadSerializer,
+    Lz4PayloadSerializer,
+    ZstdPayloadSerializer,
+    ParallelZlibPayloadSerializer,
+    train_zstd_dictionary,
+    MsgPackZlibPayloadSerializer,
+    MsgPackZlibStreamPayloadSerializer,
+    FramedPayloadSerializer,
+    IndexedPayloadSerializer,
     Snapshot,
+    SnapshotPatch,
+    squash_patches,
+    CompactMapping,
+    CompactSnapshot,
+    LazySnapshot,
     BaseCoreDataSnapshotStorageException,
+    SnapshotsLockedException,
+    KeepLastRetentionPolicy,
+    KeepNewerThanRetentionPolicy,
+    KeepEveryNthRetentionPolicy,
+    DummyCoreDataSnapshotStorage,
     RedisCoreDataSnapshotStorage,
     CompatCoreDataSnapshotStorage,
     CoreDataSnapshotStorage,
+    SegmentedCoreDataSnapshotStorage,
+    S3CoreDataSnapshotStorage,
+    CachedCoreDataSnapshotStorage,
+    TieredCoreDataSnapshotStorage,
+    FileCoreDataSnapshotStorage,
+    SnapshotRefresher,
+    _get_payload_size,
 )
 
 
+class HistogramMetricsSinkTestCase(unittest.TestCase):
+    def test_observe(self):
+        metrics_sink = HistogramMetricsSink()
+        for value in (0, 1, 2, 3, 100):
+            metrics_sink.observe('test', value)
+        metrics_sink.increment('count')
+        metrics_sink.increment('count', 2)
+
+        histogram = metrics_sink.get_histogram('test')
+        self.assertEqual(histogram['count'], 5)
+        self.assertEqual(histogram['sum'], 106)
+        self.assertEqual((histogram['min'], histogram['max']), (0, 100))
+        self.assertEqual(histogram['p50'], 4)
+        self.assertEqual(histogram['p99'], 100)
+        self.assertEqual(metrics_sink.get_counter('count'), 3)
+        self.assertIsNone(metrics_sink.get_histogram('missing'))
+
+        with metrics_sink.timer('timer'):
+            pass
+        self.assertEqual(
+            sorted(metrics_sink.summarize()['histograms']), ['test', 'timer'])
+
+        metrics_sink.reset()
+        self.assertEqual(
+            metrics_sink.summarize(), {'counters': {}, 'histograms': {}})
+
+        metrics_sink.observe('zero', 0)
+        metrics_sink.observe('zero', 0.0)
+        metrics_sink.observe('zero', 1)
+        self.assertEqual(metrics_sink.get_histogram('zero')['p50'], 0.0)
+
+    def test_serializers(self):
+        metrics_sink = HistogramMetricsSink()
+        serializer = MsgPackZlibPayloadSerializer()
+        serializer.set_metrics_sink(metrics_sink)
+        serializer.unpack(serializer.pack({'a': 'test' * 100}))
+
+        histograms = metrics_sink.summarize()['histograms']
+        self.assertEqual(sorted(histograms), [
+            'msgpack.decode', 'msgpack.encode', 'zlib.compress',
+            'zlib.compression_ratio', 'zlib.decompress'])
+        self.assertTrue(histograms['zlib.compression_ratio']['max'] < 1)
+        self.assertIs(MsgPackZlibPayloadSerializer().metrics_sink,
+                      NULL_METRICS_SINK)
+
+
+class ParallelZlibPayloadSerializerTestCase(unittest.TestCase):
+    def test_pack_unpack(self):
+        serializer = ParallelZlibPayloadSerializer(
+            block_size=100, concurrency=3)
+        payload = ''.join(str(index) for index in xrange(1000))
+        packed_payload = serializer.pack(payload)
+        self.assertTrue(
+            packed_payload.startswith(ParallelZlibPayloadSerializer.MAGIC))
+        self.assertEqual(serializer.unpack(packed_payload), payload)
+        self.assertEqual(
+            serializer.unpack(buffer(packed_payload)), payload)
+        self.assertEqual(serializer.unpack(serializer.pack('')), '')
+
+        self.assertEqual(
+            serializer.unpack(ZlibPayloadSerializer().pack(payload)),
+            payload)
+
+        framed_serializer = FramedPayloadSerializer(
+            serializers=(MsgPackPayloadSerializer(), serializer))
+        self.assertEqual(
+            FramedPayloadSerializer().unpack(
+                framed_serializer.pack({'a': payload})),
+            {'a': payload})
+
+    def test_unpack_invalid(self):
+        serializer = ParallelZlibPayloadSerializer(block_size=100)
+        packed_payload = serializer.pack('test' * 100)
+        for invalid_packed_payload in (
+                packed_payload[:-1], packed_payload[:6], 'test', None):
+            self.assertRaises(
+                BasePayloadSerializerException, serializer.unpack,
+                invalid_packed_payload)
+        self.assertRaises(
+            BasePayloadSerializerException, serializer.pack, None)
+
+
+class FramedPayloadSerializerTestCase(unittest.TestCase):
+    def test_pack_unpack(self):
+        payload = {'a': 1, 'b': ('test',)}
+        serializer = FramedPayloadSerializer()
+        packed_payload = serializer.pack(payload)
+        self.assertTrue(packed_payload.startswith(
+            FramedPayloadSerializer.MAGIC))
+        self.assertEqual(serializer.unpack(packed_payload), payload)
+
+        serializer = FramedPayloadSerializer(
+            (JsonPayloadSerializer(), ZlibPayloadSerializer(level=9)))
+        self.assertEqual(
+            FramedPayloadSerializer().unpack(serializer.pack(payload)),
+            {'a': 1, 'b': ['test']})
+
+    def test_legacy_payload(self):
+        payload = {'a': 1}
+        packed_payload = MsgPackZlibPayloadSerializer().pack(payload)
+        self.assertRaises(
+            BasePayloadSerializerException,
+            FramedPayloadSerializer().unpack, packed_payload)
+
+        serializer = FramedPayloadSerializer(
+            legacy_serializer=MsgPackZlibPayloadSerializer())
+        self.assertEqual(serializer.unpack(packed_payload), payload)
+
+    def test_unpack_error(self):
+        serializer = FramedPayloadSerializer()
+        self.assertRaises(
+            BasePayloadSerializerException,
+            serializer.unpack, FramedPayloadSerializer.MAGIC)
+        self.assertRaises(
+            BasePayloadSerializerException,
+            serializer.unpack, FramedPayloadSerializer.MAGIC + '\x01\xff')
+        self.assertRaises(
+            BasePayloadSerializerException,
+            FramedPayloadSerializer, [MsgPackZlibPayloadSerializer()])
+
+    @unittest.skipIf(lz4 is None, 'lz4 is not installed')
+    def test_lz4(self):
+        serializer = FramedPayloadSerializer(
+            (MsgPackPayloadSerializer(), Lz4PayloadSerializer()))
+        packed_payload = serializer.pack({'a': 1})
+        self.assertEqual(
+            FramedPayloadSerializer().unpack(packed_payload), {'a': 1})
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd_dictionary(self):
+        payloads = [
+            dict(('key_%d' % i, 'value_%d_%d' % (i, version))
+                 for i in xrange(1000))
+            for version in xrange(3)]
+        dictionary = train_zstd_dictionary(payloads, 4096)
+        serializer = FramedPayloadSerializer((
+            MsgPackPayloadSerializer(),
+            ZstdPayloadSerializer(level=3, dictionary=dictionary)))
+        packed_payload = serializer.pack(payloads[-1])
+        self.assertEqual(serializer.unpack(packed_payload), payloads[-1])
+
+        self.assertRaises(
+            BasePayloadSerializerException,
+            FramedPayloadSerializer().unpack, packed_payload)
+        reader = FramedPayloadSerializer(decoders=[
+            ZstdPayloadSerializer(dictionaries=[dictionary])])
+        self.assertEqual(reader.unpack(packed_payload), payloads[-1])
+
+
+class MsgPackZlibStreamPayloadSerializerTestCase(unittest.TestCase):
+    def test_unpack_stream(self):
+        serializer = MsgPackZlibStreamPayloadSerializer(read_size=8)
+        payload = dict(('key_%d' % i, 'value_%d' % i) for i in xrange(100))
+        packed_payload = serializer.pack(payload)
+        self.assertEqual(
+            packed_payload, MsgPackZlibPayloadSerializer().pack(payload))
+
+        packed_chunks = [
+            packed_payload[offset:offset + 10]
+            for offset in xrange(0, len(packed_payload), 10)]
+        self.assertEqual(serializer.unpack_stream(packed_chunks), payload)
+        self.assertEqual(serializer.unpack(packed_payload), payload)
+
+    def test_unpack_stream_error(self):
+        serializer = MsgPackZlibStreamPayloadSerializer()
+        self.assertRaises(
+            BasePayloadSerializerException, serializer.unpack, None)
+        self.assertRaises(
+            BasePayloadSerializerException, serializer.unpack, 'test')
+
+        packed_payload = serializer.pack(range(100))
+        self.assertRaises(
+            BasePayloadSerializerException,
+            serializer.unpack_stream, [packed_payload[:20]])
+        self.assertRaises(
+            BasePayloadSerializerException,
+            serializer.unpack, ZlibPayloadSerializer().pack('test'))
+
+    def test_unpack_stream_large(self):
+        # more than the 100MiB msgpack>=1.0 buffers by default
+        serializer = MsgPackZlibStreamPayloadSerializer()
+        packed_payload = serializer.pack({'a': 'a' * (101 * 1024 * 1024)})
+        payload = serializer.unpack(packed_payload)
+        self.assertEqual(len(payload['a']), 101 * 1024 * 1024)
+
+        serializer = MsgPackZlibStreamPayloadSerializer(
+            max_buffer_size=1024)
+        self.assertRaises(
+            BasePayloadSerializerException, serializer.unpack, packed_payload)
+
+
+class IndexedPayloadSerializerTestCase(unittest.TestCase):
+    def test_pack_unpack(self):
+        entry_serializer = MsgPackZlibPayloadSerializer()
+        serializer = IndexedPayloadSerializer(entry_serializer)
+        packed_payload = serializer.pack({'a': 1, 'b': {'c': (1, 2)}})
+
+        with mock.patch.object(
+                entry_serializer, 'unpack',
+                wraps=entry_serializer.unpack) as unpack:
+            payload = serializer.unpack(packed_payload)
+            self.assertEqual(sorted(payload), ['a', 'b'])
+            self.assertFalse(unpack.called)
+            self.assertEqual(payload['b'], {'c': (1, 2)})
+            self.assertEqual(payload['b'], {'c': (1, 2)})
+            self.assertEqual(unpack.call_count, 1)
+            self.assertIsNone(payload.get_packed_entry('b'))
+            self.assertIsNotNone(payload.get_packed_entry('a'))
+
+        self.assertRaises(KeyError, lambda: payload['x'])
+        payload['x'] = 2
+        del payload['a']
+        self.assertEqual(
+            dict(serializer.unpack(serializer.pack(payload))),
+            {'b': {'c': (1, 2)}, 'x': 2})
+
+    def test_unpack_invalid(self):
+        serializer = IndexedPayloadSerializer()
+        self.assertRaises(
+            BasePayloadSerializerException, serializer.unpack, 'test')
+        self.assertRaises(
+            BasePayloadSerializerException, serializer.unpack,
+            IndexedPayloadSerializer.MAGIC + '\x00')
+        self.assertRaises(
+            BasePayloadSerializerException, serializer.pack, 'test')
+
+    def test_lazy_snapshot(self):
+        serializer = IndexedPayloadSerializer()
+        base_snapshot = LazySnapshot(1, serializer.unpack(serializer.pack(
+            {'a': {'b': 1, 'c': 2}, 'd': 'test', 'e': 1})))
+        new_snapshot = LazySnapshot(2, serializer.unpack(serializer.pack(
+            {'a': {'b': 1, 'c': 3}, 'd': 'test', 'f': 2})))
+        patch = base_snapshot.make_patch(new_snapshot)
+        self.assertEqual(sorted(patch.added), [
+            (('a', 'c'), 3), (('f',), 2)])
+        self.assertEqual(patch.removed, [('e',)])
+        self.assertIsNotNone(base_snapshot.payload.get_packed_entry('d'))
+
+        base_snapshot.apply_patch(patch)
+        self.assertEqual(base_snapshot.version, 2)
+        self.assertEqual(
+            dict(base_snapshot.payload),
+            {'a': {'b': 1, 'c': 3}, 'd': 'test', 'f': 2})
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def test_make_patch(self):
+        base_snapshot = Snapshot(1, {
+            'a': 1,
+            'b': 'test',
+            'c': {'d': 1, 'e': {'f': 2}},
+            'g': (1, 2),
+        })
+        new_snapshot = Snapshot(2, {
+            'a': 1,
+            'b': 'new',
+            'c': {'d': 1, 'e': {'h': 3}},
+            'i': None,
+        })
+        patch = base_snapshot.make_patch(new_snapshot)
+        self.assertIsInstance(patch, SnapshotPatch)
+        self.assertEqual(patch.base_snapshot_version, 1)
+        self.assertEqual(patch.new_snapshot_version, 2)
+        self.assertEqual(sorted(patch.added), [
+            (('b',), 'new'),
+            (('c', 'e', 'h'), 3),
+            (('i',), None),
+        ])
+        self.assertEqual(sorted(patch.removed), [
+            ('c', 'e', 'f'),
+            ('g',),
+        ])
+
+    def test_make_patch_same_payload(self):
+        payload = {'a': {'b': 1}}
+        patch = Snapshot(1, payload).make_patch(Snapshot(2, dict(payload)))
+        self.assertEqual(list(patch.added), [])
+        self.assertEqual(patch.removed, [])
+
+    def test_make_patch_non_dict_payload(self):
+        patch = Snapshot(1, 'test').make_patch(Snapshot(2, {'a': 1}))
+        self.assertEqual(list(patch.added), [((), {'a': 1})])
+        self.assertEqual(patch.removed, [])
+
+    def test_apply_patch_failure(self):
+        payload = {'a': 1, 'b': {'c': 2}, 'd': 3}
+        snapshot = Snapshot(1, copy.deepcopy(payload))
+        patch = SnapshotPatch(1, {
+            'new_snapshot_version': 2,
+            'added': [(('b', 'c'), 4), (('e',), 5), (('a', 'f'), 6)],
+            'removed': [('d',), ('b', 'x')]})
+        self.assertRaises(TypeError, snapshot.apply_patch, patch)
+        self.assertEqual(snapshot.version, 1)
+        self.assertEqual(snapshot.payload, payload)
+
+        patch = SnapshotPatch(1, {
+            'new_snapshot_version': 2, 'added': [], 'removed': [('x', 'y')]})
+        self.assertRaises(KeyError, snapshot.apply_patch, patch)
+        self.assertEqual(snapshot.payload, payload)
+
+    def test_squash_patches(self):
+        def make_patch(base_version, added, removed):
+            return SnapshotPatch(base_version, {
+                'new_snapshot_version': base_version + 1,
+                'added': added, 'removed': removed})
+
+        base_payload = {'a': 1, 'b': {'c': 2}, 'd': 3, 'e': {'f': 4}}
+        patches = [
+            make_patch(1, [(('x',), {'y': 1}), (('a',), 2)], [('d',)]),
+            make_patch(2, [(('x', 'z'), 2), (('d',), 5)], [('b', 'c')]),
+            make_patch(3, [(('g',), 6)], [('x', 'y'), ('d',), ('e',)]),
+            make_patch(4, [(('e',), {'h': 7})], [('g',)]),
+        ]
+
+        snapshot = Snapshot(1, copy.deepcopy(base_payload))
+        for patch in patches:
+            snapshot.apply_patch(patch)
+        self.assertEqual(patches[0].payload['added'][0], (('x',), {'y': 1}))
+
+        squashed_patch = squash_patches(patches)
+        self.assertEqual(squashed_patch.base_snapshot_version, 1)
+        self.assertEqual(squashed_patch.new_snapshot_version, 5)
+        self.assertEqual(dict(squashed_patch.added), {
+            ('x',): {'z': 2}, ('a',): 2, ('e',): {'h': 7}})
+        self.assertEqual(
+            sorted(squashed_patch.removed),
+            [('b', 'c'), ('d',), ('e',), ('g',)])
+
+        squashed_snapshot = Snapshot(1, copy.deepcopy(base_payload))
+        squashed_snapshot.apply_patch(squashed_patch)
+        self.assertEqual(squashed_snapshot.version, 5)
+        self.assertEqual(squashed_snapshot.payload, snapshot.payload)
+
+        whole_patch = make_patch(5, [((), {'a': 1})], [('a',)])
+        squashed_patch = squash_patches(patches + [whole_patch])
+        self.assertEqual(list(squashed_patch.added), [((), {'a': 1})])
+        self.assertEqual(squashed_patch.removed, [])
+
+        self.assertRaises(ValueError, squash_patches, [])
+
+
+class CompactSnapshotTestCase(unittest.TestCase):
+    def test_payload(self):
+        payload = {
+            'a': 1,
+            'b': u'test',
+            'c': {'d': (1, 2, 3), 'e': (0.5, 1.5), 'f': (True, False)},
+            'g': (u'test', {'h': None}),
+        }
+        snapshot = CompactSnapshot(1, payload)
+        compact = snapshot.payload
+        self.assertIsInstance(compact, CompactMapping)
+        self.assertEqual(snapshot.version, 1)
+        self.assertEqual(compact['a'], 1)
+        self.assertEqual(compact.get('x', 2), 2)
+        self.assertNotIn('x', compact)
+        self.assertRaises(KeyError, lambda: compact['x'])
+        self.assertEqual(list(compact), ['a', 'b', 'c', 'g'])
+        self.assertEqual(len(compact), 4)
+        self.assertEqual(compact['c']['d'], (1, 2, 3))
+        self.assertIsInstance(compact['c']['d'], tuple)
+        self.assertEqual(compact['c']['e'], (0.5, 1.5))
+        self.assertEqual(compact['c']['f'], (True, False))
+        self.assertIs(compact['b'], compact['g'][0])
+        self.assertEqual(compact['g'][1], {'h': None})
+        self.assertEqual(dict(compact.iteritems())['a'], 1)
+        self.assertEqual(compact, payload)
+        self.assertEqual(
+            MsgPackPayloadSerializer().pack(compact['c']['d']),
+            MsgPackPayloadSerializer().pack((1, 2, 3)))
+
+    def test_compact_unpack(self):
+        payload = {
+            'a': 1,
+            'b': u'test',
+            'c': {'d': [1, 2, 3], 'e': [0.5, 1.5], 'f': [True, False]},
+            'g': [u'test', {'h': None}],
+        }
+        for serializer in (
+                MsgPackPayloadSerializer(compact=True),
+                MsgPackZlibStreamPayloadSerializer(compact=True)):
+            compact = serializer.unpack(serializer.pack(payload))
+            self.assertIsInstance(compact, CompactMapping)
+            self.assertIsInstance(compact['c'], CompactMapping)
+            self.assertEqual(list(compact), ['a', 'b', 'c', 'g'])
+            self.assertEqual(compact['c']['d'], (1, 2, 3))
+            self.assertEqual(compact['c']['e'], (0.5, 1.5))
+            self.assertEqual(compact['c']['f'], (True, False))
+            self.assertIs(compact['b'], compact['g'][0])
+            self.assertEqual(compact['g'][1], {'h': None})
+
+            snapshot = CompactSnapshot(1, compact)
+            self.assertIs(snapshot.payload, compact)
+            self.assertEqual(compact, CompactSnapshot(1, payload).payload)
+
+    def test_apply_patch(self):
+        snapshot = CompactSnapshot(1, {'a': 1})
+        patch = SnapshotPatch(1, {
+            'new_snapshot_version': 2, 'added': [(('a',), 2)],
+            'removed': []})
+        self.assertRaises(TypeError, snapshot.apply_patch, patch)
+
+
 class RedisCoreDataSnapshotStorageTestCase(unittest.TestCase):
     def test_latest_version_redis_error(self):
         redis_conn = mock.Mock()
@@ -69,6 +513,50 @@ class RedisCoreDataSnapshotStorageTestCase(unittest.TestCase):
         redis_conn.set.side_effect = None
         storage.set_latest_version(2)
         self.assertEqual(redis_conn.set.call_args[0][1], 2)
+        redis_conn.publish.assert_called_once_with(
+            'last_export_date:updates', 2)
+
+    def test_subscribe_latest_version(self):
+        redis_conn = mock.Mock()
+        storage = RedisCoreDataSnapshotStorage(redis_conn)
+        pubsub = storage.subscribe_latest_version()
+        self.assertIs(pubsub, redis_conn.pubsub.return_value)
+        pubsub.subscribe.assert_called_once_with('last_export_date:updates')
+
+        pubsub.subscribe.side_effect = redis.RedisError()
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.subscribe_latest_version)
+
+    def test_metrics_sink(self):
+        redis_conn = mock.Mock()
+        redis_lock_script = mock.Mock()
+        redis_conn.register_script.return_value = redis_lock_script
+        metrics_sink = HistogramMetricsSink()
+        storage = RedisCoreDataSnapshotStorage(
+            redis_conn, snapshots_lock_ttl=5,
+            ignore_snapshots_lock_once=False, metrics_sink=metrics_sink)
+        self.assertIs(storage.metrics_sink, metrics_sink)
+        self.assertIs(storage.payload_serializer.metrics_sink, metrics_sink)
+
+        storage.set_snapshot_by_version(1, Snapshot(1, 'test' * 100))
+        packed_payload = redis_conn.set.call_args[0][1]
+        redis_lock_script.return_value = [1, packed_payload]
+        storage.get_snapshot_by_version(1)
+        redis_lock_script.return_value = [0]
+        self.assertRaises(
+            SnapshotsLockedException, storage.get_snapshot_by_version, 1)
+
+        summary = metrics_sink.summarize()
+        self.assertEqual(summary['counters'], {'redis.lock_rejections': 1})
+        histograms = summary['histograms']
+        self.assertEqual(histograms['redis.read']['count'], 2)
+        self.assertEqual(histograms['redis.write']['count'], 1)
+        self.assertEqual(
+            histograms['redis.bytes_in']['sum'], len(packed_payload))
+        self.assertEqual(
+            histograms['redis.bytes_out']['sum'], len(packed_payload))
+        self.assertEqual(histograms['zlib.decompress']['count'], 1)
 
     def test_snapshots_lock_error(self):
         redis_conn = mock.Mock()
@@ -100,21 +588,24 @@ class RedisCoreDataSnapshotStorageTestCase(unittest.TestCase):
             BaseCoreDataSnapshotStorageException,
             storage.get_snapshot_by_version, 1)
 
+        redis_lock_script.return_value = [0]
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_snapshot_by_version, 1)
+        self.assertFalse(redis_conn.get.called)
+
     def test_snapshot_error(self):
         redis_conn = mock.Mock()
-        redis_lock_script = mock.Mock()
-        redis_lock_script.return_value = True
-        redis_conn.register_script.return_value = redis_lock_script
         redis_conn.get.side_effect = redis.RedisError()
         storage = RedisCoreDataSnapshotStorage(
-            redis_conn, snapshots_lock_ttl=5,
-            ignore_snapshots_lock_once=False)
+            redis_conn, snapshots_lock_ttl=5)
         self.assertRaises(
             BaseCoreDataSnapshotStorageException,
             storage.get_snapshot_by_version, 1)
 
-        redis_conn.get.side_effect = None
-        redis_conn.get.return_value = None
+        redis_lock_script = mock.Mock()
+        redis_lock_script.return_value = [1]
+        redis_conn.register_script.return_value = redis_lock_script
         self.assertRaises(
             BaseCoreDataSnapshotStorageException,
             storage.get_snapshot_by_version, 1)
@@ -147,13 +638,16 @@ class RedisCoreDataSnapshotStorageTestCase(unittest.TestCase):
         self.assertEqual(len(redis_conn.set.call_args[0]), 2)
         packed_snapshot = redis_conn.set.call_args[0][1]
         redis_lock_script = mock.Mock()
-        redis_lock_script.return_value = True
+        redis_lock_script.return_value = [1, packed_snapshot]
         redis_conn.register_script.return_value = redis_lock_script
-        redis_conn.get.return_value = packed_snapshot
 
         snapshot = storage.get_snapshot_by_version(1)
         self.assertEqual(snapshot.version, 1)
         self.assertEqual(snapshot.payload, 'test')
+        self.assertEqual(
+            redis_lock_script.call_args[1]['keys'],
+            ('snapshots_lock', 'core_data'))
+        self.assertFalse(redis_conn.get.called)
 
     def test_set_get_snapshot_by_version_ignore_lock(self):
         redis_conn = mock.Mock()
@@ -177,6 +671,54 @@ class RedisCoreDataSnapshotStorageTestCase(unittest.TestCase):
             BaseCoreDataSnapshotStorageException,
             storage.get_snapshot_by_version, 1)
 
+    def test_get_packed_snapshot_by_version(self):
+        redis_conn = mock.Mock()
+        redis_conn.get.return_value = 'packed'
+        storage = RedisCoreDataSnapshotStorage(
+            redis_conn, snapshots_lock_ttl=5,
+            ignore_snapshots_lock_always=True)
+        self.assertEqual(storage.get_packed_snapshot_by_version(1), 'packed')
+
+        redis_conn.get.return_value = None
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_packed_snapshot_by_version, 1)
+
+    def test_set_get_chunked_snapshot_by_version(self):
+        redis_conn = mock.Mock()
+        pipeline = redis_conn.pipeline.return_value
+        storage = RedisCoreDataSnapshotStorage(
+            redis_conn, snapshots_lock_ttl=5,
+            ignore_snapshots_lock_always=True,
+            payload_serializer=MsgPackZlibPayloadSerializer(),
+            chunk_size=16)
+
+        snapshot = Snapshot(1, dict(('key_%d' % i, i) for i in xrange(20)))
+        storage.set_snapshot_by_version(1, snapshot)
+        self.assertFalse(redis_conn.set.called)
+        pipeline.delete.assert_called_once_with('core_data:chunks')
+        chunks = [call[0][2] for call in pipeline.hset.call_args_list]
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(len(chunk) <= 16 for chunk in chunks))
+        manifest_key, manifest = pipeline.set.call_args[0]
+        self.assertEqual(manifest_key, 'core_data')
+
+        redis_conn.get.return_value = manifest
+        pipeline.execute.return_value = chunks
+        self.assertEqual(
+            storage.get_snapshot_by_version(1).payload, snapshot.payload)
+        self.assertEqual(pipeline.hget.call_count, len(chunks))
+
+        pipeline.execute.return_value = chunks[:-1] + [None]
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_snapshot_by_version, 1)
+
+        redis_conn.get.return_value = 'chunks:test'
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_snapshot_by_version, 1)
+
 
 class CompatCoreDataSnapshotStorageTestCase(unittest.TestCase):
     def test_set_snapshot_by_version_error(self):
@@ -197,14 +739,12 @@ class CompatCoreDataSnapshotStorageTestCase(unittest.TestCase):
         compat_storage = CompatCoreDataSnapshotStorage(
             redis_conn, snapshots_lock_ttl=5,
             ignore_snapshots_lock_once=False)
-        redis_lock_script = mock.Mock()
-        redis_lock_script.return_value = True
-        redis_conn.register_script.return_value = redis_lock_script
-        redis_conn.get.return_value = 'test'
         snapshot = Snapshot(1, 'test')
         redis_storage.set_snapshot_by_version(1, snapshot)
         packed_snapshot = redis_conn.set.call_args[0][1]
-        redis_conn.get.return_value = packed_snapshot
+        redis_lock_script = mock.Mock()
+        redis_lock_script.return_value = [1, packed_snapshot]
+        redis_conn.register_script.return_value = redis_lock_script
         self.assertRaises(
             BaseCoreDataSnapshotStorageException,
             compat_storage.get_snapshot_by_version, 1)
@@ -221,9 +761,8 @@ class CompatCoreDataSnapshotStorageTestCase(unittest.TestCase):
         self.assertEqual(len(redis_conn.set.call_args[0]), 2)
         packed_snapshot = redis_conn.set.call_args[0][1]
         redis_lock_script = mock.Mock()
-        redis_lock_script.return_value = True
+        redis_lock_script.return_value = [1, packed_snapshot]
         redis_conn.register_script.return_value = redis_lock_script
-        redis_conn.get.return_value = packed_snapshot
 
         snapshot = storage.get_snapshot_by_version(1)
         self.assertEqual(snapshot.version, 1)
@@ -231,29 +770,101 @@ class CompatCoreDataSnapshotStorageTestCase(unittest.TestCase):
 
 
 class CoreDataSnapshotStorageTestCase(unittest.TestCase):
+    def test_set_snapshot_by_version(self):
+        redis_conn = mock.Mock()
+        pipeline = redis_conn.pipeline.return_value
+        storage = CoreDataSnapshotStorage(
+            redis_conn, snapshots_lock_ttl=5,
+            ignore_snapshots_lock_once=False)
+        storage.set_snapshot_by_version('3', Snapshot(3, 'test'))
+        self.assertEqual(
+            [call[0][0] for call in pipeline.set.call_args_list],
+            ['snapshot:3', 'snapshot:3:digest'])
+        pipeline.zadd.assert_called_once_with('snapshot:versions', {3: 3})
+        self.assertTrue(pipeline.execute.called)
+
+        pipeline.reset_mock()
+        storage.set_snapshot_by_version(4, Snapshot(4, 'test'), ttl=60)
+        self.assertEqual(pipeline.set.call_args_list[0][1], {'ex': 60})
+        self.assertFalse(pipeline.zadd.called)
+
+        pipeline.execute.side_effect = redis.RedisError('')
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.set_snapshot_by_version, 3, Snapshot(3, 'test'))
+
     def test_get_all_versions(self):
         redis_conn = mock.Mock()
-        redis_conn.keys.return_value = [
+        redis_conn.zrange.return_value = ['1', '3', '5']
+        redis_conn.zrange.side_effect = redis.RedisError('')
+        storage = CoreDataSnapshotStorage(
+            redis_conn, snapshots_lock_ttl=5,
+            ignore_snapshots_lock_once=False)
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException, storage.get_all_versions)
+
+        redis_conn.zrange.side_effect = None
+        self.assertEqual(storage.get_all_versions(), [1, 3, 5])
+        redis_conn.zrange.assert_called_with('snapshot:versions', 0, -1)
+
+    def test_get_latest_versions(self):
+        redis_conn = mock.Mock()
+        redis_conn.zrevrange.return_value = ['5', '3']
+        storage = CoreDataSnapshotStorage(
+            redis_conn, snapshots_lock_ttl=5,
+            ignore_snapshots_lock_once=False)
+        self.assertEqual(storage.get_latest_versions(0), [])
+        self.assertFalse(redis_conn.zrevrange.called)
+        self.assertEqual(storage.get_latest_versions(2), [3, 5])
+        redis_conn.zrevrange.assert_called_with('snapshot:versions', 0, 1)
+
+    def test_get_versions_in_range(self):
+        redis_conn = mock.Mock()
+        redis_conn.zrangebyscore.return_value = ['2', '3']
+        storage = CoreDataSnapshotStorage(
+            redis_conn, snapshots_lock_ttl=5,
+            ignore_snapshots_lock_once=False)
+        self.assertEqual(storage.get_versions_in_range(2, 4), [2, 3])
+        redis_conn.zrangebyscore.assert_called_with(
+            'snapshot:versions', 2, 4)
+
+        redis_conn.zrangebyscore.side_effect = redis.RedisError('')
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_versions_in_range, 2, 4)
+
+    def test_migrate_versions_index(self):
+        redis_conn = mock.Mock()
+        redis_conn.scan_iter.return_value = iter([
             'snapshot:5',
             'snapshot:latest_version',
+            'snapshot:versions',
             'snapshot:1',
             'snapshot:test',
             'snapshot:2:patch',
             'snapshot:3'
-        ]
-        redis_conn.keys.side_effect = redis.RedisError('')
+        ])
         storage = CoreDataSnapshotStorage(
             redis_conn, snapshots_lock_ttl=5,
             ignore_snapshots_lock_once=False)
-        self.assertRaises(
-            BaseCoreDataSnapshotStorageException, storage.get_all_versions)
+        self.assertEqual(
+            storage.migrate_versions_index(batch_size=2), [1, 3, 5])
+        self.assertEqual(redis_conn.scan_iter.call_args[1]['match'],
+                         'snapshot:*')
+        self.assertEqual(
+            [call[0] for call in redis_conn.zadd.call_args_list],
+            [('snapshot:versions', {1: 1, 3: 3}),
+             ('snapshot:versions', {5: 5})])
 
-        redis_conn.keys.side_effect = None
-        self.assertEqual(storage.get_all_versions(), [1, 3, 5])
+        redis_conn.scan_iter.side_effect = redis.RedisError('')
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.migrate_versions_index)
 
     def test_remove_snapshots_and_patches_by_versions(self):
         redis_conn = mock.Mock()
-        redis_conn.delete.side_effect = redis.RedisError('')
+        pipeline = redis_conn.pipeline.return_value
+        pipeline.execute.side_effect = redis.RedisError('')
         storage = CoreDataSnapshotStorage(
             redis_conn, snapshots_lock_ttl=5,
             ignore_snapshots_lock_once=False)
@@ -261,11 +872,1277 @@ class CoreDataSnapshotStorageTestCase(unittest.TestCase):
             BaseCoreDataSnapshotStorageException,
             storage.remove_snapshots_and_patches_by_versions, [1, 2, 3])
 
-        redis_conn.delete.side_effect = None
-        redis_conn.delete.reset_mock()
+        pipeline.execute.side_effect = None
+        pipeline.reset_mock()
         storage.remove_snapshots_and_patches_by_versions([])
-        self.assertFalse(redis_conn.delete.called)
+        self.assertFalse(pipeline.unlink.called)
 
-        redis_conn.delete.reset_mock()
+        pipeline.reset_mock()
         storage.remove_snapshots_and_patches_by_versions([1, 2, 3])
-        self.assertTrue(redis_conn.delete.called)
+        self.assertTrue(pipeline.unlink.called)
+        self.assertIn('snapshot:1:patch', pipeline.unlink.call_args[0])
+        self.assertIn(
+            'snapshot:1:squashed_patch', pipeline.unlink.call_args[0])
+        pipeline.zrem.assert_called_once_with('snapshot:versions', 1, 2, 3)
+        self.assertTrue(pipeline.execute.called)
+
+        pipeline.reset_mock()
+        storage.remove_snapshots_and_patches_by_versions(
+            [1, 2, 3], batch_size=2)
+        self.assertEqual(
+            [call[0] for call in pipeline.zrem.call_args_list],
+            [('snapshot:versions', 1, 2), ('snapshot:versions', 3)])
+
+    def test_collect_garbage(self):
+        redis_conn = mock.Mock()
+        redis_conn.zrange.return_value = [str(v) for v in xrange(1, 11)]
+        pipeline = redis_conn.pipeline.return_value
+        storage = CoreDataSnapshotStorage(
+            redis_conn, snapshots_lock_ttl=5,
+            ignore_snapshots_lock_once=False)
+
+        def execute():
+            if pipeline.exists.called and not pipeline.unlink.called:
+                # patches exist for versions 8 and 9 only
+                return [False, True, True]
+            return [10] * len(pipeline.memory_usage.call_args_list) + [1, 1]
+        pipeline.execute.side_effect = execute
+
+        result = storage.collect_garbage([
+            KeepLastRetentionPolicy(2),
+            KeepNewerThanRetentionPolicy(10),
+            KeepEveryNthRetentionPolicy(4),
+        ], max_patch_chain_length=3, batch_size=100)
+        self.assertEqual(result.removed_versions, [1, 3, 4, 5, 7])
+        self.assertEqual(result.reclaimed_bytes, 10 * 7 * 5)
+        pipeline.zrem.assert_called_once_with(
+            'snapshot:versions', 1, 3, 4, 5, 7)
+
+    def test_collect_garbage_dry_run(self):
+        redis_conn = mock.Mock()
+        redis_conn.zrange.return_value = ['1', '2', '3']
+        pipeline = redis_conn.pipeline.return_value
+        pipeline.execute.return_value = [False]
+        storage = CoreDataSnapshotStorage(
+            redis_conn, snapshots_lock_ttl=5,
+            ignore_snapshots_lock_once=False)
+        result = storage.collect_garbage(
+            [KeepLastRetentionPolicy(0)], max_patch_chain_length=1,
+            dry_run=True)
+        self.assertEqual(result.removed_versions, [1, 2])
+        self.assertEqual(result.reclaimed_bytes, 0)
+        self.assertFalse(pipeline.unlink.called)
+
+        redis_conn.zrange.return_value = []
+        self.assertEqual(storage.collect_garbage([]), ([], 0))
+
+    def test_publish(self):
+        redis_conn = mock.Mock()
+        redis_publish_script = mock.Mock()
+        redis_publish_script.return_value = 1
+        redis_conn.register_script.return_value = redis_publish_script
+        storage = CoreDataSnapshotStorage(
+            redis_conn, snapshots_lock_ttl=5,
+            ignore_snapshots_lock_once=False)
+
+        snapshot_1 = Snapshot(1, {'a': 1})
+        snapshot_2 = Snapshot(2, {'a': 2, 'b': 'test'})
+        storage.publish(
+            '2', snapshot_2, patch=snapshot_1.make_patch(snapshot_2),
+            expected_version=1)
+        keys = redis_publish_script.call_args[1]['keys']
+        args = redis_publish_script.call_args[1]['args']
+        self.assertEqual(
+            keys[:2], ['snapshot:latest_version', 'snapshot:versions'])
+        self.assertEqual(args[:2], ['1', 2])
+
+        self.assertEqual(args[2], 'snapshot:latest_version:updates')
+
+        values = {}
+        args = args[3:]
+        for key in keys[2:]:
+            command, arguments_count = args[:2]
+            command_args = args[2:2 + arguments_count]
+            args = args[2 + arguments_count:]
+            if command == 'del':
+                values.pop(key, None)
+            elif command == 'hset':
+                values.setdefault(key, {})[command_args[0]] = command_args[1]
+            else:
+                values[key] = command_args[0]
+        self.assertEqual(args, [])
+        self.assertEqual(sorted(values), [
+            'snapshot:1:patch', 'snapshot:2', 'snapshot:2:digest'])
+        self.assertEqual(
+            values['snapshot:2:digest'],
+            hashlib.sha1(values['snapshot:2']).hexdigest())
+
+        redis_publish_script.return_value = 0
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.publish, 3, Snapshot(3, {}), expected_version=1)
+        self.assertEqual(
+            redis_publish_script.call_args[1]['args'][:2], ['1', 3])
+
+        redis_publish_script.side_effect = redis.RedisError()
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.publish, 3, Snapshot(3, {}))
+        self.assertEqual(
+            redis_publish_script.call_args[1]['args'][:2], ['', 3])
+
+    def test_publish_chunked(self):
+        redis_conn = mock.Mock()
+        pipeline = redis_conn.pipeline.return_value
+        pipeline.get.return_value = '1'
+        storage = CoreDataSnapshotStorage(
+            redis_conn, snapshots_lock_ttl=5,
+            ignore_snapshots_lock_once=False, chunk_size=4)
+
+        snapshot_1 = Snapshot(1, {'a': 1})
+        snapshot_2 = Snapshot(2, {'a': 2, 'b': 'test'})
+        storage.publish(
+            '2', snapshot_2, patch=snapshot_1.make_patch(snapshot_2),
+            expected_version=1)
+        self.assertFalse(redis_conn.register_script.called)
+        pipeline.watch.assert_called_once_with('snapshot:latest_version')
+        self.assertTrue(pipeline.multi.called)
+        pipeline.zadd.assert_called_once_with('snapshot:versions', {2: 2})
+        pipeline.set.assert_called_once_with('snapshot:latest_version', 2)
+        pipeline.publish.assert_called_once_with(
+            'snapshot:latest_version:updates', 2)
+        self.assertTrue(pipeline.execute.called)
+        self.assertTrue(pipeline.reset.called)
+
+        chunks = {}
+        for call in pipeline.execute_command.call_args_list:
+            command, key = call[0][:2]
+            if command == 'hset':
+                self.assertLessEqual(len(call[0][3]), 4)
+                chunks.setdefault(key, {})[call[0][2]] = call[0][3]
+        packed_payload = ''.join(
+            chunk for _, chunk in sorted(chunks['snapshot:2:chunks'].items()))
+        self.assertEqual(
+            storage.payload_serializer.unpack(packed_payload),
+            snapshot_2.payload)
+
+        pipeline.get.return_value = '3'
+        pipeline.execute.reset_mock()
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.publish, 3, Snapshot(3, {}), expected_version=1)
+        self.assertFalse(pipeline.execute.called)
+
+        pipeline.get.return_value = '1'
+        pipeline.execute.side_effect = redis.WatchError()
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.publish, 3, Snapshot(3, {}), expected_version=1)
+
+        pipeline.execute.side_effect = redis.RedisError()
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.publish, 3, Snapshot(3, {}))
+
+    def test_get_snapshot_if_changed(self):
+        redis_conn = mock.Mock()
+        redis_get_if_changed_script = mock.Mock()
+        redis_conn.register_script.return_value = redis_get_if_changed_script
+        storage = CoreDataSnapshotStorage(
+            redis_conn, snapshots_lock_ttl=5,
+            ignore_snapshots_lock_once=False)
+        packed_payload = storage.payload_serializer.pack({'a': 1})
+        digest = hashlib.sha1(packed_payload).hexdigest()
+
+        redis_get_if_changed_script.return_value = [1, digest, packed_payload]
+        result = storage.get_snapshot_if_changed('3')
+        self.assertTrue(result.modified)
+        self.assertEqual(result.snapshot.version, 3)
+        self.assertEqual(result.snapshot.payload, {'a': 1})
+        self.assertEqual(result.digest, digest)
+        self.assertEqual(redis_get_if_changed_script.call_args[1]['keys'], (
+            'snapshot:3:digest', 'snapshot:3', 'snapshots_lock'))
+        self.assertEqual(
+            redis_get_if_changed_script.call_args[1]['args'], ('', 5))
+
+        redis_get_if_changed_script.return_value = [0]
+        result = storage.get_snapshot_if_changed(3, digest)
+        self.assertEqual(result, (False, None, digest))
+        self.assertEqual(
+            redis_get_if_changed_script.call_args[1]['args'], (digest, 5))
+
+        redis_get_if_changed_script.return_value = [2]
+        self.assertRaises(
+            SnapshotsLockedException,
+            storage.get_snapshot_if_changed, 3, 'outdated')
+
+        redis_get_if_changed_script.return_value = [1, '']
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_snapshot_if_changed, 3, 'outdated')
+
+        redis_get_if_changed_script.return_value = [
+            1, '', 'chunks:2:%d' % len(packed_payload)]
+        redis_conn.pipeline.return_value.execute.return_value = [
+            packed_payload[:5], packed_payload[5:]]
+        result = storage.get_snapshot_if_changed(3, 'outdated')
+        self.assertEqual(result.snapshot.payload, {'a': 1})
+        self.assertIsNone(result.digest)
+
+        redis_get_if_changed_script.side_effect = redis.RedisError()
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_snapshot_if_changed, 3, digest)
+
+    def test_get_snapshots_by_versions(self):
+        redis_conn = mock.Mock()
+        redis_lock_mget_script = mock.Mock()
+        redis_conn.register_script.return_value = redis_lock_mget_script
+        storage = CoreDataSnapshotStorage(
+            redis_conn, snapshots_lock_ttl=5,
+            ignore_snapshots_lock_once=False)
+        serializer = storage.payload_serializer
+        packed_payloads = [
+            serializer.pack({'a': version}) for version in (1, 2, 3)]
+        chunks = [packed_payloads[1][:5], packed_payloads[1][5:]]
+        redis_lock_mget_script.return_value = [1, [
+            packed_payloads[0],
+            'chunks:2:%d' % len(packed_payloads[1]),
+            packed_payloads[2]]]
+        pipeline = redis_conn.pipeline.return_value
+        pipeline.execute.return_value = chunks
+
+        snapshots = storage.get_snapshots_by_versions(['1', 2, 3])
+        self.assertEqual(
+            [snapshot.version for snapshot in snapshots], [1, 2, 3])
+        self.assertEqual(
+            [snapshot.payload for snapshot in snapshots],
+            [{'a': 1}, {'a': 2}, {'a': 3}])
+        self.assertEqual(redis_lock_mget_script.call_count, 1)
+        self.assertEqual(redis_lock_mget_script.call_args[1]['keys'], [
+            'snapshots_lock', 'snapshot:1', 'snapshot:2', 'snapshot:3'])
+        self.assertEqual(pipeline.hget.call_args_list, [
+            mock.call('snapshot:2:chunks', 0),
+            mock.call('snapshot:2:chunks', 1)])
+        self.assertFalse(redis_conn.mget.called)
+
+        self.assertEqual(storage.get_snapshots_by_versions([]), [])
+
+        redis_lock_mget_script.return_value = [0]
+        self.assertRaises(
+            SnapshotsLockedException,
+            storage.get_snapshots_by_versions, [1, 2])
+
+        pipeline.execute.return_value = chunks[:1]
+        redis_lock_mget_script.return_value = [1, [
+            packed_payloads[0], 'chunks:2:%d' % len(packed_payloads[1])]]
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_snapshots_by_versions, [1, 2])
+
+        redis_lock_mget_script.side_effect = redis.RedisError()
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_snapshots_by_versions, [1])
+
+    def test_get_patches_by_versions(self):
+        redis_conn = mock.Mock()
+        storage = CoreDataSnapshotStorage(
+            redis_conn, ignore_snapshots_lock_always=True)
+        patch = Snapshot(1, {'a': 1}).make_patch(Snapshot(2, {'a': 2}))
+        packed_payload = storage.payload_serializer.pack(patch.payload)
+        redis_conn.mget.return_value = [packed_payload, None]
+
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_patches_by_versions, [1, 2])
+        redis_conn.mget.assert_called_once_with(
+            ['snapshot:1:patch', 'snapshot:2:patch'])
+
+        redis_conn.mget.return_value = [packed_payload]
+        patches = storage.get_patches_by_versions([1], concurrency=1)
+        self.assertEqual(patches[0].base_snapshot_version, 1)
+        self.assertEqual(patches[0].new_snapshot_version, 2)
+
+    def _make_sync_storage(
+            self, snapshots, patches, latest_version, squashed_patches=(),
+            **kwargs):
+        redis_conn = mock.Mock()
+        redis_lock_script = mock.Mock()
+        redis_conn.register_script.return_value = redis_lock_script
+        storage = CoreDataSnapshotStorage(
+            redis_conn, snapshots_lock_ttl=5,
+            ignore_snapshots_lock_once=False, **kwargs)
+        for snapshot in snapshots:
+            storage.set_snapshot_by_version(snapshot.version, snapshot)
+        for patch in patches:
+            storage.set_patch_by_version(patch.base_snapshot_version, patch)
+        for patch in squashed_patches:
+            storage._set_payload_by_key(
+                'snapshot:%s:squashed_patch' % patch.base_snapshot_version,
+                patch.payload)
+        set_calls = (
+            redis_conn.set.call_args_list +
+            redis_conn.pipeline.return_value.set.call_args_list)
+        values = dict(call[0] for call in set_calls)
+        values['snapshot:latest_version'] = latest_version
+        redis_conn.get.side_effect = values.get
+        redis_lock_script.side_effect = lambda keys, args, client: (
+            [1, values.get(keys[1])] if len(keys) > 1 else True)
+        return storage
+
+    def test_sync_snapshot_by_patches(self):
+        snapshot_1 = Snapshot(1, {'a': 1, 'b': {'c': 2}})
+        snapshot_2 = Snapshot(2, {'a': 1, 'b': {'c': 3}})
+        snapshot_3 = Snapshot(3, {'b': {'c': 3, 'd': 4}})
+        storage = self._make_sync_storage(
+            [snapshot_3], [
+                snapshot_1.make_patch(snapshot_2),
+                snapshot_2.make_patch(snapshot_3),
+            ], 3)
+
+        snapshot = Snapshot(1, {'a': 1, 'b': {'c': 2}})
+        synced_snapshot = storage.sync_snapshot(snapshot)
+        self.assertIs(synced_snapshot, snapshot)
+        self.assertEqual(synced_snapshot.version, 3)
+        self.assertEqual(synced_snapshot.payload, snapshot_3.payload)
+        self.assertIs(storage.sync_snapshot(snapshot), snapshot)
+
+    def test_sync_snapshot_broken_chain(self):
+        snapshot_1 = Snapshot(1, {'a': 1})
+        snapshot_2 = Snapshot(2, {'a': 2})
+        snapshot_3 = Snapshot(3, {'a': 3})
+        storage = self._make_sync_storage(
+            [snapshot_3], [snapshot_1.make_patch(snapshot_2)], 3)
+
+        snapshot = Snapshot(1, {'a': 1})
+        synced_snapshot = storage.sync_snapshot(snapshot)
+        self.assertIsNot(synced_snapshot, snapshot)
+        self.assertEqual(snapshot.version, 1)
+        self.assertEqual(synced_snapshot.version, 3)
+        self.assertEqual(synced_snapshot.payload, {'a': 3})
+
+    def test_sync_snapshot_failed_patch(self):
+        snapshot_1 = Snapshot(1, {'a': 1, 'b': {'c': 2}})
+        snapshot_2 = Snapshot(2, {'a': 2, 'b': {'c': 2}})
+        broken_patch = SnapshotPatch(2, {
+            'new_snapshot_version': 3,
+            'added': [(('a',), 3), (('b', 'c', 'd'), 4)], 'removed': []})
+        storage = self._make_sync_storage(
+            [], [snapshot_1.make_patch(snapshot_2), broken_patch], 3)
+
+        snapshot = Snapshot(1, {'a': 1, 'b': {'c': 2}})
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.sync_snapshot, snapshot)
+        self.assertEqual(snapshot.version, 2)
+        self.assertEqual(snapshot.payload, snapshot_2.payload)
+
+    def test_sync_snapshot_long_chain(self):
+        snapshots = [
+            Snapshot(version, {'a': version}) for version in (1, 2, 3)]
+        storage = self._make_sync_storage(
+            snapshots[-1:], [
+                snapshots[0].make_patch(snapshots[1]),
+                snapshots[1].make_patch(snapshots[2]),
+            ], 3)
+
+        snapshot = Snapshot(1, {'a': 1})
+        synced_snapshot = storage.sync_snapshot(snapshot, max_patches_count=1)
+        self.assertIsNot(synced_snapshot, snapshot)
+        self.assertEqual(synced_snapshot.payload, {'a': 3})
+
+        synced_snapshot = storage.sync_snapshot(None)
+        self.assertEqual(synced_snapshot.version, 3)
+        self.assertEqual(synced_snapshot.payload, {'a': 3})
+
+    def test_sync_snapshot_by_squashed_patch(self):
+        snapshots = [
+            Snapshot(version, {'a': version}) for version in (1, 2, 3)]
+        storage = self._make_sync_storage(
+            snapshots[-1:], [], 3, squashed_patches=[
+                snapshots[0].make_patch(snapshots[2])],
+            squashed_patches_count=2)
+
+        snapshot = Snapshot(1, {'a': 1})
+        synced_snapshot = storage.sync_snapshot(snapshot)
+        self.assertIs(synced_snapshot, snapshot)
+        self.assertEqual(synced_snapshot.payload, {'a': 3})
+
+        snapshot = Snapshot(2, {'a': 2})
+        synced_snapshot = storage.sync_snapshot(snapshot)
+        self.assertIsNot(synced_snapshot, snapshot)
+        self.assertEqual(synced_snapshot.payload, {'a': 3})
+
+    def test_publish_squashed_patches(self):
+        snapshots = [
+            Snapshot(version, {'a': version, 'b': 0})
+            for version in (1, 2, 3)]
+        storage = self._make_sync_storage(
+            [], [], 2, squashed_patches=[
+                snapshots[0].make_patch(snapshots[1])],
+            squashed_patches_count=3)
+        redis_conn = storage.redis_conn
+        redis_conn.zrevrange.return_value = ['2', '1']
+        redis_publish_script = mock.Mock(return_value=1)
+        redis_conn.register_script.return_value = redis_publish_script
+
+        storage.publish(
+            3, snapshots[2], patch=snapshots[1].make_patch(snapshots[2]))
+        keys = redis_publish_script.call_args[1]['keys']
+        args = redis_publish_script.call_args[1]['args'][3:]
+        values = {}
+        for key in keys[2:]:
+            arguments_count = args[1]
+            values[key] = args[2:2 + arguments_count]
+            args = args[2 + arguments_count:]
+
+        serializer = storage.payload_serializer
+        for version in (1, 2):
+            patch = SnapshotPatch(version, serializer.unpack(
+                values['snapshot:%d:squashed_patch' % version][0]))
+            self.assertEqual(patch.new_snapshot_version, 3)
+            snapshot = Snapshot(version, {'a': version, 'b': 0})
+            snapshot.apply_patch(patch)
+            self.assertEqual(snapshot.payload, snapshots[2].payload)
+
+
+class SegmentedCoreDataSnapshotStorageTestCase(unittest.TestCase):
+    def _make_storage(self, **kwargs):
+        redis_conn = mock.Mock()
+        pipeline = redis_conn.pipeline.return_value
+        values = {}
+        segments = {}
+        # digest -> keep-until time, as in the snapshot:segments sorted set
+        scores = {}
+
+        def get(key):
+            if key.startswith('snapshot:segment:'):
+                return segments.get(key[len('snapshot:segment:'):])
+            return values.get(key)
+
+        def execute():
+            for call in pipeline.set.call_args_list:
+                key, value = call[0]
+                if key.startswith('snapshot:segment:'):
+                    segments[key[len('snapshot:segment:'):]] = value
+                else:
+                    values[key] = value
+            for call in pipeline.zadd.call_args_list:
+                key, mapping = call[0]
+                if key == 'snapshot:segments':
+                    scores.update(mapping)
+            pipeline.set.reset_mock()
+            pipeline.zadd.reset_mock()
+            return []
+
+        def touch_segments(keys, args, client):
+            keep_until = args[0]
+            missing_digests = []
+            for digest in args[1:]:
+                if digest in segments:
+                    scores[digest] = max(scores.get(digest, 0), keep_until)
+                else:
+                    missing_digests.append(digest)
+            return missing_digests
+
+        def remove_segments(keys, args, client):
+            now = args[0]
+            removed_digests = []
+            for digest in args[1:]:
+                if digest in scores and scores[digest] < now:
+                    segments.pop(digest, None)
+                    del scores[digest]
+                    removed_digests.append(digest)
+            return removed_digests
+
+        def register_script(script):
+            if '--touchsegmentsscript' in script:
+                return mock.Mock(side_effect=touch_segments)
+            if '--removesegmentsscript' in script:
+                return mock.Mock(side_effect=remove_segments)
+            return mock.DEFAULT
+
+        pipeline.execute.side_effect = execute
+        redis_conn.get.side_effect = get
+        redis_conn.mget.side_effect = lambda keys: [get(key) for key in keys]
+        redis_conn.zrangebyscore.side_effect = lambda key, min, max: [
+            digest for digest, score in scores.iteritems()
+            if score < int(max[1:])]
+        redis_conn.register_script.side_effect = register_script
+
+        metrics_sink = HistogramMetricsSink()
+        storage = SegmentedCoreDataSnapshotStorage(
+            redis_conn, ignore_snapshots_lock_always=True,
+            segment_keys_count=4, metrics_sink=metrics_sink, **kwargs)
+        return storage, redis_conn, segments, scores
+
+    def test_set_get_snapshot_by_version(self):
+        storage, redis_conn, segments, scores = self._make_storage()
+        pipeline = redis_conn.pipeline.return_value
+        payload = dict(('key_%d' % index, index) for index in xrange(100))
+        storage.set_snapshot_by_version(1, Snapshot(1, payload))
+        manifest = redis_conn.get('snapshot:1')
+        self.assertTrue(manifest.startswith('segments:'))
+        digests = manifest[len('segments:'):].split(',')
+        self.assertGreater(len(digests), 1)
+        self.assertEqual(set(digests), set(segments))
+        self.assertEqual(set(scores), set(segments))
+
+        snapshot = storage.get_snapshot_by_version(1)
+        self.assertEqual(snapshot.payload, payload)
+        self.assertEqual(redis_conn.mget.call_count, 1)
+        snapshot.payload['key_1'] = 'changed'
+        self.assertEqual(storage.get_snapshot_by_version(1).payload, payload)
+        self.assertEqual(redis_conn.mget.call_count, 1)
+        self.assertEqual(
+            storage.metrics_sink.get_counter('redis.segment_cache_hits'),
+            len(digests))
+
+        new_payload = dict(payload, key_1='changed')
+        storage.set_snapshot_by_version(2, Snapshot(2, new_payload))
+        self.assertEqual(len(segments), len(digests) + 1)
+        self.assertEqual(
+            storage.metrics_sink.get_counter('redis.segments_skipped'),
+            len(digests) - 1)
+        self.assertEqual(
+            storage.get_snapshot_by_version(2).payload, new_payload)
+        self.assertEqual(redis_conn.mget.call_count, 2)
+        self.assertEqual(len(redis_conn.mget.call_args[0][0]), 1)
+
+        self.assertEqual(
+            storage.payload_serializer.unpack(
+                storage.get_packed_snapshot_by_version(2)), new_payload)
+
+    def test_get_snapshot_by_version_broken_segments(self):
+        storage, redis_conn, segments, scores = self._make_storage()
+        storage.set_snapshot_by_version(1, Snapshot(1, {'a': 1}))
+        storage.set_snapshot_by_version(2, Snapshot(2, {}))
+        self.assertEqual(storage.get_snapshot_by_version(2).payload, {})
+
+        storage.set_snapshot_by_version(1, Snapshot(1, {'a': 1}))
+        segments.clear()
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_snapshot_by_version, 1)
+
+    def test_publish(self):
+        storage, redis_conn, segments, scores = self._make_storage()
+        redis_publish_script = mock.Mock(return_value=1)
+        redis_conn.register_script.return_value = redis_publish_script
+        storage.publish(1, Snapshot(1, {'a': 1}))
+        keys = redis_publish_script.call_args[1]['keys']
+        self.assertEqual(keys[-2:], ['snapshot:1', 'snapshot:1:digest'])
+        self.assertEqual(keys[-3], 'snapshot:segments')
+        self.assertTrue(keys[2].startswith('snapshot:segment:'))
+
+    def test_collect_segments(self):
+        storage, redis_conn, segments, scores = self._make_storage(
+            segments_grace_period=10)
+        with mock.patch('time.time', return_value=100):
+            storage.set_snapshot_by_version(1, Snapshot(1, {'a': 1}))
+            storage.set_snapshot_by_version(2, Snapshot(2, {'b': 2}))
+        digest_1 = redis_conn.get('snapshot:1')[len('segments:'):]
+        digest_2 = redis_conn.get('snapshot:2')[len('segments:'):]
+        redis_conn.zrange.return_value = ['2']
+
+        # unreferenced but still within the grace period
+        with mock.patch('time.time', return_value=105):
+            self.assertEqual(storage.collect_segments(batch_size=1), [])
+        with mock.patch('time.time', return_value=111):
+            self.assertEqual(
+                storage.collect_segments(batch_size=1), [digest_1])
+        self.assertEqual(set(segments), set([digest_2]))
+        self.assertEqual(set(scores), set([digest_2]))
+
+        # a writer which skips a segment keeps it from being collected
+        # before its manifest is in place
+        with mock.patch('time.time', return_value=120):
+            storage.set_snapshot_by_version(3, Snapshot(3, {'b': 2}))
+            self.assertEqual(storage.collect_segments(), [])
+        self.assertEqual(scores[digest_2], 130)
+
+        # segments of an expiring manifest are kept as long as it lives
+        with mock.patch('time.time', return_value=200):
+            storage.set_snapshot_by_version(
+                4, Snapshot(4, {'a': 1}), ttl=60)
+        self.assertEqual(scores[digest_1], 260)
+        redis_conn.zrange.return_value = []
+        with mock.patch('time.time', return_value=250):
+            self.assertEqual(storage.collect_segments(), [digest_2])
+        with mock.patch('time.time', return_value=261):
+            self.assertEqual(storage.collect_segments(), [digest_1])
+        self.assertEqual(segments, {})
+
+        redis_conn.zrangebyscore.side_effect = redis.RedisError()
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException, storage.collect_segments)
+
+
+class CachedCoreDataSnapshotStorageTestCase(unittest.TestCase):
+    def test_get_snapshot_by_version(self):
+        dummy_storage = mock.Mock(wraps=DummyCoreDataSnapshotStorage())
+        storage = CachedCoreDataSnapshotStorage(dummy_storage)
+        storage.set_snapshot_by_version(1, Snapshot(1, {'a': 1}))
+
+        snapshot = storage.get_snapshot_by_version(1)
+        self.assertEqual(snapshot.payload, {'a': 1})
+        self.assertIs(storage.get_snapshot_by_version(1), snapshot)
+        self.assertEqual(dummy_storage.get_snapshot_by_version.call_count, 1)
+        self.assertEqual(storage.hits, 1)
+        self.assertEqual(storage.misses, 1)
+        self.assertTrue(storage.size > 0)
+
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_snapshot_by_version, 2)
+        self.assertEqual(storage.misses, 2)
+
+    def test_set_snapshot_by_version_invalidates(self):
+        storage = CachedCoreDataSnapshotStorage(
+            DummyCoreDataSnapshotStorage())
+        storage.set_snapshot_by_version(1, Snapshot(1, {'a': 1}))
+        storage.get_snapshot_by_version(1)
+        storage.set_snapshot_by_version(1, Snapshot(1, {'a': 2}))
+        self.assertEqual(storage.get_snapshot_by_version(1).payload, {'a': 2})
+        self.assertEqual(storage.misses, 2)
+
+    def test_evict_by_size(self):
+        dummy_storage = DummyCoreDataSnapshotStorage()
+        for version in (1, 2, 3):
+            dummy_storage.set_snapshot_by_version(
+                version, Snapshot(version, {'a': 'x' * 1000}))
+        storage = CachedCoreDataSnapshotStorage(dummy_storage, max_size=3000)
+
+        storage.get_snapshot_by_version(1)
+        storage.get_snapshot_by_version(2)
+        storage.get_snapshot_by_version(1)
+        storage.get_snapshot_by_version(3)
+        self.assertTrue(storage.size <= 3000)
+        self.assertEqual((storage.hits, storage.misses), (1, 3))
+
+        storage.get_snapshot_by_version(1)
+        self.assertEqual((storage.hits, storage.misses), (2, 3))
+        storage.get_snapshot_by_version(2)
+        self.assertEqual((storage.hits, storage.misses), (2, 4))
+
+        storage.invalidate()
+        self.assertEqual(storage.size, 0)
+
+    def test_size_estimate(self):
+        payload = dict(
+            ('key_%d' % index, {'value': 'value_%d' % index})
+            for index in xrange(20000))
+        dummy_storage = DummyCoreDataSnapshotStorage()
+        dummy_storage.set_snapshot_by_version(1, Snapshot(1, payload))
+        dummy_storage.set_snapshot_by_version(
+            2, CompactSnapshot(2, payload))
+        storage = CachedCoreDataSnapshotStorage(dummy_storage)
+
+        for version in (1, 2):
+            snapshot = dummy_storage.get_snapshot_by_version(version)
+            size = _get_payload_size(snapshot.payload)
+            with mock.patch(
+                    'sys.getsizeof', wraps=sys.getsizeof) as getsizeof:
+                storage.get_snapshot_by_version(version)
+            self.assertLess(getsizeof.call_count, 2000)
+            self.assertLess(abs(storage.size - size), size * 0.1)
+            storage.invalidate()
+
+
+class FakeS3Key(object):
+    # like boto, the size and the etag are the ones of the last response
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self._response = None
+        self._stream = None
+
+    def _get_etag(self, data):
+        return '"%s"' % hashlib.md5(data).hexdigest()
+
+    @property
+    def size(self):
+        if self._response is not None:
+            return self._response[0]
+        return len(self.bucket.objects[self.name])
+
+    @property
+    def etag(self):
+        if self._response is not None:
+            return self._response[1]
+        return self._get_etag(self.bucket.objects[self.name])
+
+    def set_contents_from_string(self, data):
+        self.bucket.objects[self.name] = data
+
+    def get_contents_as_string(self, headers=None):
+        if self.name not in self.bucket.objects:
+            raise boto.exception.S3ResponseError(404, 'Not Found')
+        data = self.bucket.objects[self.name]
+        etag = self._get_etag(data)
+        self.bucket.requests.append(headers)
+        headers = headers or {}
+        if headers.get('If-None-Match') == etag:
+            raise boto.exception.S3ResponseError(304, 'Not Modified')
+        if headers.get('If-Match', etag) != etag:
+            raise boto.exception.S3ResponseError(412, 'Precondition Failed')
+        self._response = (len(data), etag)
+        if 'Range' in headers:
+            start, end = headers['Range'].replace('bytes=', '').split('-')
+            data = data[int(start):int(end) + 1]
+        return data
+
+    def open_read(self, headers=None):
+        data = self.get_contents_as_string(headers=headers)
+        self._stream = iter([data[:5], data[5:]])
+
+    def read(self):
+        data = ''.join(self._stream)
+        self.close()
+        return data
+
+    def close(self):
+        self._stream = iter([])
+
+    def __iter__(self):
+        return self._stream
+
+
+class FakeS3MultipartUpload(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.parts = {}
+
+    def upload_part_from_file(self, part_file, part_num):
+        self.parts[part_num] = part_file.read()
+
+    def complete_upload(self):
+        self.bucket.objects[self.name] = ''.join(
+            part for _, part in sorted(self.parts.items()))
+
+    def cancel_upload(self):
+        self.parts.clear()
+
+
+class FakeS3Bucket(object):
+    def __init__(self):
+        self.objects = {}
+        self.requests = []
+        self.multipart_uploads = []
+
+    def get_key(self, name):
+        if name not in self.objects:
+            return None
+        return FakeS3Key(self, name)
+
+    def initiate_multipart_upload(self, name):
+        multipart_upload = FakeS3MultipartUpload(self, name)
+        self.multipart_uploads.append(multipart_upload)
+        return multipart_upload
+
+
+class S3CoreDataSnapshotStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.s3_bucket = FakeS3Bucket()
+
+        patcher = mock.patch('boto.connect_s3')
+        connect_s3 = patcher.start()
+        connect_s3.return_value.get_bucket.return_value = self.s3_bucket
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch('boto.s3.key.Key', FakeS3Key)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_snapshot_by_version_stream(self):
+        serializer = MsgPackZlibStreamPayloadSerializer()
+        storage = S3CoreDataSnapshotStorage(payload_serializer=serializer)
+        storage.set_snapshot_by_version(1, Snapshot(1, {'a': 1}))
+        self.assertIn('snapshots/snapshot_1', self.s3_bucket.objects)
+
+        snapshot = storage.get_snapshot_by_version(1)
+        self.assertEqual(snapshot.version, 1)
+        self.assertEqual(snapshot.payload, {'a': 1})
+        self.assertEqual(
+            self.s3_bucket.requests, [{'Range': 'bytes=0-8388607'}])
+
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_snapshot_by_version, 2)
+
+    def test_metrics_sink(self):
+        metrics_sink = HistogramMetricsSink()
+        storage = S3CoreDataSnapshotStorage(metrics_sink=metrics_sink)
+        storage.set_snapshot_by_version(1, Snapshot(1, 'test'))
+        storage.get_snapshot_by_version(1)
+
+        histograms = metrics_sink.summarize()['histograms']
+        for name in ('s3.pack', 's3.write', 's3.open', 's3.read',
+                     's3.unpack', 'zlib.compress', 'zlib.decompress'):
+            self.assertEqual(histograms[name]['count'], 1)
+        self.assertEqual(
+            histograms['s3.bytes_in']['sum'],
+            histograms['s3.bytes_out']['sum'])
+
+    def test_server_errors(self):
+        storage = S3CoreDataSnapshotStorage(part_size=1000)
+        server_error = boto.exception.S3ResponseError(500, 'Internal Error')
+        with mock.patch.object(
+                FakeS3Key, 'set_contents_from_string',
+                side_effect=server_error):
+            self.assertRaises(
+                BaseCoreDataSnapshotStorageException,
+                storage.set_snapshot_by_version, 1, Snapshot(1, 'test'))
+
+        storage.set_snapshot_by_version(1, Snapshot(1, 'test'))
+        with mock.patch.object(
+                FakeS3Key, 'get_contents_as_string',
+                side_effect=server_error):
+            self.assertRaises(
+                BaseCoreDataSnapshotStorageException,
+                storage.get_snapshot_by_version, 1)
+
+    def test_set_get_snapshot_by_version_parts(self):
+        storage = S3CoreDataSnapshotStorage(
+            payload_serializer=ZlibPayloadSerializer(level=0),
+            part_size=1000, concurrency=3)
+        payload = ''.join(chr(i % 256) for i in xrange(4500))
+        storage.set_snapshot_by_version(1, Snapshot(1, payload))
+        multipart_upload, = self.s3_bucket.multipart_uploads
+        self.assertEqual(sorted(multipart_upload.parts), [1, 2, 3, 4, 5])
+
+        snapshot = storage.get_snapshot_by_version(1)
+        self.assertEqual(snapshot.payload, payload)
+        self.assertEqual(
+            sorted(headers['Range'] for headers in self.s3_bucket.requests),
+            ['bytes=0-999', 'bytes=1000-1999', 'bytes=2000-2999',
+             'bytes=3000-3999', 'bytes=4000-4510'])
+
+    def test_get_snapshot_by_version_parts_framed(self):
+        storage = S3CoreDataSnapshotStorage(
+            payload_serializer=FramedPayloadSerializer(),
+            part_size=100, concurrency=2)
+        payload = dict(('key_%d' % index, index) for index in xrange(100))
+        storage.set_snapshot_by_version(1, Snapshot(1, payload))
+        self.assertGreater(
+            len(self.s3_bucket.objects['snapshots/snapshot_1']), 100)
+        self.assertEqual(storage.get_snapshot_by_version(1).payload, payload)
+
+    def test_get_snapshot_by_version_parts_stream(self):
+        payload = dict(('key_%d' % index, index) for index in xrange(100))
+        for concurrency in (1, 2):
+            storage = S3CoreDataSnapshotStorage(
+                payload_serializer=MsgPackZlibStreamPayloadSerializer(),
+                part_size=100, concurrency=concurrency)
+            storage.set_snapshot_by_version(1, Snapshot(1, payload))
+            size = len(self.s3_bucket.objects['snapshots/snapshot_1'])
+            self.s3_bucket.requests = []
+
+            with mock.patch.object(storage, '_download_parts') as download:
+                snapshot = storage.get_snapshot_by_version(1)
+            self.assertFalse(download.called)
+            self.assertEqual(snapshot.payload, payload)
+            self.assertEqual(
+                [headers['Range'] for headers in self.s3_bucket.requests],
+                ['bytes=%d-%d' % (offset, min(offset + 100, size) - 1)
+                 for offset in xrange(0, size, 100)])
+
+        self.s3_bucket.objects['snapshots/snapshot_1'] = (
+            self.s3_bucket.objects['snapshots/snapshot_1'][:size - 10])
+        storage._last_snapshot = None
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_snapshot_by_version, 1)
+
+    def test_set_get_snapshot_by_version_small(self):
+        storage = S3CoreDataSnapshotStorage(part_size=1000)
+        storage.set_snapshot_by_version(1, Snapshot(1, 'test'))
+        self.assertEqual(self.s3_bucket.multipart_uploads, [])
+        self.assertEqual(storage.get_snapshot_by_version(1).payload, 'test')
+        self.assertEqual(
+            self.s3_bucket.requests, [{'Range': 'bytes=0-999'}])
+
+    def test_get_snapshot_by_version_not_modified(self):
+        storage = S3CoreDataSnapshotStorage()
+        storage.set_snapshot_by_version(1, Snapshot(1, 'test'))
+        snapshot = storage.get_snapshot_by_version(1)
+        etag = FakeS3Key(self.s3_bucket, 'snapshots/snapshot_1').etag
+        self.assertIs(storage.get_snapshot_by_version(1), snapshot)
+        # no HEAD, the GET itself is conditional
+        self.assertEqual(self.s3_bucket.requests, [
+            {'Range': 'bytes=0-8388607'},
+            {'Range': 'bytes=0-8388607', 'If-None-Match': etag}])
+
+        storage.set_snapshot_by_version(1, Snapshot(1, 'new'))
+        self.assertEqual(storage.get_snapshot_by_version(1).payload, 'new')
+        self.assertEqual(len(self.s3_bucket.requests), 3)
+
+    def test_get_snapshot_by_version_overwritten(self):
+        # parts must come from the object whose first part was read
+        storage = S3CoreDataSnapshotStorage(
+            payload_serializer=ZlibPayloadSerializer(level=0),
+            part_size=1000, concurrency=1)
+        storage.set_snapshot_by_version(1, Snapshot(1, 'a' * 3000))
+        download_part = storage._download_part
+
+        def overwrite_download_part(s3_key, offset):
+            storage.set_snapshot_by_version(1, Snapshot(1, 'b' * 3000))
+            return download_part(s3_key, offset)
+
+        with mock.patch.object(
+                storage, '_download_part', overwrite_download_part):
+            self.assertRaises(
+                BaseCoreDataSnapshotStorageException,
+                storage.get_snapshot_by_version, 1)
+        self.assertEqual(
+            storage.get_snapshot_by_version(1).payload, 'b' * 3000)
+
+    def test_latest_version(self):
+        storage = S3CoreDataSnapshotStorage()
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException, storage.get_latest_version)
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.set_latest_version, 'test')
+
+        storage.set_latest_version(1)
+        self.assertEqual(storage.get_latest_version(), 1)
+        self.assertEqual(storage.get_latest_version(), 1)
+        self.assertEqual(
+            self.s3_bucket.requests[-1]['If-None-Match'],
+            FakeS3Key(self.s3_bucket, 'snapshots/latest_version').etag)
+
+        storage.set_latest_version(2)
+        self.assertEqual(storage.get_latest_version(), 2)
+
+    def test_upload_parts_error(self):
+        storage = S3CoreDataSnapshotStorage(
+            payload_serializer=ZlibPayloadSerializer(level=0),
+            part_size=1000)
+        with mock.patch.object(
+                FakeS3MultipartUpload, 'complete_upload',
+                side_effect=boto.exception.S3ResponseError(400, '')):
+            self.assertRaises(
+                BaseCoreDataSnapshotStorageException,
+                storage.set_snapshot_by_version, 1, Snapshot(1, 'x' * 3000))
+        self.assertEqual(self.s3_bucket.multipart_uploads[0].parts, {})
+        self.assertNotIn('snapshots/snapshot_1', self.s3_bucket.objects)
+
+
+class TieredCoreDataSnapshotStorageTestCase(unittest.TestCase):
+    def test_read_through(self):
+        primary_storage = mock.Mock()
+        primary_storage.get_snapshot_by_version.side_effect = (
+            BaseCoreDataSnapshotStorageException())
+        secondary_storage = DummyCoreDataSnapshotStorage()
+        secondary_storage.set_snapshot_by_version(1, Snapshot(1, 'test'))
+        storage = TieredCoreDataSnapshotStorage(
+            primary_storage, secondary_storage, fill_ttl=60)
+
+        self.assertEqual(storage.get_snapshot_by_version(1).payload, 'test')
+        primary_storage.set_snapshot_by_version.assert_called_once_with(
+            1, mock.ANY, ttl=60)
+        self.assertEqual(storage.metrics['misses'], 1)
+
+        primary_storage.get_snapshot_by_version.side_effect = None
+        primary_storage.get_snapshot_by_version.return_value = Snapshot(
+            1, 'primary')
+        self.assertEqual(
+            storage.get_snapshot_by_version(1).payload, 'primary')
+        self.assertEqual(storage.metrics['hits'], 1)
+
+        primary_storage.get_snapshot_by_version.side_effect = (
+            SnapshotsLockedException())
+        self.assertRaises(
+            SnapshotsLockedException, storage.get_snapshot_by_version, 1)
+
+        primary_storage.get_latest_version.side_effect = (
+            BaseCoreDataSnapshotStorageException())
+        secondary_storage.set_latest_version(1)
+        self.assertEqual(storage.get_latest_version(), 1)
+
+    def test_write_behind(self):
+        primary_storage = DummyCoreDataSnapshotStorage()
+        secondary_storage = mock.Mock(wraps=DummyCoreDataSnapshotStorage())
+        secondary_storage.set_snapshot_by_version.side_effect = [
+            BaseCoreDataSnapshotStorageException(), None]
+        storage = TieredCoreDataSnapshotStorage(
+            primary_storage, secondary_storage, retry_delay=0)
+
+        snapshot = Snapshot(1, 'test')
+        storage.set_snapshot_by_version(1, snapshot)
+        storage.set_latest_version(1)
+        self.assertIs(primary_storage.get_snapshot_by_version(1), snapshot)
+        storage.flush()
+
+        self.assertEqual(
+            secondary_storage.set_snapshot_by_version.call_count, 2)
+        secondary_storage.set_latest_version.assert_called_once_with(1)
+        metrics = storage.metrics
+        self.assertEqual(metrics['write_enqueues'], 2)
+        self.assertEqual(metrics['writes'], 2)
+        self.assertEqual(metrics['write_retries'], 1)
+        self.assertEqual(metrics['queue_size'], 0)
+
+    def test_write_behind_failures(self):
+        secondary_storage = mock.Mock()
+        secondary_storage.set_snapshot_by_version.side_effect = (
+            BaseCoreDataSnapshotStorageException())
+        storage = TieredCoreDataSnapshotStorage(
+            DummyCoreDataSnapshotStorage(), secondary_storage,
+            queue_size=1, enqueue_timeout=0, max_retries=1, retry_delay=0)
+        storage._start_writer_thread = mock.Mock()
+
+        storage.set_snapshot_by_version(1, Snapshot(1, 'test'))
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.set_snapshot_by_version, 2, Snapshot(2, 'test'))
+        self.assertEqual(storage.metrics['write_drops'], 1)
+        self.assertEqual(storage.metrics['queue_size'], 1)
+
+        del storage._start_writer_thread
+        storage._start_writer_thread()
+        storage.flush()
+        self.assertEqual(storage.metrics['write_failures'], 1)
+        self.assertEqual(
+            secondary_storage.set_snapshot_by_version.call_count, 2)
+
+        # neither the failed nor the dropped version becomes the latest one
+        storage.set_latest_version(1)
+        storage.flush()
+        storage.set_latest_version(2)
+        storage.flush()
+        self.assertFalse(secondary_storage.set_latest_version.called)
+        self.assertEqual(storage.metrics['latest_version_skips'], 2)
+
+        secondary_storage.set_snapshot_by_version.side_effect = None
+        storage.set_snapshot_by_version(2, Snapshot(2, 'test'))
+        storage.flush()
+        storage.set_latest_version(2)
+        storage.flush()
+        secondary_storage.set_latest_version.assert_called_once_with(2)
+
+    def test_write_behind_copy(self):
+        secondary_storage = DummyCoreDataSnapshotStorage()
+        storage = TieredCoreDataSnapshotStorage(
+            DummyCoreDataSnapshotStorage(), secondary_storage)
+        storage._start_writer_thread = mock.Mock()
+
+        snapshot = Snapshot(1, {'a': 1})
+        storage.set_snapshot_by_version(1, snapshot)
+        snapshot.apply_patch(SnapshotPatch(1, {
+            'new_snapshot_version': 2, 'added': [(('a',), 2)],
+            'removed': []}))
+
+        del storage._start_writer_thread
+        storage._start_writer_thread()
+        storage.flush()
+        self.assertEqual(
+            secondary_storage.get_snapshot_by_version(1).payload, {'a': 1})
+
+    def test_write_behind_unexpected_errors(self):
+        secondary_storage = mock.Mock()
+        secondary_storage.set_snapshot_by_version.side_effect = (
+            boto.exception.S3ResponseError(500, 'Internal Error'))
+        storage = TieredCoreDataSnapshotStorage(
+            DummyCoreDataSnapshotStorage(), secondary_storage,
+            max_retries=0, retry_delay=0)
+
+        storage.set_snapshot_by_version(1, Snapshot(1, 'test'))
+        storage.flush()
+        self.assertTrue(storage._writer_thread.is_alive())
+        self.assertEqual(storage.metrics['write_failures'], 1)
+
+        secondary_storage.set_snapshot_by_version.side_effect = None
+        storage.set_snapshot_by_version(2, Snapshot(2, 'test'))
+        storage.set_latest_version(2)
+        storage.flush()
+        self.assertEqual(storage.metrics['writes'], 2)
+        secondary_storage.set_latest_version.assert_called_once_with(2)
+
+
+class FileCoreDataSnapshotStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        serializer = MsgPackZlibPayloadSerializer()
+        self.storage = mock.Mock()
+        self.storage.payload_serializer = serializer
+        self.storage.get_packed_snapshot_by_version.return_value = (
+            serializer.pack({'a': 1}))
+
+    def test_get_snapshot_by_version(self):
+        storage = FileCoreDataSnapshotStorage(self.storage, self.directory)
+        snapshot = storage.get_snapshot_by_version(1)
+        self.assertEqual(snapshot.version, 1)
+        self.assertEqual(snapshot.payload, {'a': 1})
+        self.assertTrue(os.path.exists(
+            os.path.join(self.directory, 'snapshot_1')))
+
+        other_storage = FileCoreDataSnapshotStorage(
+            self.storage, self.directory)
+        self.assertEqual(
+            other_storage.get_snapshot_by_version(1).payload, {'a': 1})
+        self.assertEqual(
+            self.storage.get_packed_snapshot_by_version.call_count, 1)
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            ['snapshot_1', 'snapshot_1.lock'])
+
+    def test_get_snapshot_by_version_error(self):
+        storage = FileCoreDataSnapshotStorage(self.storage, self.directory)
+        self.storage.get_packed_snapshot_by_version.side_effect = (
+            BaseCoreDataSnapshotStorageException())
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_snapshot_by_version, 1)
+        self.assertEqual(os.listdir(self.directory), ['snapshot_1.lock'])
+
+        self.storage.get_packed_snapshot_by_version.side_effect = None
+        self.storage.get_packed_snapshot_by_version.return_value = 'test'
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException,
+            storage.get_snapshot_by_version, 1)
+
+    def test_set_snapshot_by_version(self):
+        storage = FileCoreDataSnapshotStorage(self.storage, self.directory)
+        storage.get_snapshot_by_version(1)
+        snapshot = Snapshot(1, {'a': 2})
+        storage.set_snapshot_by_version(1, snapshot)
+        self.storage.set_snapshot_by_version.assert_called_once_with(
+            1, snapshot)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, 'snapshot_1')))
+        storage.set_snapshot_by_version(2, Snapshot(2, {}))
+
+
+    def test_get_snapshot_by_version_framed(self):
+        serializer = FramedPayloadSerializer()
+        self.storage.get_packed_snapshot_by_version.return_value = (
+            serializer.pack({'a': 1}))
+        storage = FileCoreDataSnapshotStorage(
+            self.storage, self.directory, payload_serializer=serializer)
+        self.assertEqual(storage.get_snapshot_by_version(1).payload, {'a': 1})
+
+    def test_get_snapshot_by_version_lazy(self):
+        serializer = IndexedPayloadSerializer()
+        payload = dict(('key_%d' % index, index) for index in xrange(10))
+        self.storage.get_packed_snapshot_by_version.return_value = (
+            serializer.pack(payload))
+        storage = FileCoreDataSnapshotStorage(
+            self.storage, self.directory, snapshot_factory=LazySnapshot,
+            payload_serializer=serializer)
+        snapshot = storage.get_snapshot_by_version(1)
+        self.assertEqual(snapshot.payload['key_3'], 3)
+        self.assertEqual(dict(snapshot.payload), payload)
+
+    def test_prune_snapshot_files(self):
+        storage = FileCoreDataSnapshotStorage(
+            self.storage, self.directory, keep_count=2)
+        open(os.path.join(self.directory, 'other'), 'w').close()
+        for version in (1, 2, 3):
+            storage.get_snapshot_by_version(version)
+        self.assertEqual(sorted(os.listdir(self.directory)), [
+            'other', 'snapshot_2', 'snapshot_2.lock',
+            'snapshot_3', 'snapshot_3.lock'])
+
+        storage.get_snapshot_by_version(2)
+        storage.get_snapshot_by_version(1)
+        self.assertEqual(sorted(os.listdir(self.directory)), [
+            'other', 'snapshot_1', 'snapshot_1.lock',
+            'snapshot_3', 'snapshot_3.lock'])
+
+
+class SnapshotRefresherTestCase(unittest.TestCase):
+    def test_refresh(self):
+        storage = DummyCoreDataSnapshotStorage()
+        storage.set_latest_version(1)
+        storage.set_snapshot_by_version(1, Snapshot(1, {'a': 1}))
+        refresher = SnapshotRefresher(storage)
+        self.assertIsNone(refresher.snapshot)
+
+        self.assertTrue(refresher.refresh())
+        self.assertEqual(refresher.wait(0).payload, {'a': 1})
+        self.assertFalse(refresher.refresh())
+
+        storage.set_latest_version(2)
+        self.assertRaises(
+            BaseCoreDataSnapshotStorageException, refresher.refresh)
+        self.assertEqual(refresher.snapshot.version, 1)
+
+        storage.set_snapshot_by_version(2, Snapshot(2, {'a': 2}))
+        self.assertTrue(refresher.refresh())
+        self.assertEqual(refresher.snapshot.payload, {'a': 2})
+        self.assertEqual(refresher.metrics['refreshes'], 2)
+
+    def test_refresh_syncs_back_snapshot(self):
+        storage = mock.Mock()
+        snapshots = [Snapshot(version, {}) for version in (1, 2, 3)]
+        storage.get_latest_version.side_effect = [1, 2, 3]
+        storage.get_snapshot_by_version.side_effect = snapshots[:2]
+        storage.sync_snapshot.return_value = snapshots[2]
+        refresher = SnapshotRefresher(storage, max_patches_count=5)
+
+        refresher.refresh()
+        refresher.refresh()
+        self.assertFalse(storage.sync_snapshot.called)
+        refresher.refresh()
+        storage.sync_snapshot.assert_called_once_with(
+            snapshots[0], max_patches_count=5)
+        self.assertIs(refresher.snapshot, snapshots[2])
+
+    def test_run(self):
+        storage = mock.Mock()
+        storage.get_latest_version.return_value = 1
+        storage.get_snapshot_by_version.return_value = Snapshot(1, {})
+        pubsub = storage.subscribe_latest_version.return_value
+        messages = [{'type': 'message', 'data': '1'}, redis.RedisError()]
+
+        def get_message(timeout):
+            if messages:
+                message = messages.pop(0)
+                if isinstance(message, Exception):
+                    raise message
+                return message
+            refresher._stopped.set()
+
+        pubsub.get_message.side_effect = get_message
+        refresher = SnapshotRefresher(
+            storage, poll_interval=60, wait_interval=0.01)
+        refresher.start()
+        self.assertEqual(refresher.wait(1).version, 1)
+        refresher._thread.join(1)
+        refresher.stop()
+
+        metrics = refresher.metrics
+        self.assertEqual(metrics['notifications'], 1)
+        self.assertEqual(metrics['subscription_drops'], 1)
+        self.assertEqual(storage.subscribe_latest_version.call_count, 2)
+        self.assertTrue(pubsub.close.called)
+
+    def test_run_locked(self):
+        storage = mock.Mock()
+        storage.get_latest_version.return_value = 1
+        storage.get_snapshot_by_version.side_effect = [
+            SnapshotsLockedException(), Snapshot(1, {})]
+        pubsub = storage.subscribe_latest_version.return_value
+        messages = [{'type': 'message', 'data': '1'}]
+
+        def get_message(timeout):
+            if messages:
+                return messages.pop(0)
+            time.sleep(timeout)
+
+        pubsub.get_message.side_effect = get_message
+        refresher = SnapshotRefresher(
+            storage, poll_interval=60, wait_interval=0.01,
+            lock_retry_interval=0.05)
+        refresher.start()
+        self.addCleanup(refresher.stop)
+        # retried long before the next poll
+        self.assertEqual(refresher.wait(1).version, 1)
+        self.assertEqual(refresher.metrics['refresh_lock_retries'], 1)
+        self.assertEqual(refresher.metrics['notifications'], 1)